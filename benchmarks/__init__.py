@@ -0,0 +1,3 @@
+from __future__ import absolute_import, division, print_function
+
+__author__ = 'jgarman'
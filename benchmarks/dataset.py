@@ -0,0 +1,200 @@
+from __future__ import absolute_import, division, print_function
+import random
+import datetime
+from cbopensource.tools.eventduplicator.transporter import Transporter
+from cbopensource.tools.eventduplicator.file_endpoint import FileOutputSink
+
+__author__ = 'jgarman'
+
+VERSION = '5.1.1.150625.500'
+
+FEED_NAMES = ['virustotal', 'nvd', 'tor', 'isight']
+
+# (median, maximum) number of entries in each *_complete list of a process document
+EVENT_COUNTS = {
+    'modload_complete': (60, 5000),
+    'netconn_complete': (4, 2000),
+    'regmod_complete': (10, 3000),
+    'filemod_complete': (10, 3000)
+}
+
+SIZES = {
+    'small': 0.1,
+    'median': 1.0,
+    'large': 40.0
+}
+
+
+class SyntheticDataset(object):
+    """
+    Generates a deterministic Cb dataset: process documents with realistic event list sizes, plus the binaries,
+    sensors and feed documents that they reference.
+    """
+    def __init__(self, num_procs=1000, num_binaries=2000, num_sensors=10, feed_docs_per_feed=50, seed=1):
+        self.num_procs = num_procs
+        self.num_binaries = num_binaries
+        self.num_sensors = num_sensors
+        self.feed_docs_per_feed = feed_docs_per_feed
+        self.seed = seed
+
+        rng = random.Random(seed)
+        self.md5s = ['%032X' % rng.getrandbits(128) for _ in range(num_binaries)]
+        self.sensor_ids = list(range(1, num_sensors + 1))
+        self.base_time = datetime.datetime(2015, 11, 10, 19, 54, 45)
+
+    @staticmethod
+    def event_count(rng, kind, scale=None):
+        median, maximum = EVENT_COUNTS[kind]
+        if scale is None:
+            count = int(rng.lognormvariate(0, 1.0) * median)
+        else:
+            count = int(median * scale)
+        return max(0, min(count, maximum))
+
+    def timestamp(self, rng, fmt="%Y-%m-%d %H:%M:%S.000"):
+        return (self.base_time + datetime.timedelta(seconds=rng.randint(0, 86400 * 7))).strftime(fmt)
+
+    def process_doc(self, i, scale=None, rng=None):
+        """
+        Build process document number i. If scale is given, the event lists are scale * their median size instead of
+        being drawn from a lognormal distribution.
+        """
+        rng = rng or random.Random(self.seed * 1000003 + i)
+        sensor_id = self.sensor_ids[i % len(self.sensor_ids)]
+        guid = '%08x-0000-%04x-01d1-%012x' % (sensor_id, rng.getrandbits(16), i)
+        parent_guid = '%08x-0000-%04x-01d1-%012x' % (sensor_id, rng.getrandbits(16), max(i - 1, 0) // 4)
+        start = self.timestamp(rng, "%Y-%m-%dT%H:%M:%S.000Z")
+
+        doc = {
+            'unique_id': '%s-00000001' % guid,
+            'parent_unique_id': '%s-00000001' % parent_guid,
+            'sensor_id': sensor_id,
+            'hostname': 'workstation%d' % sensor_id,
+            'username': 'CORP\\user%d' % (i % 50),
+            'process_name': 'process%d.exe' % (i % 200),
+            'path': 'c:\\program files\\vendor%d\\process%d.exe' % (i % 20, i % 200),
+            'cmdline': '"c:\\program files\\vendor%d\\process%d.exe" --flag %d' % (i % 20, i % 200, i),
+            'process_md5': rng.choice(self.md5s),
+            'process_pid': rng.randint(4, 65535),
+            'parent_pid': rng.randint(4, 65535),
+            'group': 'Default Group',
+            'host_type': 'workstation',
+            'start': start,
+            'last_update': start,
+            'server_added_timestamp': start,
+            '_version_': rng.getrandbits(62),
+            'process_name_facet': 'process%d.exe' % (i % 200),
+        }
+
+        doc['modload_complete'] = ['%s|%s|c:\\windows\\system32\\module%d.dll' % (self.timestamp(rng),
+                                                                                 rng.choice(self.md5s),
+                                                                                 rng.randint(0, 5000))
+                                   for _ in range(self.event_count(rng, 'modload_complete', scale))]
+        doc['netconn_complete'] = ['%s|%d|%d|6|host%d.example.com|true' % (self.timestamp(rng),
+                                                                           rng.getrandbits(32), rng.randint(1, 65535),
+                                                                           rng.randint(0, 1000))
+                                   for _ in range(self.event_count(rng, 'netconn_complete', scale))]
+        doc['regmod_complete'] = ['2|%s|\\registry\\machine\\software\\vendor\\key%d' % (self.timestamp(rng),
+                                                                                        rng.randint(0, 10000))
+                                  for _ in range(self.event_count(rng, 'regmod_complete', scale))]
+        doc['filemod_complete'] = ['1|%s|c:\\users\\user%d\\appdata\\file%d.tmp||' % (self.timestamp(rng),
+                                                                                       i % 50, rng.randint(0, 10000))
+                                   for _ in range(self.event_count(rng, 'filemod_complete', scale))]
+        doc['modload_count'] = len(doc['modload_complete'])
+        doc['netconn_count'] = len(doc['netconn_complete'])
+        doc['regmod_count'] = len(doc['regmod_complete'])
+        doc['filemod_count'] = len(doc['filemod_complete'])
+
+        if rng.random() < 0.2:
+            feed_name = rng.choice(FEED_NAMES)
+            doc['alliance_data_%s' % feed_name] = ['%s-%d' % (feed_name, rng.randint(0, self.feed_docs_per_feed - 1))]
+            doc['alliance_score_%s' % feed_name] = rng.randint(1, 100)
+
+        return doc
+
+    def process_docs(self):
+        for i in range(self.num_procs):
+            yield self.process_doc(i)
+
+    def binary_doc(self, md5sum):
+        rng = random.Random(md5sum)
+        doc = {
+            'md5': md5sum,
+            'original_filename': 'module%d.dll' % rng.randint(0, 5000),
+            'orig_mod_len': rng.randint(4096, 20000000),
+            'company_name': 'Vendor %d' % rng.randint(0, 20),
+            'product_name': 'Product %d' % rng.randint(0, 100),
+            'file_desc': 'Synthetic module',
+            'digsig_result': 'Signed',
+            'is_executable_image': False,
+            'observed_filename': ['c:\\windows\\system32\\module%d.dll' % rng.randint(0, 5000)],
+            'server_added_timestamp': self.timestamp(rng, "%Y-%m-%dT%H:%M:%S.000Z"),
+            '_version_': rng.getrandbits(62),
+        }
+        if rng.random() < 0.1:
+            feed_name = rng.choice(FEED_NAMES)
+            doc['alliance_data_%s' % feed_name] = ['%s-%d' % (feed_name, rng.randint(0, self.feed_docs_per_feed - 1))]
+        return doc
+
+    def binary_docs(self):
+        for md5sum in self.md5s:
+            yield self.binary_doc(md5sum)
+
+    def sensor_doc(self, sensor_id):
+        return Transporter.generate_fake_sensor(sensor_id)
+
+    def sensor_docs(self):
+        for sensor_id in self.sensor_ids:
+            yield self.sensor_doc(sensor_id)
+
+    @staticmethod
+    def feed_metadata(feed_id, feed_name):
+        return {
+            'id': feed_id,
+            'name': feed_name,
+            'display_name': feed_name.title(),
+            'feed_url': 'https://feeds.example.com/%s' % feed_name,
+            'summary': 'Synthetic %s feed' % feed_name,
+            'icon': '',
+            'provider_url': 'https://www.example.com',
+            'tech_data': '',
+            'category': 'Synthetic',
+            'icon_small': ''
+        }
+
+    def feed_metadata_docs(self):
+        for i, feed_name in enumerate(FEED_NAMES):
+            yield self.feed_metadata(i + 1, feed_name)
+
+    def feed_docs(self):
+        for i, feed_name in enumerate(FEED_NAMES):
+            for n in range(self.feed_docs_per_feed):
+                doc_id = '%s-%d' % (feed_name, n)
+                yield {
+                    'id': doc_id,
+                    'feed_id': i + 1,
+                    'feed_name': feed_name,
+                    'unique_id': '%d:%s' % (i + 1, doc_id),
+                    'title': 'Report %s' % doc_id,
+                    'score': n % 100,
+                    'link': 'https://feeds.example.com/%s/%s' % (feed_name, doc_id),
+                    'create_time': '2015-11-10T19:54:45.000Z'
+                }
+
+    def write_package(self, pathname):
+        """
+        Write the whole dataset as a file package, in the layout produced by FileOutputSink.
+        """
+        sink = FileOutputSink(pathname)
+        sink.set_data_version(VERSION)
+        for doc in self.sensor_docs():
+            sink.output_sensor_info(doc)
+        for doc in self.feed_metadata_docs():
+            sink.output_feed_metadata(doc)
+        for doc in self.feed_docs():
+            sink.output_feed_doc(doc)
+        for doc in self.binary_docs():
+            sink.output_binary_doc(doc)
+        for doc in self.process_docs():
+            sink.output_process_doc(doc)
+        return pathname
@@ -0,0 +1,141 @@
+"""
+End-to-end benchmarks: time file->file, file->Solr and Solr->file transports of a synthetic dataset against a local
+fake Cb server, and report documents per second.
+
+    python -m benchmarks.e2e --procs 2000 --solr-latency 5
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+from cbopensource.tools.eventduplicator.transporter import Transporter
+from cbopensource.tools.eventduplicator.file_endpoint import FileInputSource, FileOutputSink
+from cbopensource.tools.eventduplicator.solr_endpoint import SolrInputSource, SolrOutputSink
+from cbopensource.tools.eventduplicator.metrics import registry, clock
+from benchmarks.dataset import SyntheticDataset, VERSION
+from benchmarks.fake_cb import FakeCbServer
+
+__author__ = 'jgarman'
+
+
+def run_transport(name, input_source, output_sink, **kwargs):
+    registry.reset()
+    t = Transporter(input_source, output_sink, **kwargs)
+    start = clock()
+    t.transport()
+    elapsed = clock() - start
+
+    snapshot = registry.snapshot()
+    total_docs = sum(v['count'] for v in snapshot['documents'].values())
+    result = {
+        'name': name,
+        'elapsed_seconds': elapsed,
+        'documents': dict((k, v['count']) for k, v in snapshot['documents'].items()),
+        'docs_per_sec': total_docs / elapsed,
+        'procs_per_sec': snapshot['documents'].get('proc', {}).get('count', 0) / elapsed,
+        'latency': snapshot['latency']
+    }
+    return result
+
+
+def file_to_file(dataset, workdir, options):
+    source = os.path.join(workdir, 'source')
+    return run_transport('file->file', FileInputSource(source),
+                         FileOutputSink(os.path.join(workdir, 'file-to-file')))
+
+
+def file_to_solr(dataset, workdir, options):
+    server = FakeCbServer(VERSION, solr_latency=options.solr_latency / 1000.0,
+                          db_latency=options.db_latency / 1000.0)
+    try:
+        return run_transport('file->solr', FileInputSource(os.path.join(workdir, 'source')),
+                             SolrOutputSink(server.connection()))
+    finally:
+        server.stop()
+
+
+def solr_to_file(dataset, workdir, options):
+    server = FakeCbServer(VERSION, solr_latency=options.solr_latency / 1000.0,
+                          db_latency=options.db_latency / 1000.0).load(dataset)
+    try:
+        return run_transport('solr->file', SolrInputSource(server.connection(), query='*:*'),
+                             FileOutputSink(os.path.join(workdir, 'solr-to-file')))
+    finally:
+        server.stop()
+
+
+def solr_to_file_prefetch(dataset, workdir, options):
+    server = FakeCbServer(VERSION, solr_latency=options.solr_latency / 1000.0,
+                          db_latency=options.db_latency / 1000.0).load(dataset)
+    try:
+        return run_transport('solr->file (prefetch)', SolrInputSource(server.connection(), query='*:*'),
+                             FileOutputSink(os.path.join(workdir, 'solr-to-file-prefetch')), prefetch=True)
+    finally:
+        server.stop()
+
+
+def solr_to_file_partitioned(dataset, workdir, options):
+    server = FakeCbServer(VERSION, solr_latency=options.solr_latency / 1000.0,
+                          db_latency=options.db_latency / 1000.0).load(dataset)
+    try:
+        return run_transport('solr->file (%d partitions)' % options.partitions,
+                             SolrInputSource(server.connection(), query='*:*', partitions=options.partitions),
+                             FileOutputSink(os.path.join(workdir, 'solr-to-file-partitioned')))
+    finally:
+        server.stop()
+
+
+BENCHMARKS = [
+    ('file-file', file_to_file),
+    ('file-solr', file_to_solr),
+    ('solr-file', solr_to_file),
+    ('solr-file-prefetch', solr_to_file_prefetch),
+    ('solr-file-partitioned', solr_to_file_partitioned)
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run end-to-end cb-event-duplicator benchmarks")
+    parser.add_argument("--procs", help="Number of process documents to generate", type=int, default=1000)
+    parser.add_argument("--binaries", help="Number of binaries to generate", type=int, default=2000)
+    parser.add_argument("--sensors", help="Number of sensors to generate", type=int, default=10)
+    parser.add_argument("--solr-latency", help="Latency added to each fake Solr request, in ms", type=float,
+                        default=0.0)
+    parser.add_argument("--db-latency", help="Latency added to each fake database query, in ms", type=float,
+                        default=0.0)
+    parser.add_argument("--partitions", help="Number of time windows for the partitioned Solr read", type=int,
+                        default=4)
+    parser.add_argument("--only", help="Run only the named benchmark", choices=[b[0] for b in BENCHMARKS],
+                        action="append")
+    parser.add_argument("--json", help="Write the results as JSON to this file", action="store")
+    options = parser.parse_args()
+
+    dataset = SyntheticDataset(num_procs=options.procs, num_binaries=options.binaries, num_sensors=options.sensors)
+    workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        dataset.write_package(os.path.join(workdir, 'source'))
+        for name, benchmark in BENCHMARKS:
+            if options.only and name not in options.only:
+                continue
+            results.append(benchmark(dataset, workdir, options))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("%-24s %10s %12s %12s" % ("benchmark", "seconds", "docs/sec", "procs/sec"))
+    for result in results:
+        print("%-24s %10.2f %12.1f %12.1f" % (result['name'], result['elapsed_seconds'], result['docs_per_sec'],
+                                              result['procs_per_sec']))
+
+    if options.json:
+        with open(options.json, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
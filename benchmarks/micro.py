@@ -0,0 +1,158 @@
+"""
+CPU micro-benchmarks for the per-document hot paths: the mungers, the utils helpers and the dependency extraction in
+Transporter. Each function is run against generated process documents of small, median and very large size; with
+--compact, against the same documents with their event lists already parsed into EventColumns, as Transporter
+hands them to the mungers.
+
+    python -m benchmarks.micro --save-baseline baseline.json
+    python -m benchmarks.micro --compare baseline.json --threshold 1.25
+"""
+from __future__ import absolute_import, division, print_function
+import sys
+import json
+import argparse
+from copy import deepcopy
+from cbopensource.tools.eventduplicator.transporter import Transporter, CleanseSolrData, DataAnonymizer
+from cbopensource.tools.eventduplicator.utils import json_encode, update_sensor_id_refs
+from cbopensource.tools.eventduplicator.metrics import clock
+from cbopensource.tools.eventduplicator.events import compact_events
+from cbopensource.tools.eventduplicator import serializer
+from benchmarks.dataset import SyntheticDataset, SIZES
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__author__ = 'jgarman'
+
+
+def bench_update_md5sums(transporter, doc):
+    transporter.input_md5set = set()
+    return transporter.update_md5sums(doc)
+
+
+def bench_update_feeds(transporter, doc):
+    transporter.seen_feeds = set()
+    return transporter.update_feeds(doc)
+
+
+# name -> (function taking (transporter, doc), whether the function mutates the document)
+FUNCTIONS = [
+    ('CleanseSolrData.munge_document', lambda t, doc: CleanseSolrData.munge_document('proc', doc), True),
+    ('DataAnonymizer.anonymize', lambda t, doc: DataAnonymizer.anonymize(doc), True),
+    ('utils.json_encode', lambda t, doc: json_encode(doc), False),
+    ('serializer.dumps', lambda t, doc: serializer.dumps(doc), False),
+    ('utils.update_sensor_id_refs', lambda t, doc: update_sensor_id_refs(doc, 42), True),
+    ('Transporter.update_md5sums', bench_update_md5sums, False),
+    ('Transporter.update_feeds', bench_update_feeds, False),
+    ('events.compact_events', lambda t, doc: compact_events(doc), True),
+]
+
+
+def measure_time(fn, transporter, docs, mutates, repeat):
+    best = None
+    for _ in range(repeat):
+        batch = [deepcopy(doc) for doc in docs] if mutates else docs
+        start = clock()
+        for doc in batch:
+            fn(transporter, doc)
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1e9 / len(docs)
+
+
+def measure_allocations(fn, transporter, docs, mutates):
+    if not tracemalloc:
+        return None
+
+    batch = [deepcopy(doc) for doc in docs] if mutates else docs
+    total = 0
+    tracemalloc.start()
+    try:
+        for doc in batch:
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(transporter, doc)
+            total += tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return total // len(batch)
+
+
+def run(docs_per_size, repeat, only=None, compact=False):
+    dataset = SyntheticDataset(num_procs=docs_per_size)
+    transporter = Transporter(None, None)
+    results = {}
+
+    for size in ('small', 'median', 'large'):
+        docs = [dataset.process_doc(i, scale=SIZES[size]) for i in range(docs_per_size)]
+        doc_bytes = len(json_encode(docs[0]))
+        if compact:
+            docs = [compact_events(doc) for doc in docs]
+        for name, fn, mutates in FUNCTIONS:
+            if only and name not in only:
+                continue
+            results['%s/%s' % (name, size)] = {
+                'ns_per_doc': measure_time(fn, transporter, docs, mutates, repeat),
+                'alloc_bytes_per_doc': measure_allocations(fn, transporter, docs[:10], mutates),
+                'doc_bytes': doc_bytes
+            }
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        ratio = results[key]['ns_per_doc'] / baseline[key]['ns_per_doc']
+        if ratio > threshold:
+            regressions.append((key, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run cb-event-duplicator CPU micro-benchmarks")
+    parser.add_argument("--docs", help="Number of documents per size class", type=int, default=50)
+    parser.add_argument("--repeat", help="Number of timing runs; the fastest is reported", type=int, default=5)
+    parser.add_argument("--only", help="Run only the named function", action="append",
+                        choices=[f[0] for f in FUNCTIONS])
+    parser.add_argument("--compact", help="Parse the event lists of the documents into EventColumns first",
+                        action="store_true", default=False)
+    parser.add_argument("--save-baseline", help="Save the results to this baseline file", action="store")
+    parser.add_argument("--compare", help="Compare the results against this baseline file", action="store")
+    parser.add_argument("--threshold", help="Slowdown ratio against the baseline flagged as a regression",
+                        type=float, default=1.25)
+    options = parser.parse_args()
+
+    results = run(options.docs, options.repeat, options.only, options.compact)
+
+    print("%-42s %14s %16s %12s" % ("function/size", "ns/doc", "alloc bytes/doc", "doc bytes"))
+    for key in sorted(results):
+        result = results[key]
+        alloc = result['alloc_bytes_per_doc']
+        print("%-42s %14.0f %16s %12d" % (key, result['ns_per_doc'], '-' if alloc is None else alloc,
+                                          result['doc_bytes']))
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+        print("Baseline saved to %s" % options.save_baseline)
+
+    if options.compare:
+        with open(options.compare, 'r') as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, options.threshold)
+        for key, ratio in regressions:
+            print("REGRESSION: %s is %.2fx slower than the baseline" % (key, ratio))
+        if regressions:
+            return 1
+        print("No regressions against %s" % options.compare)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
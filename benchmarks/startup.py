@@ -0,0 +1,97 @@
+"""
+Startup benchmark: time fresh interpreters importing the CLI, printing --help and copying a tiny package from one
+directory to another, and check that none of them loads the heavy dependencies that only Cb server endpoints need.
+
+    python -m benchmarks.startup --runs 10 --max-ms 250
+"""
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+from cbopensource.tools.eventduplicator.metrics import clock
+from benchmarks.dataset import SyntheticDataset
+
+__author__ = 'jgarman'
+
+# modules that must not be imported unless a Cb server (or an option that needs them) is involved
+HEAVY_MODULES = ['paramiko', 'psycopg2', 'requests', 'multiprocessing.managers', 'sqlite3', 'aiohttp', 'asyncpg']
+
+SCENARIO_TEMPLATE = """
+import io, sys, json
+sys.argv = %(argv)r
+sys.stdout, stdout = io.StringIO(), sys.stdout
+from cbopensource.tools.eventduplicator.data_migration import main
+if len(sys.argv) > 1:
+    try:
+        main()
+    except SystemExit:
+        pass
+sys.stdout = stdout
+print(json.dumps(sorted(m for m in %(heavy)r if m in sys.modules)))
+"""
+
+
+def run_scenario(argv, env):
+    code = SCENARIO_TEMPLATE % {'argv': argv, 'heavy': HEAVY_MODULES}
+    start = clock()
+    output = subprocess.check_output([sys.executable, '-c', code], env=env, stderr=subprocess.STDOUT)
+    elapsed = clock() - start
+    return elapsed, json.loads(output.decode('utf8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time cb-event-duplicator startup")
+    parser.add_argument("--runs", help="Number of interpreter launches per scenario", type=int, default=10)
+    parser.add_argument("--max-ms", help="Fail if any scenario's median startup time exceeds this", type=float,
+                        action="store")
+    options = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([os.getcwd()] + [p for p in [env.get('PYTHONPATH')] if p])
+    try:
+        source = os.path.join(workdir, 'source')
+        SyntheticDataset(num_procs=10, num_binaries=10, num_sensors=2).write_package(source)
+
+        scenarios = [
+            ('import', ['cb-event-duplicator']),
+            ('--help', ['cb-event-duplicator', '--help']),
+            ('file->file', ['cb-event-duplicator', source, os.path.join(workdir, 'destination')])
+        ]
+
+        # one untimed launch so that every scenario sees warm .pyc files and OS caches
+        run_scenario(scenarios[0][1], env)
+
+        failed = False
+        print("%-12s %12s %12s  %s" % ("scenario", "median ms", "min ms", "heavy modules loaded"))
+        for name, argv in scenarios:
+            timings = []
+            loaded = []
+            for i in range(options.runs):
+                shutil.rmtree(os.path.join(workdir, 'destination'), ignore_errors=True)
+                elapsed, loaded = run_scenario(argv, env)
+                timings.append(elapsed * 1000.0)
+
+            print("%-12s %12.1f %12.1f  %s" % (name, median(timings), min(timings), ', '.join(loaded) or '-'))
+            if loaded:
+                failed = True
+            if options.max_ms and median(timings) > options.max_ms:
+                print("SLOW: %s took %.1f ms, more than %.1f ms" % (name, median(timings), options.max_ms))
+                failed = True
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
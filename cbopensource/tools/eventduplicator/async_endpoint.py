@@ -0,0 +1,690 @@
+"""
+asyncio variants of the Solr endpoints and the transport loop. Requires Python 3.6+, aiohttp and asyncpg.
+
+HTTP requests go over one aiohttp session per endpoint and database queries over an asyncpg pool, both through the
+connection's solr_url_base and db_endpoint(), so with an SSHConnection every request still travels through the one
+SSH transport, without a thread per request on our side.
+"""
+from __future__ import absolute_import, division, print_function
+import asyncio
+import inspect
+import logging
+import datetime
+from copy import deepcopy
+from cbopensource.tools.eventduplicator.solr_endpoint import SolrInputSource, SolrOutputSink
+from cbopensource.tools.eventduplicator.transporter import Transporter
+from cbopensource.tools.eventduplicator.utils import get_process_id, get_parent_process_id, update_sensor_id_refs, \
+    update_feed_id_refs
+from cbopensource.tools.eventduplicator.metrics import registry, clock
+from cbopensource.tools.eventduplicator.throttle import TokenBucket, AIMDController, backoff_delay
+from cbopensource.tools.eventduplicator import serializer
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+
+def check_dependencies():
+    missing = [name for name, module in (('aiohttp', aiohttp), ('asyncpg', asyncpg)) if module is None]
+    if missing:
+        raise Exception("The asyncio endpoints require the %s package(s)" % ', '.join(missing))
+
+
+async def maybe_await(value):
+    # lets the async transporter drive the synchronous file endpoints as well
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+# formats of the timestamps in sensor and feed metadata read from a package, or from Solr
+DB_TIMESTAMP_FORMATS = [serializer.DATE_FORMAT, "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S%z", "%Y-%m-%d %H:%M:%S",
+                        "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"]
+DB_TIME_TYPES = ('timestamp with time zone', 'timestamp without time zone', 'date')
+
+
+def db_value(value, data_type):
+    """
+    :return: value as asyncpg expects it for a column of data_type. Unlike psycopg2, asyncpg does not let Postgres
+    parse strings into dates and timestamps, so the strings that packages hold are parsed here.
+    """
+    if data_type not in DB_TIME_TYPES or not isinstance(value, str):
+        return value
+
+    for fmt in DB_TIMESTAMP_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(value, fmt)
+            break
+        except ValueError:
+            pass
+    else:
+        # leave it to asyncpg to report
+        return value
+
+    if data_type == 'date':
+        return parsed.date()
+    if data_type == 'timestamp with time zone':
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+    if parsed.tzinfo:
+        return parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def query_params(params):
+    # aiohttp wants a list of pairs of strings; list values (e.g. facet.field) become repeated parameters
+    pairs = []
+    for key, value in params.items():
+        for item in (value if isinstance(value, list) else [value]):
+            pairs.append((key, str(item)))
+    return pairs
+
+
+class AsyncSolrMixin(object):
+    """
+    Async HTTP and database plumbing shared by AsyncSolrInputSource and AsyncSolrOutputSink. cb.conf and the VERSION
+    file are still read through the (blocking) connection, once.
+    """
+    def init_async(self, concurrency):
+        self.concurrency = concurrency
+        self.session = None
+        self.pool = None
+        self.pool_lock = None
+        self.column_types = {}
+
+    async def open(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency),
+                                             timeout=aiohttp.ClientTimeout(total=60))
+        self.pool_lock = asyncio.Lock()
+
+    async def close_async(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def db_pool(self):
+        async with self.pool_lock:
+            if not self.pool:
+                username, password, hostname, remote_port, database_name = self.get_db_parameters()
+                host, port = self.connection.db_endpoint('127.0.0.1', int(remote_port))
+                self.pool = await asyncpg.create_pool(user=username, password=password, database=database_name,
+                                                      host=host, port=port, min_size=1,
+                                                      max_size=min(self.concurrency, 10))
+        return self.pool
+
+    async def db_fetchrow(self, query, *args):
+        pool = await self.db_pool()
+        with registry.timer('db_query'):
+            row = await pool.fetchrow(query, *args)
+        return dict(row) if row else None
+
+    async def solr_get_json(self, path, params):
+        """
+        :return: the decoded JSON response, or None if Solr did not return 200
+        """
+        with registry.timer('solr_get'):
+            async with self.session.get(self.connection.solr_url_base + path, params=query_params(params)) as resp:
+                if resp.status != 200:
+                    return None
+                return await resp.json(content_type=None)
+
+    async def solr_post_bytes(self, path, body):
+        """
+        :return: (HTTP status, response body) tuple
+        """
+        headers = {'content-type': 'application/json; charset=utf8'}
+        with registry.timer('solr_post'):
+            async with self.session.post(self.connection.solr_url_base + path, data=body, headers=headers) as resp:
+                return resp.status, await resp.read()
+
+    async def db_values(self, table_name, obj, keys):
+        """
+        :return: the values of obj's keys, converted for the types of the table's columns
+        """
+        if table_name not in self.column_types:
+            pool = await self.db_pool()
+            with registry.timer('db_query'):
+                rows = await pool.fetch('SELECT column_name, data_type FROM information_schema.columns '
+                                        'WHERE table_name = $1', table_name)
+            self.column_types[table_name] = dict((row['column_name'], row['data_type']) for row in rows)
+
+        column_types = self.column_types[table_name]
+        return [db_value(obj[key], column_types.get(key)) for key in keys]
+
+    async def find_db_row_matching(self, table_name, obj):
+        obj.pop('id', None)
+
+        keys = list(obj.keys())
+        predicate = ' AND '.join(["%s = $%d" % (key, i + 1) for i, key in enumerate(keys)])
+        try:
+            row = await self.db_fetchrow('SELECT id from %s WHERE %s' % (table_name, predicate),
+                                         *(await self.db_values(table_name, obj, keys)))
+        except (asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            # the row is then inserted, or its document dead-lettered if that fails too
+            log.error("Error looking up row in table %s: %s" % (table_name, e))
+            return None
+
+        if row:
+            return row['id']
+        else:
+            return None
+
+    async def insert_db_row(self, table_name, obj):
+        obj.pop('id', None)
+
+        keys = list(obj.keys())
+        values = ', '.join(['$%d' % (i + 1) for i in range(len(keys))])
+        query = 'INSERT INTO %s (%s) VALUES (%s) RETURNING id' % (table_name, ', '.join(keys), values)
+        try:
+            row = await self.db_fetchrow(query, *(await self.db_values(table_name, obj, keys)))
+            return row['id']
+        except (asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+            # the DataError that asyncpg raises for values it cannot bind is an InterfaceError, not a PostgresError
+            log.error("Error inserting row into table %s: %s" % (table_name, e))
+            return None
+
+    async def get_binary_doc(self, md5sum):
+        rj = await self.solr_get_json("/solr/cbmodules/select", {'q': 'md5:%s' % md5sum.upper(), 'wt': 'json'})
+        if rj is None:
+            return None
+        docs = rj.get('response', {}).get('docs', [{}])
+        if len(docs) == 0:
+            return None
+        return docs[0]
+
+
+class AsyncSolrInputSource(AsyncSolrMixin, SolrInputSource):
+    """
+    SolrInputSource whose document and database lookups are coroutines. get_process_docs is an async generator;
+    the partitions option is not used, since the async transporter overlaps the per-process lookups instead.
+    """
+    def __init__(self, connection, concurrency=50, **kwargs):
+        super(AsyncSolrInputSource, self).__init__(connection, **kwargs)
+        self.init_async(concurrency)
+
+    async def get_process_docs(self, query_filter=None):
+        if not query_filter:
+            async for doc in self.get_process_docs(self.query):
+                self.update_watermark(doc)
+                yield doc
+            return
+
+        params = {
+            'q': query_filter,
+            'sort': 'start asc',
+            'wt': 'json',
+            'rows': self.pagination_length,
+            'start': 0
+        }
+        while True:
+            rj = await self.solr_get_json("/solr/0/select", params)
+            docs = (rj or {}).get('response', {}).get('docs', [])
+            if not len(docs):
+                break
+            for doc in docs:
+                yield doc
+
+            params['start'] += len(docs)
+
+    async def get_feed_doc(self, feed_key):
+        feed_name, feed_id = feed_key.split(':')
+        rj = await self.solr_get_json("/solr/cbfeeds/select",
+                                      {'q': 'id:"%s" AND feed_name:%s' % (feed_id, feed_name), 'wt': 'json'})
+        if rj is None:
+            return None
+        docs = rj.get('response', {}).get('docs', [{}])
+        if len(docs) == 0:
+            return None
+
+        return docs[0]
+
+    async def get_feed_metadata(self, feed_id):
+        try:
+            return await self.db_fetchrow('SELECT id,name,display_name,feed_url,summary,icon,provider_url,tech_data,' +
+                                          'category,icon_small FROM alliance_feeds WHERE id=$1', feed_id)
+        except Exception as e:
+            log.error("Error getting feed metadata for id %s: %s" % (feed_id, str(e)))
+            return None
+
+    async def get_sensor_doc(self, sensor_id):
+        try:
+            sensor_info = await self.db_fetchrow('SELECT * FROM sensor_registrations WHERE id=$1', sensor_id)
+            build_info = await self.db_fetchrow('SELECT * FROM sensor_builds WHERE id=$1', sensor_info['build_id'])
+            environment_info = await self.db_fetchrow('SELECT * FROM sensor_os_environments WHERE id=$1',
+                                                      sensor_info['os_environment_id'])
+        except Exception as e:
+            log.error("Error getting sensor data for sensor id %s: %s" % (sensor_id, str(e)))
+            return None
+
+        if not sensor_info or not build_info or not environment_info:
+            log.error("Could not get full sensor data for sensor id %d" % sensor_id)
+            return None
+
+        return {
+            'sensor_info': sensor_info,
+            'build_info': build_info,
+            'os_info': environment_info
+        }
+
+
+class AsyncTokenBucket(TokenBucket):
+    """
+    TokenBucket whose acquire() is a coroutine, so that waiting for a token does not block the event loop.
+    """
+    async def acquire(self, tokens=1):
+        while True:
+            wait = self.reserve(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class AIMDWindow(AIMDController):
+    """
+    AIMDController whose acquire() and release() are coroutines. open() creates the condition on the event loop
+    that will use it.
+    """
+    def open(self):
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def release(self, latency, overloaded=False):
+        async with self.condition:
+            self.inflight -= 1
+            self.adjust(latency, overloaded)
+            self.condition.notify_all()
+
+
+class AsyncSolrOutputSink(AsyncSolrMixin, SolrOutputSink):
+    """
+    SolrOutputSink whose output_* methods are coroutines. The sensor and feed metadata database writes are issued
+    by the async transporter at most once per source id, so they need no locking of their own.
+
+    Document updates go through the same rate limit, AIMD window and jittered retries as SolrOutputSink's. Without
+    max_concurrency the window may grow to `concurrency`; it starts out fully open, as the async transporter has
+    that many processes in flight from the start.
+    """
+    def __init__(self, connection, concurrency=50, existing='overwrite', max_rate=None, max_concurrency=None,
+                 spool=None, destination=None):
+        super(AsyncSolrOutputSink, self).__init__(connection, existing=existing, spool=spool, destination=destination)
+        self.init_async(concurrency)
+
+        window = max_concurrency or concurrency
+        self.rate_limiter = AsyncTokenBucket(max_rate)
+        self.max_concurrency = window
+        self.post_window = AIMDWindow(window, initial=window, target_latency=2.0)
+
+    async def open(self):
+        await super(AsyncSolrOutputSink, self).open()
+        self.post_window.open()
+
+    async def output_doc(self, doc_type, doc_content):
+        body = b''.join((b'{"add":{"commitWithin":5000,"doc":', serializer.dumps(doc_content), b'}}'))
+        self.written_docs[doc_type] += 1
+
+        status, content, error = None, None, None
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            await self.post_window.acquire()
+            start = clock()
+            # anything else raised by the post, cancellation included, still frees its slot as overloaded
+            overloaded = True
+            try:
+                status, content = await self.solr_post_bytes(self.doc_endpoints[doc_type], body)
+                error = None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                status, error = None, e
+            else:
+                overloaded = status in self.retry_statuses
+            finally:
+                await self.post_window.release(clock() - start, overloaded)
+                registry.set_gauge('post_window', int(self.post_window.limit))
+
+            if status == 200:
+                registry.record_doc(doc_type, len(body))
+                return
+            if not overloaded or attempt == self.max_retries:
+                break
+
+            registry.increment('solr_post_retries')
+            await asyncio.sleep(backoff_delay(attempt))
+
+        if status is None:
+            # a timeout has no message of its own
+            error = str(error) or 'Timed out'
+        else:
+            error = "HTTP %d: %s" % (status, content.decode('utf8', 'replace'))
+        log.error("Error sending document to destination Solr: %s" % error)
+        with self.failed_lock:
+            self.failed_docs[doc_type] += 1
+        self.dead_letter(doc_type, doc_content, error)
+
+    async def output_feed_doc(self, doc_content):
+        if doc_content['feed_id'] not in self.feed_id_map:
+            log.warning("got feed document %s:%s without associated feed metadata" % (doc_content['feed_name'],
+                                                                                      doc_content['id']))
+        else:
+            feed_id = self.feed_id_map[doc_content['feed_id']]
+            doc_content = deepcopy(doc_content)
+            update_feed_id_refs(doc_content, feed_id)
+
+        await self.output_doc("feed", doc_content)
+
+    async def output_binary_doc(self, doc_content):
+        md5sum = doc_content.get('md5').upper()
+        if md5sum in self.existing_md5s:
+            return
+
+        if await self.get_binary_doc(md5sum):
+            self.existing_md5s.add(md5sum)
+            return
+
+        await self.output_doc("binary", doc_content)
+
+    async def output_process_doc(self, doc_content):
+        if doc_content['sensor_id'] not in self.sensor_id_map:
+            log.warning("Got process document %s without associated sensor data" % get_process_id(doc_content))
+        else:
+            sensor_id = self.sensor_id_map[doc_content['sensor_id']]
+            doc_content = deepcopy(doc_content)
+            update_sensor_id_refs(doc_content, sensor_id)
+
+        if self.existing_policy == 'overwrite':
+            await self.post_process_doc(doc_content)
+            return
+
+        self.pending_process_docs.append(doc_content)
+        if len(self.pending_process_docs) >= self.existence_batch_size:
+            await self.flush_process_docs()
+
+    async def flush_process_docs(self):
+        docs, self.pending_process_docs = self.pending_process_docs, []
+        if not docs:
+            return
+
+        try:
+            rj = await self.solr_get_json("/solr/0/select", self.existence_query(docs))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # a timeout has no message of its own
+            log.error("Error checking for existing process documents, sending them anyway: %s" %
+                      (str(e) or 'Timed out'))
+            rj = None
+        else:
+            if rj is None:
+                log.error("Error checking for existing process documents, sending them anyway")
+        existing_docs = (rj or {}).get('response', {}).get('docs', [])
+
+        await asyncio.gather(*[self.post_process_doc(doc) for doc in self.select_process_docs(docs, existing_docs)])
+
+    async def post_process_doc(self, doc_content):
+        last_update = doc_content.get("last_update", None) or self.now
+        doc_content["last_update"] = {"set": last_update}
+
+        doc_content.pop("last_server_update", None)
+
+        await self.output_doc("proc", doc_content)
+
+    async def output_feed_metadata(self, doc_content):
+        original_id = doc_content['id']
+        feed_id = await self.find_db_row_matching('alliance_feeds', {'name': doc_content['name']})
+        if feed_id:
+            self.feed_id_map[original_id] = feed_id
+            return
+
+        original_doc = deepcopy(doc_content)
+        doc_content.pop('id', None)
+        doc_content['manually_added'] = True
+        doc_content['enabled'] = False
+        doc_content['display_name'] += ' (added via cb-event-duplicator)'
+
+        feed_id = await self.insert_db_row('alliance_feeds', doc_content)
+        if not feed_id:
+            self.dead_letter('feed_metadata', original_doc, "Could not insert feed %s" % doc_content['name'])
+            return
+        self.new_metadata['feed'].append(doc_content['name'])
+        registry.record_doc('feed_metadata')
+
+        self.feed_id_map[original_id] = feed_id
+
+    async def output_sensor_info(self, doc_content):
+        original_id = doc_content['sensor_info']['id']
+        sensor_info = doc_content['sensor_info']
+        sensor_id = await self.find_db_row_matching('sensor_registrations',
+                                                    {'computer_dns_name': sensor_info['computer_dns_name'],
+                                                     'computer_name': sensor_info['computer_name']})
+
+        if sensor_id:
+            self.sensor_id_map[original_id] = sensor_id
+            return
+
+        original_doc = deepcopy(doc_content)
+        os_id = await self.find_db_row_matching('sensor_os_environments', doc_content['os_info'])
+        if not os_id:
+            os_id = await self.insert_db_row('sensor_os_environments', doc_content['os_info'])
+
+        build_id = await self.find_db_row_matching('sensor_builds', doc_content['build_info'])
+        if not build_id:
+            build_id = await self.insert_db_row('sensor_builds', doc_content['build_info'])
+
+        doc_content['sensor_info']['group_id'] = 1         # TODO: mirror groups?
+        doc_content['sensor_info']['build_id'] = build_id
+        doc_content['sensor_info']['os_environment_id'] = os_id
+        sensor_id = await self.insert_db_row('sensor_registrations', doc_content['sensor_info'])
+        if not sensor_id:
+            self.dead_letter('sensor', original_doc, "Could not insert sensor %s" % sensor_info['computer_name'])
+            return
+
+        self.new_metadata['sensor'].append(doc_content['sensor_info']['computer_name'])
+        registry.record_doc('sensor')
+        self.sensor_id_map[original_id] = sensor_id
+
+    async def cleanup(self):
+        await self.flush_process_docs()
+
+        for doc_type in self.doc_endpoints.keys():
+            await self.solr_post_bytes(self.doc_endpoints[doc_type] + '?commit=true', b'{}')
+
+
+class AsyncTransporter(Transporter):
+    """
+    Transporter that runs up to `concurrency` processes through the pipeline at once on an asyncio event loop. For
+    each process, its new binaries and feed hits are fetched and written concurrently; sensors and feed metadata are
+    created once, by whichever process first references them, and the others wait on that same task.
+
+    Either endpoint may also be one of the synchronous ones (e.g. a package directory).
+    """
+    def __init__(self, input_source, output_sink, tree=False, concurrency=50):
+        super(AsyncTransporter, self).__init__(input_source, output_sink, tree=tree)
+        self.concurrency = concurrency
+        self.sensor_tasks = {}
+        self.feed_metadata_tasks = {}
+
+    async def iterate_process_docs(self, query_filter=None):
+        docs = self.input.get_process_docs(query_filter)
+        if hasattr(docs, '__aiter__'):
+            async for doc in docs:
+                yield doc
+        else:
+            for doc in docs:
+                yield doc
+
+    async def traverse_up(self, guid):
+        total = []
+
+        async for proc in self.iterate_process_docs('unique_id:%s' % (guid,)):
+            process_id = get_process_id(proc)
+            if process_id not in self.input_proc_guids:
+                self.input_proc_guids.add(process_id)
+                total.append(proc)
+
+            parent_process_id = get_parent_process_id(proc)
+            if parent_process_id and parent_process_id not in self.input_proc_guids:
+                total.extend(await self.traverse_up(parent_process_id))
+
+        return total
+
+    async def traverse_down(self, guid):
+        total = []
+
+        async for proc in self.iterate_process_docs('parent_unique_id:%s' % (guid,)):
+            process_id = get_process_id(proc)
+            if process_id not in self.input_proc_guids:
+                self.input_proc_guids.add(process_id)
+                total.append(proc)
+
+            total.extend(await self.traverse_down(process_id))
+
+        return total
+
+    async def get_process_docs(self):
+        async for proc in self.iterate_process_docs():
+            process_id = get_process_id(proc)
+            if process_id not in self.input_proc_guids:
+                self.input_proc_guids.add(process_id)
+                yield proc
+
+            if self.traverse_tree:
+                parent_process_id = get_parent_process_id(proc)
+                total = []
+                if parent_process_id:
+                    total.extend(await self.traverse_up(parent_process_id))
+                total.extend(await self.traverse_down(process_id))
+                for tree_proc in total:
+                    yield tree_proc
+
+    async def transfer_binary(self, md5sum, referrer):
+        doc = await maybe_await(self.input.get_binary_doc(md5sum))
+        if not doc:
+            log.warning("Could not retrieve the binary MD5 %s referenced in %s" % (md5sum, referrer))
+            return set()
+
+        new_feed_ids = self.update_feeds(doc)
+        for munger in self.mungers:
+            doc = munger.munge_document('binary', doc)
+        await maybe_await(self.output.output_binary_doc(doc))
+        return new_feed_ids
+
+    async def transfer_sensor(self, sensor_id, referrer):
+        doc = await maybe_await(self.input.get_sensor_doc(sensor_id))
+        if not doc:
+            log.warning("Could not retrieve sensor info for sensor id %s referenced in %s" % (sensor_id, referrer))
+            doc = self.generate_fake_sensor(sensor_id)
+
+        for munger in self.mungers:
+            doc['sensor_info'] = munger.munge_document('sensor', doc['sensor_info'])
+        await maybe_await(self.output.output_sensor_info(doc))
+
+    async def transfer_feed_metadata(self, feed_id):
+        feed_metadata = await maybe_await(self.input.get_feed_metadata(feed_id))
+        if feed_metadata:
+            await maybe_await(self.output.output_feed_metadata(feed_metadata))
+
+    async def transfer_feed(self, feed_key, referrer):
+        doc = await maybe_await(self.input.get_feed_doc(feed_key))
+        if not doc:
+            log.warning("Could not retrieve feed document for id %s referenced in %s" % (feed_key, referrer))
+            return
+
+        for munger in self.mungers:
+            doc = munger.munge_document('feed', doc)
+
+        feed_id = doc['feed_id']
+        if feed_id not in self.feed_metadata_tasks:
+            self.feed_metadata_tasks[feed_id] = asyncio.ensure_future(self.transfer_feed_metadata(feed_id))
+        await self.feed_metadata_tasks[feed_id]
+
+        await maybe_await(self.output.output_feed_doc(doc))
+
+    async def transfer_process(self, proc):
+        referrer = "the process with ID: %s" % proc['unique_id']
+
+        for sensor_id in self.update_sensors(proc):
+            self.sensor_tasks[sensor_id] = asyncio.ensure_future(self.transfer_sensor(sensor_id, referrer))
+
+        new_feed_ids = self.update_feeds(proc)
+        for binary_feed_ids in await asyncio.gather(*[self.transfer_binary(md5sum, referrer)
+                                                      for md5sum in self.update_md5sums(proc)]):
+            new_feed_ids |= binary_feed_ids
+        await asyncio.gather(*[self.transfer_feed(feed_key, referrer) for feed_key in new_feed_ids])
+
+        # the process document needs its sensor to exist in the target first
+        sensor_task = self.sensor_tasks.get(proc.get('sensor_id', 0))
+        if sensor_task:
+            await sensor_task
+
+        for munger in self.mungers:
+            proc = munger.munge_document('proc', proc)
+        await maybe_await(self.output.output_process_doc(proc))
+
+        self.progress.update("Uploading %s (%.1f procs/sec)..." % (get_process_id(proc), registry.rate('proc')))
+
+    async def run(self):
+        for endpoint in (self.input, self.output):
+            if hasattr(endpoint, 'open'):
+                await endpoint.open()
+
+        try:
+            input_version = self.input.get_version()
+            if not self.output.set_data_version(input_version):
+                raise Exception("Input and Output versions are incompatible")
+
+            slots = asyncio.Semaphore(self.concurrency)
+            pending = set()
+            failures = []
+
+            def finished(task):
+                slots.release()
+                pending.discard(task)
+                if not task.cancelled() and task.exception():
+                    failures.append(task.exception())
+
+            async for proc in self.get_process_docs():
+                await slots.acquire()
+                # surface failures as soon as possible instead of after the whole query has been read
+                if failures:
+                    raise failures[0]
+
+                task = asyncio.ensure_future(self.transfer_process(proc))
+                task.add_done_callback(finished)
+                pending.add(task)
+                registry.set_gauge('inflight_processes', len(pending))
+
+            await asyncio.gather(*pending)
+            if failures:
+                raise failures[0]
+
+            # clean up
+            await maybe_await(self.input.cleanup())
+            await maybe_await(self.output.cleanup())
+        finally:
+            for endpoint in (self.input, self.output):
+                if hasattr(endpoint, 'close_async'):
+                    await endpoint.close_async()
+
+    def transport(self, debug=False):
+        log.info("Starting async transport from %s to %s with up to %d processes in flight" %
+                 (self.input.connection_name(), self.output.connection_name(), self.concurrency))
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.run())
+        finally:
+            loop.close()
+
+        self.progress.clear()
+
+        log.info("Transport complete from %s to %s" % (self.input.connection_name(), self.output.connection_name()))
@@ -0,0 +1,183 @@
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from cbopensource.tools.eventduplicator.metrics import registry
+from cbopensource.tools.eventduplicator import serializer
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cb-event-duplicator', 'cache.sqlite')
+
+
+class ContentCache(object):
+    """
+    Persistent key/document cache in a SQLite file. Entries older than `ttl` seconds are ignored and removed when
+    read; once the stored documents take up more than `max_bytes`, the least recently used ones are evicted.
+    """
+    def __init__(self, filename=None, ttl=86400, max_bytes=1024 * 1024 * 1024):
+        self.filename = filename or DEFAULT_CACHE_FILE
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.commit_interval = 100
+        self.pending_writes = 0
+        self.lock = threading.Lock()
+
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # worker processes may share the file, so wait for each other's write locks rather than failing
+        self.db = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, '
+                        'created REAL, accessed REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+        self.db.commit()
+
+    def write(self, query, args):
+        # called with the lock held
+        self.db.execute(query, args)
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_interval:
+            self.evict()
+            self.db.commit()
+            self.pending_writes = 0
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT value, created FROM entries WHERE key=?', (key,)).fetchone()
+            if row and row[1] < now - self.ttl:
+                self.write('DELETE FROM entries WHERE key=?', (key,))
+                row = None
+            if row:
+                self.write('UPDATE entries SET accessed=? WHERE key=?', (now, key))
+
+        if not row:
+            registry.increment('cache_misses')
+            return None
+
+        registry.increment('cache_hits')
+        return json.loads(bytes(row[0]).decode('utf8'))
+
+    def put(self, key, doc):
+        value = serializer.dumps(doc)
+        now = time.time()
+        with self.lock:
+            self.write('INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                       (key, sqlite3.Binary(value), len(value), now, now))
+
+    def evict(self):
+        # called with the lock held
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        excess = total - self.max_bytes
+        evicted = 0
+        for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+            if excess <= 0:
+                break
+            self.db.execute('DELETE FROM entries WHERE key=?', (key,))
+            excess -= size
+            evicted += 1
+
+        log.debug("Evicted %d entries from %s" % (evicted, self.filename))
+
+    def flush(self):
+        with self.lock:
+            self.evict()
+            self.db.commit()
+            self.pending_writes = 0
+
+
+class CachingInputSource(object):
+    """
+    Wraps an input source, answering binary, feed and sensor lookups from a ContentCache when possible. Keys are
+    prefixed with `namespace`, which should identify the source server. Lookups that fail are not cached.
+    """
+    def __init__(self, input_source, cache, namespace):
+        self.input = input_source
+        self.cache = cache
+        self.namespace = namespace
+
+    def __getattr__(self, name):
+        return getattr(self.input, name)
+
+    def key(self, kind, value):
+        return '%s|%s|%s' % (self.namespace, kind, value)
+
+    def cached(self, kind, value, fetch):
+        key = self.key(kind, value)
+        doc = self.cache.get(key)
+        if doc is None:
+            doc = fetch(value)
+            if doc:
+                self.cache.put(key, doc)
+        return doc
+
+    def get_binary_doc(self, md5sum):
+        return self.cached('binary', md5sum.upper(), self.input.get_binary_doc)
+
+    def get_binary_docs(self, md5sums):
+        missing = []
+        for md5sum in set(md5sum.upper() for md5sum in md5sums):
+            doc = self.cache.get(self.key('binary', md5sum))
+            if doc is None:
+                missing.append(md5sum)
+            else:
+                yield md5sum, doc
+
+        for md5sum, doc in self.input.get_binary_docs(missing):
+            if doc:
+                self.cache.put(self.key('binary', md5sum), doc)
+            yield md5sum, doc
+
+    def get_feed_doc(self, feed_key):
+        return self.cached('feed', feed_key, self.input.get_feed_doc)
+
+    def get_feed_docs(self, feed_keys):
+        missing = []
+        for feed_key in set(feed_keys):
+            doc = self.cache.get(self.key('feed', feed_key))
+            if doc is None:
+                missing.append(feed_key)
+            else:
+                yield feed_key, doc
+
+        for feed_key, doc in self.input.get_feed_docs(missing):
+            if doc:
+                self.cache.put(self.key('feed', feed_key), doc)
+            yield feed_key, doc
+
+    def get_feed_metadata(self, feed_id):
+        return self.cached('feed_metadata', feed_id, self.input.get_feed_metadata)
+
+    def get_feeds_metadata(self, feed_ids):
+        feed_info = {}
+        missing = []
+        for feed_id in set(feed_ids):
+            feed_metadata = self.cache.get(self.key('feed_metadata', feed_id))
+            if feed_metadata is None:
+                missing.append(feed_id)
+            else:
+                feed_info[feed_id] = feed_metadata
+
+        if missing:
+            for feed_id, feed_metadata in self.input.get_feeds_metadata(missing).items():
+                self.cache.put(self.key('feed_metadata', feed_id), feed_metadata)
+                feed_info[feed_id] = feed_metadata
+        return feed_info
+
+    def get_sensor_doc(self, sensor_id):
+        return self.cached('sensor', sensor_id, self.input.get_sensor_doc)
+
+    def cleanup(self):
+        self.cache.flush()
+        self.input.cleanup()
@@ -0,0 +1,121 @@
+from __future__ import absolute_import, division, print_function
+import logging
+import threading
+from copy import deepcopy
+from cbopensource.tools.eventduplicator.metrics import registry
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+
+class SinkWriter(object):
+    """
+    Feeds one output sink from its own thread and bounded queue, in the order the documents were handed over.
+    """
+    def __init__(self, index, sink, queue_length):
+        self.index = index
+        self.sink = sink
+        self.queue = Queue.Queue(maxsize=queue_length)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="sink-%d" % index)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            method_name, doc = self.queue.get()
+            if method_name is None:
+                return
+            if self.error:
+                # keep draining, so that a failed sink never blocks the reader
+                continue
+
+            try:
+                getattr(self.sink, method_name)(doc)
+            except Exception as e:
+                log.exception("Error writing to %s; no further documents will be sent to it" %
+                              self.sink.connection_name())
+                self.error = e
+
+    def put(self, method_name, doc):
+        self.queue.put((method_name, doc))
+        registry.set_gauge('sink_queue:%d' % self.index, self.queue.qsize())
+
+    def finish(self):
+        self.queue.put((None, None))
+        self.thread.join()
+        if self.error:
+            return
+
+        try:
+            self.sink.cleanup()
+        except Exception as e:
+            log.exception("Error finishing the writes to %s" % self.sink.connection_name())
+            self.error = e
+
+
+class CompositeOutputSink(object):
+    """
+    Output sink that writes every document to several sinks at once. Each sink gets its own copy of each document
+    and keeps its own sensor/feed id maps; it is written from its own thread, so a slow sink only holds back the
+    others once it is queue_length documents behind.
+    """
+    def __init__(self, sinks, queue_length=1000):
+        self.sinks = sinks
+        self.queue_length = queue_length
+        self.writers = []
+        # list of (sink, exception) pairs for the sinks that failed, once cleanup() has run
+        self.errors = []
+
+    def set_data_version(self, version):
+        if not all([sink.set_data_version(version) for sink in self.sinks]):
+            return False
+
+        # the version check is done; start the writers
+        self.writers = [SinkWriter(i, sink, self.queue_length) for i, sink in enumerate(self.sinks)]
+        return True
+
+    def dispatch(self, method_name, doc):
+        # sinks may modify the documents they are given, so all but the last one get a copy
+        for writer in self.writers[:-1]:
+            writer.put(method_name, deepcopy(doc))
+        self.writers[-1].put(method_name, doc)
+
+    def output_process_doc(self, doc_content):
+        self.dispatch('output_process_doc', doc_content)
+
+    def output_binary_doc(self, doc_content):
+        self.dispatch('output_binary_doc', doc_content)
+
+    def output_feed_doc(self, doc_content):
+        self.dispatch('output_feed_doc', doc_content)
+
+    def output_feed_metadata(self, doc_content):
+        self.dispatch('output_feed_metadata', doc_content)
+
+    def output_sensor_info(self, doc_content):
+        self.dispatch('output_sensor_info', doc_content)
+
+    def cleanup(self):
+        # a failed sink does not keep the others from finishing; its error is listed in the report instead
+        for writer in self.writers:
+            writer.finish()
+        self.errors = [(writer.sink, writer.error) for writer in self.writers if writer.error]
+
+    def connection_name(self):
+        return ', '.join(sink.connection_name() for sink in self.sinks)
+
+    def report(self):
+        errors = dict((id(sink), error) for sink, error in self.errors)
+        report_data = ''
+        for sink in self.sinks:
+            report_data += sink.report()
+            if id(sink) in errors:
+                report_data += "Writing to %s failed, and it may be missing documents: %s\n" % (sink.connection_name(),
+                                                                                                errors[id(sink)])
+        return report_data
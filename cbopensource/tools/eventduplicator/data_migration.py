@@ -2,16 +2,26 @@ from __future__ import absolute_import, division, print_function
 import sys
 import argparse
 import re
-import requests
 import tempfile
 import zipfile
 import logging
 import os.path
+import functools
+import time
+import copy
 from cbopensource.tools.eventduplicator.solr_endpoint import SolrInputSource, SolrOutputSink, LocalConnection
-from cbopensource.tools.eventduplicator.transporter import Transporter, DataAnonymizer
-from cbopensource.tools.eventduplicator.file_endpoint import FileInputSource, FileOutputSink
+from cbopensource.tools.eventduplicator.transporter import Transporter, DataAnonymizer, Amplifier, Sampler
+from cbopensource.tools.eventduplicator.file_endpoint import FileInputSource, FileOutputSink, ZipOutputSink
+from cbopensource.tools.eventduplicator.packed_endpoint import PackedInputSource, PackedOutputSink, is_packed_package
+from cbopensource.tools.eventduplicator.composite_endpoint import CompositeOutputSink
 from cbopensource.tools.eventduplicator import main_log
-from cbopensource.tools.eventduplicator.ssh_connection import SSHConnection
+from cbopensource.tools.eventduplicator.metrics import registry
+from cbopensource.tools.eventduplicator.watermark import WatermarkStore
+from cbopensource.tools.eventduplicator.deadletter import DeadLetterSpool, DEFAULT_DEAD_LETTER_FILE
+
+# paramiko (for SSH), requests (for downloads), the multiprocessing machinery and sqlite3 are only imported by the
+# functions below once an option needs them, so that package-to-package copies and --help start quickly;
+# benchmarks/startup.py keeps an eye on this
 
 __author__ = 'jgarman'
 
@@ -33,112 +43,452 @@ def initialize_logger(verbose):
     main_log.addHandler(handler)
 
 
-def input_from_zip(fn):
+host_match = re.compile("([^@]+)@([^:]+)(:([\d]*))?")
+
+
+def extract_zip(fn):
     tempdir = tempfile.mkdtemp()
     z = zipfile.ZipFile(fn)
     z.extractall(tempdir)
 
-    return FileInputSource(tempdir)
+    return tempdir
+
+
+def download_package(url):
+    import requests
+    with tempfile.NamedTemporaryFile() as handle:
+        response = requests.get(url, stream=True)
+        if not response.ok:
+            raise Exception("Could not retrieve package at %s" % url)
+        print("Downloading package from %s..." % url)
+        for block in response.iter_content(1024):
+            handle.write(block)
+
+        handle.flush()
+
+        print("Done. Unzipping...")
+        return extract_zip(handle.name)
+
+
+def is_server(spec):
+    return spec == 'local' or host_match.match(spec) is not None
+
+
+def open_ssh_connection(spec, password='', stripes=1):
+    from cbopensource.tools.eventduplicator.ssh_connection import SSHConnection
+    parts = host_match.match(spec)
+    port_number = 22
+    if parts.group(4):
+        port_number = int(parts.group(4))
+
+    return SSHConnection(username=parts.group(1), hostname=parts.group(2), port=port_number, password=password,
+                         stripes=stripes)
+
+
+def open_input(options):
+    """
+    Open the data source named by options.source, which must be a Cb server or a package directory.
+    """
+    if not is_server(options.source):
+        if is_packed_package(options.source):
+            return PackedInputSource(options.source)
+        return FileInputSource(options.source)
+
+    if options.source == 'local':
+        input_connection = LocalConnection()
+    else:
+        input_connection = open_ssh_connection(options.source, getattr(options, 'source_password', ''),
+                                               getattr(options, 'ssh_connections', 1))
+
+    if getattr(options, 'use_async', False):
+        from cbopensource.tools.eventduplicator.async_endpoint import AsyncSolrInputSource
+        return AsyncSolrInputSource(input_connection, concurrency=options.concurrency, query=options.query)
+
+    input_source = SolrInputSource(input_connection, query=options.query, partitions=options.partitions)
+    if options.cache is not None:
+        from cbopensource.tools.eventduplicator.cache import ContentCache, CachingInputSource
+        cache = ContentCache(options.cache, ttl=options.cache_ttl * 3600, max_bytes=options.cache_size * 1024 * 1024)
+        input_source = CachingInputSource(input_source, cache, namespace=options.source)
+    return input_source
+
+
+def open_output(options, create=True):
+    """
+    Open the data destinations named by options.destination; several destinations are written through a
+    CompositeOutputSink. With create=False, an existing package directory is reused rather than created.
+    """
+    sinks = [open_destination(options, destination, create=create) for destination in options.destination]
+    if len(sinks) == 1:
+        return sinks[0]
+    return CompositeOutputSink(sinks)
+
+
+def package_format(options, destination):
+    if getattr(options, 'package_format', None):
+        return options.package_format
+    return 'zip' if destination.lower().endswith('.zip') else 'directory'
+
+
+def open_destination(options, destination, create=True):
+    if not is_server(destination):
+        if package_format(options, destination) == 'zip':
+            return ZipOutputSink(destination)
+        if package_format(options, destination) == 'packed':
+            return PackedOutputSink(destination)
+        return FileOutputSink(destination, create=create)
+
+    if destination == 'local':
+        output_connection = LocalConnection()
+    else:
+        output_connection = open_ssh_connection(destination, getattr(options, 'destination_password', ''),
+                                                getattr(options, 'ssh_connections', 1))
+
+    spool = DeadLetterSpool(options.dead_letter_file)
+    if getattr(options, 'use_async', False):
+        from cbopensource.tools.eventduplicator.async_endpoint import AsyncSolrOutputSink
+        return AsyncSolrOutputSink(output_connection, concurrency=options.concurrency, existing=options.existing,
+                                   max_rate=options.max_rate, max_concurrency=options.max_concurrency, spool=spool,
+                                   destination=destination)
+    return SolrOutputSink(output_connection, existing=options.existing, max_rate=options.max_rate,
+                          max_concurrency=options.max_concurrency or 1, spool=spool, destination=destination)
+
+
+def create_transporter(options, input_source, output_sink):
+    amplifier = None
+    if options.amplify > 1:
+        amplifier = Amplifier(options.amplify, time_offset=options.amplify_time_offset)
+
+    if options.use_async:
+        from cbopensource.tools.eventduplicator.async_endpoint import AsyncTransporter
+        t = AsyncTransporter(input_source, output_sink, tree=options.tree, concurrency=options.concurrency)
+    elif options.processes > 1:
+        from cbopensource.tools.eventduplicator.parallel import ShardedTransporter
+        # workers open their own connections; hand them the passwords we were given, if any
+        options.source_password = getattr(getattr(input_source, 'connection', None), 'password', '')
+        options.destination_password = getattr(getattr(output_sink, 'connection', None), 'password', '')
+        t = ShardedTransporter(input_source, output_sink, functools.partial(open_input, options),
+                               functools.partial(open_output, options, create=False), processes=options.processes,
+                               tree=options.tree, prefetch=options.prefetch_dependencies, verbose=options.verbose,
+                               amplifier=amplifier, target_rate=options.target_rate)
+    else:
+        t = Transporter(input_source, output_sink, tree=options.tree, prefetch=options.prefetch_dependencies,
+                        amplifier=amplifier, target_rate=options.target_rate)
+
+    if options.anonymize:
+        t.add_anonymizer(DataAnonymizer())
+
+    return t
+
+
+def plan_transfer(options):
+    from cbopensource.tools.eventduplicator.planner import TransferPlanner, format_plan
+    # plans are made with the synchronous endpoints, also for --async runs, and without creating any packages
+    plan_options = copy.copy(options)
+    plan_options.use_async = False
+    input_source = open_input(plan_options)
+    destinations = [(destination, open_destination(plan_options, destination) if is_server(destination) else None)
+                    for destination in options.destination]
+
+    if options.incremental or options.follow:
+        watermark_key = WatermarkStore.key(options.source, ','.join(options.destination), options.query)
+        input_source.set_since(WatermarkStore(options.watermark_file).get(watermark_key))
+
+    planner = TransferPlanner(input_source, destinations, tree=options.tree,
+                              prefetch=options.prefetch_dependencies,
+                              parallelism=options.concurrency if options.use_async else options.processes,
+                              existing=options.existing, max_rate=options.max_rate,
+                              max_concurrency=options.max_concurrency or 1, amplify=options.amplify,
+                              target_rate=options.target_rate, sample_rate=options.sample)
+    print(format_plan(planner.plan()))
+    return 0
+
+
+def write_metrics(filename):
+    if filename:
+        registry.write_json(filename)
+        print("Metrics written to %s" % filename)
+
+
+def replay(args):
+    parser = argparse.ArgumentParser(prog="cb-event-duplicator replay",
+                                     description="Resend the documents saved in a dead-letter file")
+    parser.add_argument("spool_file", help="Dead-letter file written by a previous run")
+    parser.add_argument("destination", help="Send the documents to this Cb server rather than to the destination " +
+                                            "each of them was meant for. Only binaries, sensors and feed metadata " +
+                                            "can be sent elsewhere", nargs='?')
+    parser.add_argument("-v", "--verbose", help="Increase output verbosity", action="store_true")
+    parser.add_argument("--max-rate", help="Send at most this many documents per second", type=float,
+                        action="store")
+    parser.add_argument("--max-concurrency", help="Send up to this many documents at once", type=int, default=1)
+    options = parser.parse_args(args)
+
+    initialize_logger(options.verbose)
+
+    if not os.path.exists(options.spool_file):
+        sys.stderr.write("Cannot find file %s\n\n" % options.spool_file)
+        return 2
+
+    # documents that fail again are saved next to the original file, which is left untouched
+    base, ext = os.path.splitext(options.spool_file)
+    options.dead_letter_file = '%s-replay%s' % (base, ext)
+    options.existing = 'overwrite'
+
+    sinks = {}
+    replayed = 0
+    skipped = 0
+    for record in DeadLetterSpool.read(options.spool_file):
+        destination = options.destination or record['destination']
+        if not is_server(destination):
+            sys.stderr.write("Cannot replay a %s document to %s\n" % (record['doc_type'], destination))
+            skipped += 1
+            continue
+
+        if record['doc_type'] in ('proc', 'feed') and destination != record['destination']:
+            # these were saved as posted, with their sensor and feed ids rewritten for the original destination
+            sys.stderr.write("Cannot replay a %s document meant for %s to %s, as it refers to the sensors and feeds "
+                             "of %s\n" % (record['doc_type'], record['destination'], destination,
+                                          record['destination']))
+            skipped += 1
+            continue
+
+        if destination not in sinks:
+            sinks[destination] = open_destination(options, destination)
+        sinks[destination].replay_doc(record['doc_type'], record['doc'])
+        replayed += 1
+
+    for sink in sinks.values():
+        sink.cleanup()
+        print(sink.report())
+
+    print("Replayed %d documents from %s" % (replayed, options.spool_file))
+    if skipped:
+        print("Skipped %d documents that cannot be replayed" % skipped)
+        return 1
+    return 0
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        return replay(sys.argv[2:])
+
     ssh_help = ", or a remote Cb server (root@cb5.server:2202)"
     parser = argparse.ArgumentParser(description="Transfer data from one Cb server to another")
     parser.add_argument("source", help="Data source - can be a pathname (/tmp/blah), " +
                                        "a URL referencing a zip package" +
                                        "(http://my.server.com/package.zip), the local Cb server (local)%s" % ssh_help)
     parser.add_argument("destination", help="Data destination - can be a filepath (/tmp/blah), " +
-                                            "the local Cb server (local)%s" % ssh_help)
+                                            "the local Cb server (local)%s. " % ssh_help +
+                                            "Several destinations are written concurrently from one read",
+                        nargs='+')
     parser.add_argument("-v", "--verbose", help="Increase output verbosity", action="store_true")
     parser.add_argument("--anonymize", help="Anonymize data in transport", action="store_true", default=False)
     parser.add_argument("-q", "--query", help="Source data query (required for server input)", action="store")
     parser.add_argument("--tree", help="Traverse up and down process tree", action="store_true", default=False)
+    parser.add_argument("--prefetch-dependencies", help="Find and transfer the process binaries, sensors and " +
+                        "feed hits referenced by the query upfront, using Solr facets", action="store_true",
+                        default=False)
+    parser.add_argument("--partitions", help="Read a Solr source as this many time windows in parallel",
+                        type=int, default=1)
+    parser.add_argument("--processes", help="Shard process documents across this many worker processes",
+                        type=int, default=1)
+    parser.add_argument("--async", help="Use the asyncio endpoints for Cb servers (requires Python 3.6+, aiohttp " +
+                        "and asyncpg)", dest="use_async", action="store_true", default=False)
+    parser.add_argument("--concurrency", help="Number of processes in flight at once with --async",
+                        type=int, default=50)
+    parser.add_argument("--existing", help="What to do with process documents already in a Cb server destination: " +
+                        "overwrite them (default), skip them, or overwrite them only if the source copy is newer",
+                        choices=SolrOutputSink.existing_policies, default='overwrite')
+    parser.add_argument("--max-rate", help="Send at most this many documents per second to a Cb server destination",
+                        type=float, action="store")
+    parser.add_argument("--max-concurrency", help="Send up to this many documents at once to a Cb server " +
+                        "destination, backing off while it is slow or overloaded (default: 1, or --concurrency " +
+                        "with --async)", type=int)
+    parser.add_argument("--ssh-connections", help="Open this many SSH connections to each remote Cb server and " +
+                        "spread Solr requests across them; Postgres stays on the first one", type=int, default=1)
+    parser.add_argument("--dead-letter-file", help="Save documents that cannot be written to a Cb server " +
+                        "destination to this file, for 'cb-event-duplicator replay' (default: %s)" %
+                        DEFAULT_DEAD_LETTER_FILE, default=DEFAULT_DEAD_LETTER_FILE)
+    parser.add_argument("--cache", help="Keep binary, feed and sensor documents read from a Cb server source in a " +
+                        "local cache for later runs (default file: ~/.cb-event-duplicator/cache.sqlite)", nargs='?',
+                        const='')
+    parser.add_argument("--cache-ttl", help="Hours before a cached document is fetched again", type=float,
+                        default=24.0)
+    parser.add_argument("--cache-size", help="Maximum cache size in MB; least recently used documents are evicted " +
+                        "first", type=int, default=1024)
+    parser.add_argument("--incremental", help="Only transfer process documents updated since the last run with the " +
+                        "same source, destination and query", action="store_true", default=False)
+    parser.add_argument("--follow", help="Keep running, transferring new process documents every FOLLOW seconds " +
+                        "(implies --incremental)", type=int, action="store")
+    parser.add_argument("--watermark-file", help="File recording the last transferred update time for " +
+                        "--incremental (default: ~/.cb-event-duplicator/watermarks.json)", action="store")
+    parser.add_argument("--metrics-file", help="Write throughput and latency metrics as JSON to this file",
+                        action="store")
+    parser.add_argument("--amplify", help="Write each process this many times, each copy under its own generated " +
+                        "sensor with rewritten GUIDs and host names, to build load-test data", type=int, default=1)
+    parser.add_argument("--amplify-time-offset", help="Shift the times of each further --amplify copy by this many " +
+                        "seconds", type=int, default=0)
+    parser.add_argument("--sample", help="Copy only this fraction (0-1] of the matching processes, chosen by the " +
+                        "last digits of their GUIDs so every run picks the same ones; with --tree, their whole " +
+                        "trees are copied", type=float, action="store")
+    parser.add_argument("--target-rate", help="Write process documents, including --amplify copies, at this many " +
+                        "per second", type=float, action="store")
+    parser.add_argument("--package-format", help="Write a package destination as a directory tree, stream it " +
+                        "into a compressed zip file that can be used as a source as is, or pack it into a few " +
+                        "large indexed files for fast lookups (default: zip if the destination ends in .zip, " +
+                        "otherwise directory)", choices=['directory', 'zip', 'packed'])
+    parser.add_argument("--profile", help="Time Solr requests, Postgres queries, the SSH relay, munging and JSON " +
+                        "handling, and print a breakdown at the end of the run", action="store_true", default=False)
+    parser.add_argument("--profile-output", help="Write a cProfile dump of the main thread to this file " +
+                        "(implies --profile)", action="store")
+    parser.add_argument("--profile-sample", help="Sample the stacks of all threads every PROFILE_SAMPLE " +
+                        "milliseconds and report wall time per function (implies --profile)", type=float,
+                        action="store")
+    parser.add_argument("--plan", help="Estimate how many documents the transfer would copy, their size and how " +
+                        "long it would take, without transferring anything", action="store_true", default=False)
 
     options = parser.parse_args()
 
-    host_match = re.compile("([^@]+)@([^:]+)(:([\d]*))?")
-
-    source_parts = host_match.match(options.source)
-    destination_parts = host_match.match(options.destination)
-    input_source = None
-
     initialize_logger(options.verbose)
 
-    if options.source == options.destination:
+    if options.source in options.destination:
         sys.stderr.write("Talk to yourself often?\n\n")
         parser.print_usage()
         return 2
 
+    if len(options.destination) > 1 and (options.processes > 1 or options.use_async):
+        sys.stderr.write("Multiple destinations cannot be combined with --processes or --async\n\n")
+        parser.print_usage()
+        return 2
+
+    if options.processes > 1 and any(not is_server(destination) and package_format(options, destination) != 'directory'
+                                     for destination in options.destination):
+        sys.stderr.write("Zip and packed packages cannot be written with --processes\n\n")
+        parser.print_usage()
+        return 2
+
+    # zip and packed packages are finished off at the end of a transfer, and cannot take the documents of later passes
+    if options.follow and any(not is_server(destination) and package_format(options, destination) != 'directory'
+                              for destination in options.destination):
+        sys.stderr.write("Zip and packed packages cannot be written with --follow\n\n")
+        parser.print_usage()
+        return 2
+
+    if is_server(options.source) and not options.query:
+        sys.stderr.write("Query is required when using Solr as a data source\n\n")
+        parser.print_usage()
+        return 2
+
+    if (options.incremental or options.follow) and not is_server(options.source):
+        sys.stderr.write("Incremental sync requires a Cb server as the data source\n\n")
+        parser.print_usage()
+        return 2
+
+    if options.sample is not None and not 0 < options.sample <= 1:
+        sys.stderr.write("--sample must be a fraction greater than 0 and at most 1\n\n")
+        parser.print_usage()
+        return 2
+
+    if options.ssh_connections < 1:
+        sys.stderr.write("--ssh-connections must be at least 1\n\n")
+        parser.print_usage()
+        return 2
+
+    if options.use_async:
+        if options.processes > 1 or options.prefetch_dependencies or options.cache is not None or \
+                options.amplify > 1 or options.target_rate or options.ssh_connections > 1 or options.sample:
+            sys.stderr.write("--async cannot be combined with --processes, --prefetch-dependencies, --cache, " +
+                             "--amplify, --target-rate, --ssh-connections or --sample\n\n")
+            parser.print_usage()
+            return 2
+        try:
+            from cbopensource.tools.eventduplicator.async_endpoint import check_dependencies
+            check_dependencies()
+        except Exception as e:
+            # includes the SyntaxError raised importing the module on Python 2
+            sys.stderr.write("%s\n" % e)
+            return 2
+
     if options.source.startswith(('http://', 'https://')):
-        with tempfile.NamedTemporaryFile() as handle:
-            response = requests.get(options.source, stream=True)
-            if not response.ok:
-                raise Exception("Could not retrieve package at %s" % options.source)
-            print("Downloading package from %s..." % options.source)
-            for block in response.iter_content(1024):
-                handle.write(block)
-
-            handle.flush()
-
-            print("Done. Unzipping...")
-            input_source = input_from_zip(handle.name)
-    elif options.source == 'local':
-        input_connection = LocalConnection()
-        input_source = SolrInputSource(input_connection, query=options.query)
-    elif source_parts:
-        port_number = 22
-        if source_parts.group(4):
-            port_number = int(source_parts.group(4))
-
-        input_connection = SSHConnection(username=source_parts.group(1), hostname=source_parts.group(2),
-                                         port=port_number)
-        input_source = SolrInputSource(input_connection, query=options.query)
-    else:
-        # source_parts is a file path
+        options.source = download_package(options.source)
+    elif not is_server(options.source):
+        # source is a file path
         if not os.path.exists(options.source):
             sys.stderr.write("Cannot find file %s\n\n" % options.source)
             return 2
 
-        if os.path.isdir(options.source):
-            input_source = FileInputSource(options.source)
-        else:
+        if not os.path.isdir(options.source):
             print("Unzipping %s into a temporary directory for processing..." % options.source)
-            input_source = input_from_zip(options.source)
+            options.source = extract_zip(options.source)
 
-    if type(input_source) == SolrInputSource:
-        if not options.query:
-            sys.stderr.write("Query is required when using Solr as a data source\n\n")
-            parser.print_usage()
-            return 2
+    if options.plan:
+        return plan_transfer(options)
 
-    if options.destination == 'local':
-        output_connection = LocalConnection()
-        output_sink = SolrOutputSink(output_connection)
-    elif destination_parts:
-        port_number = 22
-        if destination_parts.group(4):
-            port_number = int(destination_parts.group(4))
-        output_connection = SSHConnection(username=destination_parts.group(1), hostname=destination_parts.group(2),
-                                          port=port_number)
-        output_sink = SolrOutputSink(output_connection)
-    else:
-        output_sink = FileOutputSink(options.destination)
+    profiler = None
+    if options.profile or options.profile_output or options.profile_sample:
+        from cbopensource.tools.eventduplicator.profiling import Profiler
+        profiler = Profiler(options.profile_output,
+                            options.profile_sample / 1000.0 if options.profile_sample else None)
+        profiler.start()
+
+    try:
+        input_source = open_input(options)
+        output_sink = open_output(options)
+        return run_transfers(options, input_source, output_sink)
+    finally:
+        if profiler:
+            profiler.stop()
+            print(profiler.report())
 
-    t = Transporter(input_source, output_sink, tree=options.tree)
 
-    if options.anonymize:
-        t.add_anonymizer(DataAnonymizer())
+def run_transfers(options, input_source, output_sink):
+    watermarks = None
+    watermark_key = None
+    if options.incremental or options.follow:
+        watermarks = WatermarkStore(options.watermark_file)
+        watermark_key = WatermarkStore.key(options.source, ','.join(options.destination), options.query)
+        since = watermarks.get(watermark_key)
+        if since:
+            print("Transferring process documents updated since %s" % since)
+        input_source.set_since(since)
 
-    try:
-        t.transport(debug=options.verbose)
-    except KeyboardInterrupt:
-        print("\nMigration interrupted. Processed:")
+    if options.sample:
+        input_source.set_sample(Sampler(options.sample))
+
+    while True:
+        t = create_transporter(options, input_source, output_sink)
+
+        try:
+            t.transport(debug=options.verbose)
+        except KeyboardInterrupt:
+            print("\nMigration interrupted. Processed:")
+            print(t.get_report())
+            write_metrics(options.metrics_file)
+            return 1
+
+        failed = getattr(output_sink, 'errors', None)
+        print("Migration finished, but not every destination was written to!" if failed else "Migration complete!")
         print(t.get_report())
-        return 1
+        print(registry.summary())
+        write_metrics(options.metrics_file)
+
+        if failed:
+            # leave the watermark alone, so the next run sends the failed destinations everything again
+            return 1
+
+        # only move the watermark once everything up to it has been written
+        if watermarks and input_source.watermark:
+            watermarks.set(watermark_key, input_source.watermark)
+            input_source.set_since(input_source.watermark)
+
+        if not options.follow:
+            return 0
+
+        try:
+            print("Waiting %d seconds for new data..." % options.follow)
+            time.sleep(options.follow)
+        except KeyboardInterrupt:
+            return 0
 
-    print("Migration complete!")
-    print(t.get_report())
-    return 0
 
 if __name__ == '__main__':
     main()
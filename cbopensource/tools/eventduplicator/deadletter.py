@@ -0,0 +1,66 @@
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import logging
+import datetime
+import threading
+from cbopensource.tools.eventduplicator import serializer
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DEAD_LETTER_FILE = 'cb-event-duplicator-failed.jsonl'
+
+
+class DeadLetterSpool(object):
+    """
+    Append-only file of the documents that could not be written to a destination, one JSON record per line:
+    {"time": ..., "destination": ..., "doc_type": ..., "error": ..., "doc": {...}}
+
+    The file is only created once the first document fails. Several sinks, or worker processes, may append to the
+    same file: each record is written with a single unbuffered write in append mode.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename or DEFAULT_DEAD_LETTER_FILE
+        self.count = 0
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def write(self, destination, doc_type, doc, error):
+        record = {
+            'time': datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            'destination': destination,
+            'doc_type': doc_type,
+            'error': str(error),
+            'doc': doc
+        }
+        line = serializer.dumps(record) + b'\n'
+
+        with self.lock:
+            if not self.fp:
+                self.fp = open(self.filename, 'ab', 0)
+            self.fp.write(line)
+            self.count += 1
+
+        log.warning("Saved failed %s document to %s" % (doc_type, self.filename))
+
+    def close(self):
+        with self.lock:
+            if self.fp:
+                self.fp.close()
+                self.fp = None
+
+    def report(self):
+        if not self.count:
+            return ''
+        return ("%d documents could not be written and were saved to %s.\n"
+                "Resend them with: cb-event-duplicator replay %s\n" % (self.count, os.path.abspath(self.filename),
+                                                                       self.filename))
+
+    @staticmethod
+    def read(filename):
+        with open(filename, 'rb') as fp:
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line.decode('utf8'))
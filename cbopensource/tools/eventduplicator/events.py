@@ -0,0 +1,174 @@
+from __future__ import absolute_import, division, print_function
+import sys
+import logging
+from array import array
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+# position of the timestamp, and of the GUID of another process if any, in each event type
+EVENT_FIELDS = {
+    'modload_complete': (0, None),
+    'netconn_complete': (0, None),
+    'regmod_complete': (1, None),
+    'filemod_complete': (1, None),
+    'crossproc_complete': (1, 2),
+    'childproc_complete': (0, 1)
+}
+
+try:
+    intern_string = sys.intern
+except AttributeError:
+    def intern_string(value):
+        # Python 2 only interns byte strings; the unicode strings that json returns are kept as they are
+        if isinstance(value, str):
+            return intern(value)
+        return value
+
+
+def intern_column(values):
+    return [value if value is None else intern_string(value) for value in values]
+
+
+class EventColumns(object):
+    """
+    The events of one *_complete field of a process document, split into a column per pipe-delimited field the first
+    time a field is changed. Every field except the timestamp is interned, so that MD5s, paths and host names
+    repeated across events and processes are stored once. Rows with fewer fields than others have None in the missing
+    columns, and `widths` records the number of fields in each row so that encode() gives back the original strings.
+
+    Until then the Solr strings are kept as they are: reading a field splits only as much of each event as it needs,
+    which is cheaper than building every column, and documents that are only read are written out as they came in.
+    Columns are never changed in place, which lets copies share them.
+
+    Process documents carry these in place of lists while they are munged; the serializer turns them back into
+    lists of strings when a sink writes the document.
+    """
+    def __init__(self, events, time_index=None):
+        self.events = events
+        self.time_index = time_index
+        self.columns = None
+        self.widths = None
+
+    def parse(self):
+        if self.columns is not None:
+            return
+
+        rows = [event.split('|') for event in self.events]
+        self.widths = array('H', [len(row) for row in rows])
+        width = max(self.widths) if rows else 0
+        if self.widths.count(width) != len(self.widths):
+            rows = [row + [None] * (width - len(row)) for row in rows]
+
+        self.columns = [list(column) for column in zip(*rows)]
+        for i in range(len(self.columns)):
+            if i != self.time_index:
+                self.columns[i] = intern_column(self.columns[i])
+
+    def encode(self):
+        """
+        :return: the events as Solr stores them, a list of pipe-delimited strings. Do not modify it.
+        """
+        if self.events is None:
+            width = len(self.columns)
+            if self.widths.count(width) == len(self.widths):
+                self.events = ['|'.join(row) for row in zip(*self.columns)]
+            else:
+                self.events = ['|'.join(row[:row_width]) for row, row_width in zip(zip(*self.columns), self.widths)]
+        return self.events
+
+    def column(self, index):
+        """
+        :return: the values of field `index`, with None for events that do not have that field
+        """
+        if self.columns is None:
+            return [fields[index] if len(fields) > index else None
+                    for fields in (event.split('|', index + 1) for event in self.events)]
+        if index >= len(self.columns):
+            return [None] * len(self.widths)
+        return self.columns[index]
+
+    def map_column(self, index, fn):
+        """
+        Replace each value of field `index` with fn(value), calling fn once per distinct value.
+        """
+        self.parse()
+        if index >= len(self.columns):
+            return
+
+        results = {None: None}
+        column = self.columns[index]
+        for value in column:
+            if value not in results:
+                results[value] = fn(value)
+        values = [results[value] for value in column]
+        self.columns[index] = values if index == self.time_index else intern_column(values)
+        self.events = None
+
+    def map_text(self, fn):
+        """
+        Apply fn, a string replacement that neither matches across nor introduces a '|', to every field of every
+        event. Columns are transformed as a whole, and only split again if fn changed them.
+        """
+        if self.columns is None:
+            self.events = [fn(event) for event in self.events]
+            return
+
+        for index, column in enumerate(self.columns):
+            values = [value for value in column if value is not None]
+            text = '|'.join(values)
+            new_text = fn(text)
+            if new_text == text:
+                continue
+
+            new_values = new_text.split('|')
+            if len(new_values) != len(values):
+                new_values = [fn(value) for value in values]
+            new_values = iter(new_values)
+            self.columns[index] = intern_column(value if value is None else next(new_values) for value in column)
+            self.events = None
+
+    def __len__(self):
+        if self.events is not None:
+            return len(self.events)
+        return len(self.widths)
+
+    def __iter__(self):
+        return iter(self.encode())
+
+    def __eq__(self, other):
+        if isinstance(other, EventColumns):
+            other = other.encode()
+        return self.encode() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __deepcopy__(self, memo):
+        # neither the event list nor the columns are modified in place, so the copy can share them
+        copy = EventColumns(self.events, self.time_index)
+        if self.columns is not None:
+            copy.columns = list(self.columns)
+            copy.widths = self.widths
+        return copy
+
+
+def compact_events(proc):
+    """
+    Replace the *_complete event lists of a process document with EventColumns, in place.
+    """
+    for field, (time_index, guid_index) in EVENT_FIELDS.items():
+        events = proc.get(field)
+        if isinstance(events, list):
+            proc[field] = EventColumns(events, time_index)
+    return proc
+
+
+def event_column(events, index):
+    """
+    :return: the values of field `index` of events, which may be EventColumns or a list of pipe-delimited strings
+    """
+    if isinstance(events, EventColumns):
+        return events.column(index)
+    return EventColumns(events).column(index)
@@ -1,11 +1,20 @@
 from __future__ import absolute_import, division, print_function
 import os
 import hashlib
-from cbopensource.tools.eventduplicator.utils import get_process_id, json_encode
+import zipfile
+import warnings
+import threading
+from cbopensource.tools.eventduplicator.utils import get_process_id
+from cbopensource.tools.eventduplicator import serializer
+from cbopensource.tools.eventduplicator.metrics import registry
 import json
 import codecs
 from collections import defaultdict
 import logging
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 __author__ = 'jgarman'
 
@@ -17,6 +26,12 @@ def get_process_path(proc_guid):
     return os.path.join(key[:2].upper(), '%s.json' % proc_guid)
 
 
+def process_id_from_filename(fn):
+    process_id = fn[:-len('.json')]
+    # old style process ids are integers
+    return int(process_id) if process_id.isdigit() else process_id
+
+
 def get_binary_path(md5sum):
     return os.path.join(md5sum[:2].upper(), '%s.json' % md5sum.lower())
 
@@ -25,6 +40,10 @@ class FileInputSource(object):
     def __init__(self, pathname):
         self.pathname = pathname
         self.reader = codecs.getreader("utf-8")
+        self.sampler = None
+
+    def set_sample(self, sampler):
+        self.sampler = sampler
 
     def get_version(self):
         return open(os.path.join(self.pathname, 'VERSION'), 'r').read()
@@ -36,12 +55,20 @@ class FileInputSource(object):
 
         for root, dirs, files in os.walk(os.path.join(self.pathname, 'procs')):
             for fn in files:
-                yield json.load(self.reader(open(os.path.join(root, fn), 'rb')))
+                # documents are named after their process id, so unsampled ones are skipped without reading them
+                if self.sampler and not self.sampler.keep(process_id_from_filename(fn)):
+                    continue
+                yield self.load_doc(os.path.join(root, fn))
+
+    def load_doc(self, pathname):
+        with registry.span('json_decode'):
+            with open(pathname, 'rb') as fp:
+                return json.load(self.reader(fp))
 
     def get_feed_doc(self, feed_key):
         pathname = os.path.join(self.pathname, 'feeds', '%s.json' % feed_key)
         try:
-            return json.load(self.reader(open(pathname, 'rb')))
+            return self.load_doc(pathname)
         except Exception as e:
             log.warning("Could not open feed document: %s - %s" % (pathname, str(e)))
             return None
@@ -49,20 +76,37 @@ class FileInputSource(object):
     def get_feed_metadata(self, feed_id):
         pathname = os.path.join(self.pathname, 'feeds', '%s.json' % feed_id)
         try:
-            return json.load(self.reader(open(pathname, 'rb')))
+            return self.load_doc(pathname)
         except Exception as e:
             log.warning("Could not open feed metadata: %s - %s" % (pathname, str(e)))
             return None
 
+    # packages are read one file per document; these match the batch lookups of SolrInputSource
+    def get_feed_docs(self, feed_keys):
+        for feed_key in feed_keys:
+            yield feed_key, self.get_feed_doc(feed_key)
+
+    def get_feeds_metadata(self, feed_ids):
+        feed_info = {}
+        for feed_id in feed_ids:
+            feed_metadata = self.get_feed_metadata(feed_id)
+            if feed_metadata:
+                feed_info[feed_id] = feed_metadata
+        return feed_info
+
     def get_binary_doc(self, md5sum):
         md5sum = md5sum.lower()
         pathname = os.path.join(self.pathname, 'binaries', get_binary_path(md5sum))
         try:
-            return json.load(self.reader(open(pathname, 'rb')))
+            return self.load_doc(pathname)
         except Exception as e:
             log.warning("Could not open binary document: %s - %s" % (pathname, str(e)))
             return None
 
+    def get_dependencies(self):
+        # file packages are not indexed; dependencies are found as each process document is read
+        return None
+
     def get_sensor_doc(self, sensor_id):
         pathname = os.path.join(self.pathname, 'sensors', '%d.json' % sensor_id)
         try:
@@ -79,32 +123,46 @@ class FileInputSource(object):
 
 
 class FileOutputSink(object):
-    def __init__(self, pathname):
+    def __init__(self, pathname, create=True):
         self.pathname = pathname
-        os.makedirs(pathname, 0o755)
+        if create:
+            self.create_directories()
 
-        os.makedirs(os.path.join(pathname, 'procs'), 0o755)
-        os.makedirs(os.path.join(pathname, 'binaries'), 0o755)
-        os.makedirs(os.path.join(pathname, 'sensors'), 0o755)
-        os.makedirs(os.path.join(pathname, 'feeds'), 0o755)
+        self.written_docs = defaultdict(int)
+        self.new_metadata = defaultdict(list)
+
+    def create_directories(self):
+        os.makedirs(self.pathname, 0o755)
+
+        os.makedirs(os.path.join(self.pathname, 'procs'), 0o755)
+        os.makedirs(os.path.join(self.pathname, 'binaries'), 0o755)
+        os.makedirs(os.path.join(self.pathname, 'sensors'), 0o755)
+        os.makedirs(os.path.join(self.pathname, 'feeds'), 0o755)
 
         # TODO: only create the directories we need
         for dirname in ['procs', 'binaries']:
             for segment in ['%02X' % x for x in range(0, 256)]:
-                os.makedirs(os.path.join(pathname, dirname, segment), 0o755)
-
-        self.written_docs = defaultdict(int)
-        self.new_metadata = defaultdict(list)
+                os.makedirs(os.path.join(self.pathname, dirname, segment), 0o755)
 
     def output_process_doc(self, doc_content):
         proc_guid = get_process_id(doc_content)
-        pathname = os.path.join(self.pathname, 'procs', get_process_path(proc_guid))
-        if os.path.exists(pathname):
+        relative_path = os.path.join('procs', get_process_path(proc_guid))
+        if self.has_doc(relative_path):
             log.warning('process %s already existed, writing twice' % proc_guid)
         self.format_date_fields(doc_content)
-        open(os.path.join(self.pathname, 'procs', get_process_path(proc_guid)), 'w').write(json_encode(doc_content))
+        self.write_doc('proc', relative_path, doc_content)
         self.written_docs['proc'] += 1
 
+    def has_doc(self, relative_path):
+        return os.path.exists(os.path.join(self.pathname, relative_path))
+
+    def write_doc(self, doc_type, relative_path, doc_content):
+        with registry.span('json_encode'):
+            data = serializer.dumps(doc_content)
+        with open(os.path.join(self.pathname, relative_path), 'wb') as fp:
+            fp.write(data)
+        registry.record_doc(doc_type, len(data))
+
     def format_date_fields(self, doc_content):
         for date_field in ['last_update', 'start', 'server_added_timestamp', 'last_server_update']:
             if (date_field in doc_content) and ('.' not in doc_content[date_field]):
@@ -113,22 +171,20 @@ class FileOutputSink(object):
 
     def output_binary_doc(self, doc_content):
         md5sum = doc_content.get('md5').lower()
-        open(os.path.join(self.pathname, 'binaries', get_binary_path(md5sum)), 'w').write(json_encode(doc_content))
+        self.write_doc('binary', os.path.join('binaries', get_binary_path(md5sum)), doc_content)
         self.written_docs['binary'] += 1
 
     def output_sensor_info(self, doc_content):
-        open(os.path.join(self.pathname, 'sensors', '%s.json' % doc_content['sensor_info']['id']), 'w').\
-            write(json_encode(doc_content))
+        self.write_doc('sensor', os.path.join('sensors', '%s.json' % doc_content['sensor_info']['id']), doc_content)
         self.new_metadata['sensor'].append(doc_content['sensor_info']['computer_name'])
 
     def output_feed_doc(self, doc_content):
-        open(os.path.join(self.pathname, 'feeds', '%s:%s.json' % (doc_content['feed_name'], doc_content['id'])), 'w').\
-            write(json_encode(doc_content))
+        self.write_doc('feed', os.path.join('feeds', '%s:%s.json' % (doc_content['feed_name'], doc_content['id'])),
+                       doc_content)
         self.written_docs['feed'] += 1
 
     def output_feed_metadata(self, doc_content):
-        open(os.path.join(self.pathname, 'feeds', '%s.json' % (doc_content['id'],)), 'w').\
-            write(json_encode(doc_content))
+        self.write_doc('feed_metadata', os.path.join('feeds', '%s.json' % (doc_content['id'],)), doc_content)
         self.new_metadata['feed'].append(doc_content['name'])
 
     def set_data_version(self, version):
@@ -153,3 +209,111 @@ class FileOutputSink(object):
                 report_data += " %s\n" % value
 
         return report_data
+
+
+class ZipOutputSink(FileOutputSink):
+    """
+    Writes the same layout as FileOutputSink, but streams it straight into a deflate-compressed zip file, which can
+    be given to cb-event-duplicator as a source directly or from a URL. Documents are serialized by the caller and
+    compressed and written by a worker thread; the zip is written as <filename>.partial and only renamed once
+    complete.
+
+    As in a package directory, a document written twice keeps its last copy. Zip entries cannot be replaced in
+    place, so the new copy is added under the same name and cleanup() leaves the replaced entries out.
+    """
+    def __init__(self, pathname, queue_length=1000, compression=zipfile.ZIP_DEFLATED):
+        if os.path.exists(pathname):
+            raise Exception("Package %s already exists" % pathname)
+
+        self.partial_pathname = pathname + '.partial'
+        self.compression = compression
+        self.zipfile = zipfile.ZipFile(self.partial_pathname, 'w', compression, allowZip64=True)
+        self.names = set()
+        self.replaced = False
+        self.error = None
+        self.queue = Queue.Queue(maxsize=queue_length)
+        self.thread = threading.Thread(target=self.run, name="zip-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+        super(ZipOutputSink, self).__init__(pathname, create=False)
+
+    def run(self):
+        while True:
+            relative_path, data, replacing = self.queue.get()
+            if relative_path is None:
+                return
+            if self.error:
+                continue
+
+            try:
+                if replacing:
+                    with warnings.catch_warnings():
+                        # zipfile warns about the duplicate name, which cleanup() resolves
+                        warnings.simplefilter('ignore')
+                        self.zipfile.writestr(relative_path, data)
+                else:
+                    self.zipfile.writestr(relative_path, data)
+            except Exception as e:
+                log.exception("Error writing %s to %s" % (relative_path, self.pathname))
+                self.error = e
+
+    def put(self, relative_path, data):
+        if self.error:
+            raise Exception("Could not write to %s: %s" % (self.pathname, self.error))
+
+        # zip entries always use forward slashes
+        relative_path = relative_path.replace(os.sep, '/')
+        replacing = relative_path in self.names
+        self.replaced |= replacing
+        self.names.add(relative_path)
+        self.queue.put((relative_path, data, replacing))
+        registry.set_gauge('zip_queue', self.queue.qsize())
+
+    def has_doc(self, relative_path):
+        return relative_path.replace(os.sep, '/') in self.names
+
+    def write_doc(self, doc_type, relative_path, doc_content):
+        with registry.span('json_encode'):
+            data = serializer.dumps(doc_content)
+        self.put(relative_path, data)
+        registry.record_doc(doc_type, len(data))
+
+    def set_data_version(self, version):
+        if type(version) != str:
+            version = version.decode('utf8')
+        self.put('VERSION', version.encode('utf8'))
+        return True
+
+    def cleanup(self):
+        self.queue.put((None, None, False))
+        self.thread.join()
+        self.zipfile.close()
+        if self.error:
+            raise Exception("Could not write to %s: %s" % (self.pathname, self.error))
+        if self.replaced:
+            self.drop_replaced_entries()
+        os.rename(self.partial_pathname, self.pathname)
+
+    def drop_replaced_entries(self):
+        """
+        Copy the zip, leaving out every entry that a later entry of the same name replaced.
+        """
+        compacted_pathname = self.partial_pathname + '.compacted'
+        with zipfile.ZipFile(self.partial_pathname) as source:
+            entries = source.infolist()
+            last_entries = dict((entry.filename, entry) for entry in entries)
+            with zipfile.ZipFile(compacted_pathname, 'w', self.compression, allowZip64=True) as target:
+                for entry in entries:
+                    if last_entries[entry.filename] is entry:
+                        target.writestr(entry, source.read(entry))
+
+        log.info("Removed %d replaced documents from %s" % (len(entries) - len(last_entries), self.pathname))
+        os.remove(self.partial_pathname)
+        os.rename(compacted_pathname, self.partial_pathname)
+
+    def report(self):
+        report_data = super(ZipOutputSink, self).report()
+        if os.path.exists(self.pathname):
+            report_data += "Package size: %.1f MB\n" % (os.path.getsize(self.pathname) / (1024.0 * 1024.0))
+        return report_data
@@ -0,0 +1,74 @@
+from __future__ import absolute_import, division, print_function
+import re
+import json
+import codecs
+import logging
+from cbopensource.tools.eventduplicator.metrics import registry
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+docs_start = re.compile(r'"response"\s*:\s*\{.*?"docs"\s*:\s*\[', re.DOTALL)
+whitespace = re.compile(r'[\s,]*')
+
+
+def iter_solr_docs(chunks):
+    """
+    Yield the documents of a Solr select response ({"response": {"docs": [...]}}) one by one, while the body is
+    still arriving as an iterable of byte chunks. Only the document being decoded is buffered, so memory is bounded
+    by the largest document rather than by the size of the page.
+
+    A body without a docs array (for instance a Solr error) is parsed whole, and yields nothing.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf8')()
+    chunks = iter(chunks)
+    buf = ''
+    eof = False
+
+    def read():
+        # :return: (text, whether the body has ended); text may be empty if a chunk ends within a character
+        try:
+            return text_decoder.decode(next(chunks)), False
+        except StopIteration:
+            return text_decoder.decode(b'', final=True), True
+
+    # skip ahead to the opening bracket of response.docs
+    while True:
+        match = docs_start.search(buf)
+        if match:
+            pos = match.end()
+            break
+        data, eof = read()
+        buf += data
+        if eof:
+            if not docs_start.search(buf):
+                json.loads(buf or '{}')
+                return
+
+    while True:
+        pos = whitespace.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == ']':
+            return
+
+        try:
+            if pos >= len(buf):
+                raise ValueError("need more data")
+            with registry.span('json_decode'):
+                doc, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise ValueError("Truncated Solr response")
+            # the document is incomplete: at least double what is buffered of it before trying again, so that
+            # large documents are not re-parsed once per chunk
+            buf = buf[pos:]
+            pos = 0
+            wanted = max(2 * len(buf), 1)
+            while len(buf) < wanted and not eof:
+                data, eof = read()
+                buf += data
+            continue
+
+        yield doc
+        pos = end
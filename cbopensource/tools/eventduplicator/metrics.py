@@ -0,0 +1,263 @@
+from __future__ import absolute_import, division, print_function
+import sys
+import time
+import json
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+__author__ = 'jgarman'
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    # upper bounds of each latency bucket, in milliseconds; the last bucket catches everything above
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        ms = seconds * 1000.0
+        for i, bound in enumerate(self.bounds):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+        self.count += 1
+        self.total += ms
+        if self.min is None or ms < self.min:
+            self.min = ms
+        if self.max is None or ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+
+        threshold = self.count * p / 100.0
+        running = 0
+        for i, n in enumerate(self.buckets):
+            running += n
+            if running >= threshold:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def merge(self, other):
+        # other is the to_dict() form of a histogram, e.g. from a worker process
+        if not other['count']:
+            return
+
+        bounds = [str(b) for b in self.bounds] + ['inf']
+        for i, bound in enumerate(bounds):
+            self.buckets[i] += other['buckets'].get(bound, 0)
+        self.count += other['count']
+        self.total += other['total_ms']
+        self.min = other['min_ms'] if self.min is None else min(self.min, other['min_ms'])
+        self.max = other['max_ms'] if self.max is None else max(self.max, other['max_ms'])
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total,
+            'mean_ms': self.total / self.count if self.count else None,
+            'min_ms': self.min,
+            'max_ms': self.max,
+            'p50_ms': self.percentile(50),
+            'p90_ms': self.percentile(90),
+            'p99_ms': self.percentile(99),
+            'buckets': dict(zip([str(b) for b in self.bounds] + ['inf'], self.buckets))
+        }
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Metrics(object):
+    """
+    Collects throughput counters, latency histograms and queue depth gauges for a single run.
+    All methods are safe to call from multiple threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # spans are only timed when profiling (--profile), as they wrap per-document work
+        self.tracing = False
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.docs = defaultdict(int)
+            self.bytes = defaultdict(int)
+            self.counters = defaultdict(int)
+            self.histograms = defaultdict(Histogram)
+            self.gauges = {}
+            self.gauge_max = {}
+
+    def record_doc(self, doc_type, nbytes=0):
+        with self.lock:
+            self.docs[doc_type] += 1
+            self.bytes[doc_type] += nbytes
+
+    def add_bytes(self, name, nbytes):
+        with self.lock:
+            self.counters[name] += nbytes
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(name, clock() - start)
+
+    def span(self, name):
+        if not self.tracing:
+            return null_span
+        return self.timer('span:%s' % name)
+
+    def span_iter(self, name, iterable):
+        """
+        Time each step of iterable as span `name`, e.g. reading chunks of a streamed response.
+        """
+        if not self.tracing:
+            return iterable
+        return self.timed_iter(name, iter(iterable))
+
+    def timed_iter(self, name, iterator):
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+            if value > self.gauge_max.get(name, 0):
+                self.gauge_max[name] = value
+
+    def elapsed(self):
+        return max(time.time() - self.started, 1e-6)
+
+    def rate(self, doc_type):
+        return self.docs.get(doc_type, 0) / self.elapsed()
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = self.elapsed()
+            return {
+                'elapsed_seconds': elapsed,
+                'documents': dict((k, {'count': self.docs[k],
+                                       'bytes': self.bytes[k],
+                                       'docs_per_sec': self.docs[k] / elapsed,
+                                       'bytes_per_sec': self.bytes[k] / elapsed}) for k in self.docs),
+                'counters': dict(self.counters),
+                'latency': dict((k, v.to_dict()) for k, v in self.histograms.items()),
+                'queues': dict((k, {'current': self.gauges[k], 'max': self.gauge_max.get(k, 0)})
+                               for k in self.gauges)
+            }
+
+    def merge(self, snapshot):
+        """
+        Add the counters and latencies from another registry's snapshot(), e.g. one taken in a worker process.
+        """
+        with self.lock:
+            for key, stats in snapshot['documents'].items():
+                self.docs[key] += stats['count']
+                self.bytes[key] += stats['bytes']
+            for key, value in snapshot['counters'].items():
+                self.counters[key] += value
+            for key, histogram in snapshot['latency'].items():
+                self.histograms[key].merge(histogram)
+
+    def write_json(self, filename):
+        with open(filename, 'w') as fp:
+            json.dump(self.snapshot(), fp, indent=2, sort_keys=True)
+
+    def summary(self):
+        snapshot = self.snapshot()
+        report_data = "Throughput over %.1f seconds:\n" % snapshot['elapsed_seconds']
+        for key in sorted(snapshot['documents']):
+            stats = snapshot['documents'][key]
+            report_data += " %13s: %8.1f docs/sec %10.1f KB/sec\n" % (key, stats['docs_per_sec'],
+                                                                     stats['bytes_per_sec'] / 1024.0)
+        if snapshot['latency']:
+            report_data += "Latency (ms):\n"
+            for key in sorted(snapshot['latency']):
+                stats = snapshot['latency'][key]
+                report_data += " %13s: n=%-7d mean=%-8.1f p90=%-8.1f max=%.1f\n" % (key, stats['count'],
+                                                                                     stats['mean_ms'],
+                                                                                     stats['p90_ms'],
+                                                                                     stats['max_ms'])
+        tunnels = sorted(set(key.rsplit(':', 1)[0] for key in snapshot['counters'] if key.startswith('ssh:')))
+        if tunnels:
+            report_data += "SSH tunnels (KB sent / received):\n"
+            for tunnel in tunnels:
+                report_data += " %s: %.1f / %.1f\n" % (tunnel[len('ssh:'):],
+                                                       snapshot['counters'].get(tunnel + ':sent', 0) / 1024.0,
+                                                       snapshot['counters'].get(tunnel + ':received', 0) / 1024.0)
+        return report_data
+
+
+class ProgressLine(object):
+    """
+    A single status line that overwrites itself, rewritten at most once every `interval` seconds. Messages are cut to
+    `width` characters, so that the line never wraps on an 80 column terminal.
+    """
+    width = 79
+
+    def __init__(self, stream=None, interval=0.5):
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.last_update = 0
+        self.enabled = True
+
+    def update(self, message, force=False):
+        if not self.enabled:
+            return
+
+        now = time.time()
+        if not force and now - self.last_update < self.interval:
+            return
+
+        self.last_update = now
+        self.stream.write('%-*s\r' % (self.width, message[:self.width]))
+        self.stream.flush()
+
+    def clear(self):
+        if not self.enabled:
+            return
+
+        self.stream.write('%-*s\r' % (self.width, ""))
+        self.stream.flush()
+
+
+registry = Metrics()
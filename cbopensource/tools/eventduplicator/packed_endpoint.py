@@ -0,0 +1,240 @@
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import mmap
+import struct
+import hashlib
+import logging
+from array import array
+from collections import defaultdict
+from cbopensource.tools.eventduplicator.file_endpoint import FileOutputSink
+from cbopensource.tools.eventduplicator.utils import get_process_id
+from cbopensource.tools.eventduplicator import serializer
+from cbopensource.tools.eventduplicator.metrics import registry
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+# index records: md5 digest of the document key, shard number, offset and length of the document in the shard
+INDEX_RECORD = struct.Struct('<16sHQI')
+DIRECTORIES = ['procs', 'binaries', 'sensors', 'feeds']
+
+
+def is_packed_package(pathname):
+    return os.path.exists(os.path.join(pathname, 'procs.index'))
+
+
+def shard_path(pathname, directory, shard):
+    return os.path.join(pathname, '%s-%04d.jsonl' % (directory, shard))
+
+
+def key_digest(key):
+    return hashlib.md5(str(key).encode('utf8')).digest()
+
+
+class PackedOutputSink(FileOutputSink):
+    """
+    Writes a package as a few large files rather than one file per document. The documents that FileOutputSink
+    would write under each of procs/, binaries/, sensors/ and feeds/ are appended, one JSON document per line, to
+    <directory>-NNNN.jsonl shards of up to max_shard_bytes each. <directory>.index maps the file name each document
+    would have had (without .json) to its shard, offset and length; it is sorted so that PackedInputSource can
+    binary search it in place.
+    """
+    def __init__(self, pathname, max_shard_bytes=1024 * 1024 * 1024):
+        self.max_shard_bytes = max_shard_bytes
+        self.shards = {}
+        self.index_entries = dict((directory, []) for directory in DIRECTORIES)
+        self.proc_keys = set()
+        super(PackedOutputSink, self).__init__(pathname)
+
+    def create_directories(self):
+        os.makedirs(self.pathname, 0o755)
+
+    def split_path(self, relative_path):
+        directory, filename = relative_path.split(os.sep)[0], os.path.basename(relative_path)
+        return directory, filename[:-len('.json')]
+
+    def has_doc(self, relative_path):
+        return self.split_path(relative_path)[1] in self.proc_keys
+
+    def shard(self, directory, size):
+        shard, fp = self.shards.get(directory, (-1, None))
+        if fp and fp.tell() + size > self.max_shard_bytes and fp.tell() > 0:
+            fp.close()
+            fp = None
+        if not fp:
+            shard += 1
+            fp = open(shard_path(self.pathname, directory, shard), 'wb')
+            self.shards[directory] = (shard, fp)
+        return shard, fp
+
+    def write_doc(self, doc_type, relative_path, doc_content):
+        directory, key = self.split_path(relative_path)
+        with registry.span('json_encode'):
+            data = serializer.dumps(doc_content)
+
+        shard, fp = self.shard(directory, len(data) + 1)
+        self.index_entries[directory].append((key_digest(key), shard, fp.tell(), len(data)))
+        fp.write(data)
+        fp.write(b'\n')
+        if directory == 'procs':
+            self.proc_keys.add(key)
+
+        registry.record_doc(doc_type, len(data))
+
+    def cleanup(self):
+        for shard, fp in self.shards.values():
+            fp.close()
+
+        for directory in DIRECTORIES:
+            # as in a package directory, a document written twice keeps its last copy: the index only points at
+            # that one, and PackedInputSource skips the lines it does not point at
+            last_entries = dict((entry[0], entry) for entry in self.index_entries[directory])
+            entries = sorted(last_entries.values(), key=lambda entry: entry[0])
+            with open(os.path.join(self.pathname, '%s.index' % directory), 'wb') as fp:
+                for entry in entries:
+                    fp.write(INDEX_RECORD.pack(*entry))
+
+
+class PackedInputSource(object):
+    """
+    Reads a package written by PackedOutputSink. Process documents are read by streaming the shards; binary, sensor
+    and feed lookups binary search the memory-mapped index and decode just that document's bytes from a memory map
+    of its shard.
+    """
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.indexes = {}
+        self.maps = {}
+        self.files = []
+        self.sampler = None
+
+    def get_version(self):
+        return open(os.path.join(self.pathname, 'VERSION'), 'r').read()
+
+    def set_sample(self, sampler):
+        self.sampler = sampler
+
+    def map_file(self, pathname):
+        fp = open(pathname, 'rb')
+        self.files.append(fp)
+        if not os.fstat(fp.fileno()).st_size:
+            # empty files cannot be mapped
+            return b''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def index(self, directory):
+        if directory not in self.indexes:
+            self.indexes[directory] = self.map_file(os.path.join(self.pathname, '%s.index' % directory))
+        return self.indexes[directory]
+
+    def shard(self, directory, shard):
+        if (directory, shard) not in self.maps:
+            self.maps[(directory, shard)] = self.map_file(shard_path(self.pathname, directory, shard))
+        return self.maps[(directory, shard)]
+
+    def lookup(self, directory, key):
+        index = self.index(directory)
+        digest = key_digest(key)
+        size = INDEX_RECORD.size
+
+        lo, hi = 0, len(index) // size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if index[mid * size:mid * size + 16] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo * size >= len(index) or index[lo * size:lo * size + 16] != digest:
+            log.warning("Could not find %s in %s/%s.index" % (key, self.pathname, directory))
+            return None
+
+        _, shard, offset, length = INDEX_RECORD.unpack_from(index, lo * size)
+        with registry.span('json_decode'):
+            return json.loads(self.shard(directory, shard)[offset:offset + length].decode('utf8'))
+
+    def indexed_offsets(self, directory):
+        """
+        :return: dict of shard number to the sorted offsets of the documents the index points at
+        """
+        index = self.index(directory)
+        offsets = defaultdict(lambda: array('Q'))
+        for i in range(0, len(index), INDEX_RECORD.size):
+            _, shard, offset, length = INDEX_RECORD.unpack_from(index, i)
+            offsets[shard].append(offset)
+        return dict((shard, array('Q', sorted(shard_offsets))) for shard, shard_offsets in offsets.items())
+
+    def get_process_docs(self, query_filter=None):
+        if query_filter:
+            return
+
+        # lines that are not indexed are earlier copies of processes written again
+        indexed_offsets = self.indexed_offsets('procs')
+        shard = 0
+        while os.path.exists(shard_path(self.pathname, 'procs', shard)):
+            offsets = iter(indexed_offsets.get(shard, []))
+            next_offset = next(offsets, None)
+            offset = 0
+            with open(shard_path(self.pathname, 'procs', shard), 'rb') as fp:
+                for line in fp:
+                    line_offset, offset = offset, offset + len(line)
+                    if line_offset != next_offset:
+                        continue
+                    next_offset = next(offsets, None)
+                    with registry.span('json_decode'):
+                        doc = json.loads(line.decode('utf8'))
+                    if not self.sampler or self.sampler.keep(get_process_id(doc)):
+                        yield doc
+            shard += 1
+
+    def get_feed_doc(self, feed_key):
+        return self.lookup('feeds', feed_key)
+
+    def get_feed_metadata(self, feed_id):
+        return self.lookup('feeds', feed_id)
+
+    def get_feed_docs(self, feed_keys):
+        for feed_key in feed_keys:
+            yield feed_key, self.get_feed_doc(feed_key)
+
+    def get_feeds_metadata(self, feed_ids):
+        feed_info = {}
+        for feed_id in feed_ids:
+            feed_metadata = self.get_feed_metadata(feed_id)
+            if feed_metadata:
+                feed_info[feed_id] = feed_metadata
+        return feed_info
+
+    def get_binary_doc(self, md5sum):
+        return self.lookup('binaries', md5sum.lower())
+
+    def get_dependencies(self):
+        # as with directory packages, dependencies are found as each process document is read
+        return None
+
+    def get_sensor_doc(self, sensor_id):
+        return self.lookup('sensors', sensor_id)
+
+    def get_package_statistics(self):
+        """
+        :return: (documents, bytes) for each of the package's directories, from the indexes
+        """
+        statistics = {}
+        for directory in DIRECTORIES:
+            index = self.index(directory)
+            lengths = [INDEX_RECORD.unpack_from(index, i)[3] for i in range(0, len(index), INDEX_RECORD.size)]
+            statistics[directory] = (len(lengths), sum(lengths))
+        return statistics
+
+    def connection_name(self):
+        return self.pathname
+
+    def cleanup(self):
+        for mapped in list(self.indexes.values()) + list(self.maps.values()):
+            if mapped:
+                mapped.close()
+        for fp in self.files:
+            fp.close()
+        self.indexes, self.maps, self.files = {}, {}, []
@@ -0,0 +1,242 @@
+from __future__ import absolute_import, division, print_function
+import logging
+import zlib
+import multiprocessing
+from multiprocessing.managers import BaseManager
+from cbopensource.tools.eventduplicator.transporter import Transporter
+from cbopensource.tools.eventduplicator.utils import get_process_id
+from cbopensource.tools.eventduplicator.metrics import registry
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+
+class SharedSet(object):
+    """
+    A set that lives in the manager process, so that all workers see the same contents.
+    """
+    def __init__(self, items=None):
+        self.items = set(items or [])
+
+    def claim(self, items):
+        """
+        Atomically add items to the set.
+        :return: the items that were not in the set before, i.e. those the caller is now responsible for
+        """
+        new_items = [item for item in items if item not in self.items]
+        self.items.update(new_items)
+        return new_items
+
+
+class SharedStateManager(BaseManager):
+    pass
+
+SharedStateManager.register('SharedSet', SharedSet)
+
+
+def get_context():
+    # spawn rather than fork: the coordinator holds live SSH transports and tunnel threads which must not be
+    # duplicated into the workers
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('spawn')
+    return multiprocessing
+
+
+def get_shard(proc, processes):
+    # crc32 rather than hash(), which is randomized per process on Python 3
+    return (zlib.crc32(str(get_process_id(proc)).encode('utf8')) & 0xffffffff) % processes
+
+
+def run_worker(index, input_factory, output_factory, mungers, work_queue, feedback_queue, md5_registry, verbose,
+               amplifier=None, target_rate=None, tracing=False):
+    """
+    Worker process body: receives process documents for one shard, transfers the binaries they reference that no
+    other worker has claimed, and writes the process documents. Feed hits are sent back to the coordinator.
+    """
+    from cbopensource.tools.eventduplicator.data_migration import initialize_logger
+    initialize_logger(verbose)
+    registry.reset()
+    registry.tracing = tracing
+
+    try:
+        input_source = input_factory()
+        output_sink = output_factory()
+        t = Transporter(input_source, output_sink, amplifier=amplifier, target_rate=target_rate)
+        t.mungers = mungers
+        t.progress.enabled = False
+
+        while True:
+            kind, payload = work_queue.get()
+            if kind == 'stop':
+                break
+            elif kind == 'sensor_id_map':
+                output_sink.sensor_id_map.update(payload)
+                continue
+
+            proc = payload
+            referrer = "the process with ID: %s" % proc['unique_id']
+            new_md5sums = t.update_md5sums(proc)
+            if new_md5sums:
+                new_md5sums = md5_registry.claim(list(new_md5sums))
+
+            new_feed_ids = t.update_feeds(proc)
+            new_feed_ids |= t.output_binaries(((md5sum, input_source.get_binary_doc(md5sum))
+                                               for md5sum in new_md5sums), referrer)
+            if new_feed_ids:
+                feedback_queue.put(('feeds', index, list(new_feed_ids), None))
+
+            t.output_process_doc(proc)
+
+        output_sink.cleanup()
+        feedback_queue.put(('done', index, (dict(output_sink.written_docs),
+                                            dict(getattr(output_sink, 'skipped_docs', {})),
+                                            dict(getattr(output_sink, 'failed_docs', {}))), registry.snapshot()))
+    except Exception as e:
+        log.exception("Worker %d failed" % index)
+        feedback_queue.put(('error', index, repr(e), None))
+
+
+class ShardedTransporter(Transporter):
+    """
+    Transporter that shards process documents by a hash of their unique_id across worker processes, each with its
+    own input and output connections.
+
+    The coordinator (this object) reads and deduplicates the process stream, and creates sensors, feed metadata and
+    feed documents exactly once. New entries in the output's sensor_id_map are handed to the workers ahead of the
+    process documents that need them. Binary dedup is shared between workers through a manager process.
+    """
+    def __init__(self, input_source, output_sink, input_factory, output_factory, processes, tree=False,
+                 prefetch=False, verbose=False, amplifier=None, target_rate=None):
+        super(ShardedTransporter, self).__init__(input_source, output_sink, tree=tree, prefetch=prefetch,
+                                                 amplifier=amplifier)
+        # each worker paces its own share of the process documents
+        self.worker_rate = target_rate / processes if target_rate else None
+        self.input_factory = input_factory
+        self.output_factory = output_factory
+        self.processes = processes
+        self.verbose = verbose
+        self.queue_length = 100
+
+        self.workers = []
+        self.work_queues = []
+        self.dispatched = 0
+
+    def dispatch(self, work_queue, item):
+        while True:
+            try:
+                work_queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise Exception("A worker process exited unexpectedly")
+
+    def broadcast_sensor_id_map(self, sensor_ids):
+        sensor_id_map = getattr(self.output, 'sensor_id_map', None)
+        if sensor_id_map is None:
+            return
+
+        update = dict((k, sensor_id_map[k]) for k in sensor_ids if k in sensor_id_map)
+        for work_queue in self.work_queues:
+            self.dispatch(work_queue, ('sensor_id_map', update))
+
+    def handle_feedback(self, message):
+        kind, index, payload, snapshot = message
+        if kind == 'feeds':
+            new_feed_ids = set(payload) - self.seen_feeds
+            self.seen_feeds |= new_feed_ids
+            self.output_feeds(new_feed_ids, "the documents handled by worker %d" % index)
+            return False
+        elif kind == 'done':
+            written_docs, skipped_docs, failed_docs = payload
+            for doc_type, count in written_docs.items():
+                self.output.written_docs[doc_type] += count
+            for doc_type, count in skipped_docs.items():
+                self.output.skipped_docs[doc_type] += count
+            for doc_type, count in failed_docs.items():
+                self.output.failed_docs[doc_type] += count
+            registry.merge(snapshot)
+            return True
+        else:
+            raise Exception("Worker %d failed: %s" % (index, payload))
+
+    def drain_feedback(self, feedback_queue):
+        while True:
+            try:
+                self.handle_feedback(feedback_queue.get_nowait())
+            except Queue.Empty:
+                return
+
+    def transport(self, debug=False):
+        log.info("Starting transport from %s to %s using %d worker processes" % (self.input.connection_name(),
+                                                                               self.output.connection_name(),
+                                                                               self.processes))
+
+        input_version = self.input.get_version()
+        if not self.output.set_data_version(input_version):
+            raise Exception("Input and Output versions are incompatible")
+
+        if self.prefetch:
+            self.prefetch_dependencies()
+
+        ctx = get_context()
+        manager = SharedStateManager(ctx=ctx) if hasattr(multiprocessing, 'get_context') else SharedStateManager()
+        manager.start()
+        md5_registry = manager.SharedSet(list(self.input_md5set))
+        feedback_queue = ctx.Queue()
+        self.work_queues = [ctx.Queue(maxsize=self.queue_length) for _ in range(self.processes)]
+        self.workers = [ctx.Process(target=run_worker, args=(i, self.input_factory, self.output_factory, self.mungers,
+                                                             self.work_queues[i], feedback_queue, md5_registry,
+                                                             self.verbose, self.amplifier, self.worker_rate,
+                                                             registry.tracing))
+                        for i in range(self.processes)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            for proc in self.get_process_docs():
+                new_sensor_ids = self.update_sensors(proc)
+                if new_sensor_ids:
+                    self.output_sensors(new_sensor_ids, "the process with ID: %s" % proc['unique_id'])
+                    if self.amplifier:
+                        new_sensor_ids = [sensor_id for original_id in new_sensor_ids
+                                          for sensor_id in self.amplifier.sensor_ids(original_id)]
+                    self.broadcast_sensor_id_map(new_sensor_ids)
+
+                self.dispatch(self.work_queues[get_shard(proc, self.processes)], ('proc', proc))
+                self.dispatched += 1
+                self.progress.update("Dispatched %d processes to %d workers..." % (self.dispatched, self.processes))
+
+                self.drain_feedback(feedback_queue)
+
+            for work_queue in self.work_queues:
+                self.dispatch(work_queue, ('stop', None))
+
+            remaining = self.processes
+            while remaining:
+                if self.handle_feedback(feedback_queue.get()):
+                    remaining -= 1
+
+            for worker in self.workers:
+                worker.join()
+        finally:
+            for worker in self.workers:
+                if worker.is_alive():
+                    worker.terminate()
+            for work_queue in self.work_queues:
+                # don't block on exit flushing documents to workers that are gone
+                work_queue.cancel_join_thread()
+            manager.shutdown()
+
+        # clean up
+        self.input.cleanup()
+        self.output.cleanup()
+
+        self.progress.clear()
+
+        log.info("Transport complete from %s to %s" % (self.input.connection_name(), self.output.connection_name()))
@@ -0,0 +1,372 @@
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import logging
+from collections import defaultdict
+from cbopensource.tools.eventduplicator.utils import get_process_id, get_parent_process_id
+from cbopensource.tools.eventduplicator.metrics import clock
+from cbopensource.tools.eventduplicator import serializer
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+# per-process event counts in a Cb process document; the size of a document grows with the number of events in it
+EVENT_COUNT_FIELDS = ['modload_count', 'filemod_count', 'regmod_count', 'netconn_count', 'crossproc_count',
+                      'childproc_count']
+
+# database round trips made for each sensor and feed, by the input source and by a Cb server destination
+SENSOR_READ_QUERIES = 3
+SENSOR_WRITE_QUERIES = 6
+FEED_METADATA_READ_QUERIES = 1
+FEED_METADATA_WRITE_QUERIES = 2
+
+DOC_TYPES = ['proc', 'binary', 'sensor', 'feed']
+PACKAGE_DIRECTORIES = [('procs', 'proc'), ('binaries', 'binary'), ('sensors', 'sensor'), ('feeds', 'feed')]
+
+
+def format_bytes(n):
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if n < 1024 or unit == 'GB':
+            return ("%d %s" if unit == 'bytes' else "%.1f %s") % (n, unit)
+        n /= 1024.0
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return "%.1fs" % seconds
+    seconds = int(round(seconds))
+    if seconds < 3600:
+        return "%dm %02ds" % (seconds // 60, seconds % 60)
+    return "%dh %02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+
+def free_space(pathname):
+    # the destination directory does not exist yet; look at the filesystem it would be created on
+    pathname = os.path.abspath(pathname)
+    while not os.path.exists(pathname):
+        pathname = os.path.dirname(pathname)
+    if not hasattr(os, 'statvfs'):
+        return None
+    stat = os.statvfs(pathname)
+    return stat.f_bavail * stat.f_frsize
+
+
+class TransferPlanner(object):
+    """
+    Estimates what a transfer would read and write without transferring any documents: process, binary, sensor and
+    feed document counts and sizes, the extra processes --tree would pull in, and how long the whole transfer should
+    take given the measured round trip time to the source and each destination.
+
+    Counts come from count, facet and stats queries. Sizes and tree fan-out are measured on a sample of the process
+    documents spread over the query results, so they are estimates; dependencies of the processes found through
+    --tree are not counted.
+    """
+    def __init__(self, input_source, destinations, tree=False, prefetch=False, parallelism=1, existing='overwrite',
+                 max_rate=None, max_concurrency=1, sample_size=10, max_tree_nodes=1000, amplify=1, target_rate=None,
+                 sample_rate=None):
+        self.input = input_source
+        # list of (destination, output sink) pairs; the sink is None for package directories
+        self.destinations = destinations
+        self.tree = tree
+        self.prefetch = prefetch
+        self.parallelism = max(parallelism, 1)
+        self.existing = existing
+        self.max_rate = max_rate
+        self.max_concurrency = max(max_concurrency, 1)
+        self.sample_size = sample_size
+        self.max_tree_nodes = max_tree_nodes
+        self.amplify = max(amplify, 1)
+        self.target_rate = target_rate
+        self.sample_rate = sample_rate
+
+    def plan(self):
+        if hasattr(self.input, 'doc_count_hint'):
+            plan = self.plan_solr()
+        else:
+            plan = self.plan_package()
+
+        if self.sample_rate:
+            # --sample keeps that share of the processes; binaries, sensors and feeds shared between the processes
+            # that are kept and those that are not are still counted in full
+            plan['counts']['proc'] = int(plan['counts']['proc'] * self.sample_rate)
+            plan['bytes']['proc'] = int(plan['bytes']['proc'] * self.sample_rate)
+            plan['tree_procs'] = int(plan['tree_procs'] * self.sample_rate)
+
+        # --amplify writes every process and sensor that many times, from the same read
+        for doc_type in ['proc', 'sensor']:
+            plan['counts'][doc_type] *= self.amplify
+            plan['bytes'][doc_type] *= self.amplify
+        plan['tree_procs'] *= self.amplify
+
+        plan['destinations'] = [self.plan_destination(destination, sink, plan)
+                                for destination, sink in self.destinations]
+        plan['duration'] = self.estimate_duration(plan)
+        return plan
+
+    def plan_package(self):
+        """
+        A package on disk holds exactly the documents that would be copied, so simply count them.
+        """
+        counts = dict((doc_type, 0) for doc_type in DOC_TYPES)
+        sizes = dict((doc_type, 0) for doc_type in DOC_TYPES)
+        feed_metadata = 0
+
+        if hasattr(self.input, 'get_package_statistics'):
+            # packed packages keep feed documents and feed metadata in one index, so they are counted together
+            statistics = self.input.get_package_statistics()
+            for directory, doc_type in PACKAGE_DIRECTORIES:
+                counts[doc_type], sizes[doc_type] = statistics[directory]
+            return {
+                'source': self.input.connection_name(),
+                'counts': counts,
+                'bytes': sizes,
+                'feed_metadata': feed_metadata,
+                'tree_procs': 0,
+                'source_requests': 0,
+                'source_rtt': 0.0,
+                'source_bandwidth': None
+            }
+
+        sample = []
+        for dirname, doc_type in PACKAGE_DIRECTORIES:
+            for root, dirs, files in os.walk(os.path.join(self.input.pathname, dirname)):
+                for fn in files:
+                    if doc_type == 'feed' and ':' not in fn:
+                        # feed metadata is stored next to the feed documents as <feed id>.json
+                        feed_metadata += 1
+                    else:
+                        counts[doc_type] += 1
+                    sizes[doc_type] += os.path.getsize(os.path.join(root, fn))
+                    if doc_type == 'proc' and len(sample) < self.sample_size:
+                        sample.append(os.path.join(root, fn))
+
+        # time parsing a few process documents to estimate how fast the package can be read
+        start = clock()
+        sample_bytes = 0
+        for pathname in sample:
+            with open(pathname, 'rb') as fp:
+                data = fp.read()
+            json.loads(data.decode('utf8'))
+            sample_bytes += len(data)
+        elapsed = clock() - start
+
+        return {
+            'source': self.input.connection_name(),
+            'counts': counts,
+            'bytes': sizes,
+            'feed_metadata': feed_metadata,
+            'tree_procs': 0,
+            'source_requests': 0,
+            'source_rtt': 0.0,
+            'source_bandwidth': sample_bytes / max(elapsed, 0.000001) if sample else None
+        }
+
+    def plan_solr(self):
+        num_found = self.input.doc_count_hint()
+        log.info("Sampling %d of the %d process documents matching %s" % (min(num_found, self.sample_size),
+                                                                         num_found, self.input.query))
+        rtt = self.input.round_trip_time()
+        sample = self.input.get_sample_process_docs(num_found, self.sample_size)
+        sample_sizes = [len(serializer.dumps(doc)) for doc, elapsed in sample]
+
+        # time spent receiving the sample, beyond the round trip itself, gives the bandwidth from the source
+        transfer_time = sum(max(elapsed - rtt, 0.001) for doc, elapsed in sample)
+        bandwidth = sum(sample_sizes) / transfer_time if sample else None
+
+        counts = dict((doc_type, 0) for doc_type in DOC_TYPES)
+        sizes = dict((doc_type, 0) for doc_type in DOC_TYPES)
+        counts['proc'] = num_found
+        sizes['proc'] = self.estimate_process_bytes(num_found, sample, sample_sizes)
+
+        source_requests = num_found // self.input.pagination_length + 1
+
+        tree_procs = 0
+        if self.tree and sample:
+            nodes, requests = zip(*[self.measure_tree(doc) for doc, elapsed in sample])
+            # trees of processes matching the query overlap, so this is an upper bound...
+            tree_procs = int(num_found * sum(nodes) / len(sample))
+            # ... and no more processes can be found than there are in the index
+            tree_procs = min(tree_procs, max(self.input.doc_count_hint('*:*') - num_found, 0))
+            source_requests += int(num_found * sum(requests) / len(sample))
+            if sample_sizes:
+                sizes['proc'] += tree_procs * sum(sample_sizes) // len(sample_sizes)
+
+        dependencies = self.input.get_dependencies()
+        # the md5 field also holds child process and written file MD5s, so this is an upper bound
+        counts['binary'] = len(dependencies['md5s']) + len(dependencies['module_md5s'])
+        counts['sensor'] = len(dependencies['sensor_ids'])
+        counts['feed'] = len(dependencies['feed_keys'])
+        feed_metadata = len(set(feed_key.split(':')[0] for feed_key in dependencies['feed_keys']))
+
+        sizes['binary'] = self.estimate_bytes(counts['binary'],
+                                              [doc for md5sum, doc in self.input.get_binary_docs(
+                                                  sorted(dependencies['md5s'] | dependencies['module_md5s'])
+                                                  [:self.sample_size]) if doc])
+        sizes['sensor'] = self.estimate_bytes(counts['sensor'],
+                                              [self.input.get_sensor_doc(sensor_id) for sensor_id in
+                                               sorted(dependencies['sensor_ids'])[:3]])
+        sizes['feed'] = self.estimate_bytes(counts['feed'],
+                                            [self.input.get_feed_doc(feed_key) for feed_key in
+                                             sorted(dependencies['feed_keys'])[:self.sample_size]])
+
+        if self.prefetch:
+            # two facet queries, then the process binaries and the feed documents of each feed in batches, and
+            # the metadata of all feeds at once; module binaries are still fetched one by one
+            feeds_per_name = defaultdict(int)
+            for feed_key in dependencies['feed_keys']:
+                feeds_per_name[feed_key.split(':')[0]] += 1
+            source_requests += 2 + -(-len(dependencies['md5s']) // self.input.batch_size) + \
+                len(dependencies['module_md5s']) + \
+                sum(-(-feeds // self.input.batch_size) for feeds in feeds_per_name.values()) + \
+                FEED_METADATA_READ_QUERIES
+        else:
+            source_requests += counts['binary'] + counts['feed'] + feed_metadata * FEED_METADATA_READ_QUERIES
+        source_requests += counts['sensor'] * SENSOR_READ_QUERIES
+
+        return {
+            'source': self.input.connection_name(),
+            'counts': counts,
+            'bytes': sizes,
+            'feed_metadata': feed_metadata,
+            'tree_procs': tree_procs,
+            'source_requests': source_requests,
+            'source_rtt': rtt,
+            'source_bandwidth': bandwidth
+        }
+
+    def estimate_process_bytes(self, num_found, sample, sample_sizes):
+        if not sample:
+            return 0
+
+        # scale the sample by the number of events in all of the matching documents, from the stats component
+        stats = self.input.get_field_stats("/solr/0/select", self.input.query, EVENT_COUNT_FIELDS)
+        if not stats:
+            return num_found * sum(sample_sizes) // len(sample_sizes)
+
+        total_events = sum(stats[field].get('sum') or 0 for field in stats)
+        sample_events = sum(doc.get(field) or 0 for doc, elapsed in sample for field in stats)
+        return int(sum(sample_sizes) * (num_found + total_events) / (len(sample) + sample_events))
+
+    @staticmethod
+    def estimate_bytes(count, sample_docs):
+        sample_sizes = [len(serializer.dumps(doc)) for doc in sample_docs if doc]
+        if not sample_sizes:
+            return 0
+        return count * sum(sample_sizes) // len(sample_sizes)
+
+    def measure_tree(self, proc):
+        """
+        Walk the process tree around proc the way Transporter does with --tree, reading only process ids.
+        :return: (number of other processes in the tree, number of requests made), stopping at max_tree_nodes
+        """
+        seen = set([get_process_id(proc)])
+        requests = 0
+
+        parent_id = get_parent_process_id(proc)
+        while parent_id and parent_id not in seen and len(seen) < self.max_tree_nodes:
+            parents = list(self.input.get_process_ids('unique_id:%s' % parent_id))
+            requests += len(parents) // self.input.pagination_length + 1
+            if not parents:
+                break
+            seen.add(parent_id)
+            parent_id = get_parent_process_id(parents[0])
+
+        pending = [get_process_id(proc)]
+        while pending and len(seen) < self.max_tree_nodes:
+            children = list(self.input.get_process_ids('parent_unique_id:%s' % pending.pop()))
+            requests += len(children) // self.input.pagination_length + 1
+            for child in children:
+                child_id = get_process_id(child)
+                if child_id not in seen:
+                    seen.add(child_id)
+                    pending.append(child_id)
+
+        if len(seen) >= self.max_tree_nodes:
+            log.info("Stopped measuring the process tree of %s after %d processes" % (get_process_id(proc),
+                                                                                      self.max_tree_nodes))
+        return len(seen) - 1, requests
+
+    def plan_destination(self, destination, sink, plan):
+        counts = plan['counts']
+        procs = counts['proc'] + plan['tree_procs']
+        if sink is None:
+            return {
+                'destination': destination,
+                'rtt': 0.0,
+                'requests': 0,
+                'free_bytes': free_space(destination)
+            }
+
+        posts = procs + counts['binary'] + counts['feed']
+        queries = counts['sensor'] * SENSOR_WRITE_QUERIES + plan['feed_metadata'] * FEED_METADATA_WRITE_QUERIES
+        if self.existing != 'overwrite':
+            queries += -(-procs // sink.existence_batch_size)
+
+        return {
+            'destination': destination,
+            'rtt': sink.round_trip_time(),
+            'posts': posts,
+            'requests': posts + queries,
+            'free_bytes': None
+        }
+
+    def estimate_duration(self, plan):
+        total_bytes = sum(plan['bytes'].values())
+        read_time = plan['source_requests'] * plan['source_rtt']
+        if plan['source_bandwidth']:
+            read_time += total_bytes / plan['source_bandwidth']
+
+        # destinations are written concurrently, so the slowest one sets the pace
+        write_time = 0.0
+        for destination in plan['destinations']:
+            posts = destination.get('posts', 0)
+            seconds = (posts / self.max_concurrency + destination['requests'] - posts) * destination['rtt']
+            write_time = max(write_time, seconds)
+
+        duration = (read_time + write_time) / self.parallelism
+        for rate in [self.max_rate, self.target_rate]:
+            if rate:
+                duration = max(duration, (plan['counts']['proc'] + plan['tree_procs']) / rate)
+        return duration
+
+
+def format_plan(plan):
+    counts, sizes = plan['counts'], plan['bytes']
+    report_data = "Transfer plan for %s (nothing has been transferred):\n" % plan['source']
+    report_data += " %8s  %10s  %12s\n" % ('type', 'documents', 'size')
+    for doc_type in DOC_TYPES:
+        count = counts[doc_type]
+        if doc_type == 'proc' and plan['tree_procs']:
+            count += plan['tree_procs']
+        report_data += " %8s: %10d  %12s\n" % (doc_type, count, format_bytes(sizes[doc_type]))
+    report_data += " %8s: %10d  %12s\n" % ('total', sum(counts.values()) + plan['tree_procs'],
+                                            format_bytes(sum(sizes.values())))
+
+    if plan['tree_procs']:
+        report_data += ("--tree adds up to %d processes to the %d matching the query (%.1f per process);\n" +
+                        "their binaries, sensors and feed hits are not included above\n") % \
+                       (plan['tree_procs'], counts['proc'], plan['tree_procs'] / max(counts['proc'], 1))
+    if plan['feed_metadata']:
+        report_data += "Feed hits come from %d feeds\n" % plan['feed_metadata']
+
+    if plan['source_requests']:
+        report_data += "Source: about %d requests, %.1f ms round trip" % (plan['source_requests'],
+                                                                          plan['source_rtt'] * 1000.0)
+        if plan['source_bandwidth']:
+            report_data += ", %s/sec" % format_bytes(plan['source_bandwidth'])
+        report_data += "\n"
+
+    for destination in plan['destinations']:
+        if destination['requests']:
+            report_data += "Destination %s: about %d requests, %.1f ms round trip\n" % \
+                           (destination['destination'], destination['requests'], destination['rtt'] * 1000.0)
+        elif destination['free_bytes'] is not None:
+            report_data += "Destination %s: %s free" % (destination['destination'],
+                                                        format_bytes(destination['free_bytes']))
+            if destination['free_bytes'] < sum(sizes.values()):
+                report_data += " - NOT ENOUGH SPACE"
+            report_data += "\n"
+
+    report_data += "Projected duration: %s\n" % format_duration(plan['duration'])
+    return report_data
@@ -0,0 +1,126 @@
+from __future__ import absolute_import, division, print_function
+import os
+import sys
+import logging
+import threading
+from collections import defaultdict
+from cbopensource.tools.eventduplicator.metrics import registry, clock
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+# rows of the end-of-run breakdown, and the latency histograms (timers and spans) that make up each of them
+BREAKDOWN = [
+    ('Solr requests', ['solr_get', 'solr_post', 'span:solr_read']),
+    ('Postgres queries', ['db_query']),
+    ('SSH relay', ['span:ssh_relay']),
+    ('Munging', ['span:munge']),
+    ('JSON encoding', ['span:json_encode']),
+    ('JSON decoding', ['span:json_decode'])
+]
+
+
+class StackSampler(object):
+    """
+    Samples the stack of every other thread each `interval` seconds. A function's wall time is estimated as the
+    number of samples it was on a stack (inclusive) or at the top of one (self) times the interval.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.inclusive = defaultdict(int)
+        self.exclusive = defaultdict(int)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="stack-sampler")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_id = threading.current_thread().ident
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                seen = set()
+                key = None
+                while frame is not None:
+                    code = frame.f_code
+                    key = (code.co_filename, code.co_firstlineno, code.co_name)
+                    if not seen:
+                        self.exclusive[key] += 1
+                    if key not in seen:
+                        # count recursive functions once per sample
+                        seen.add(key)
+                        self.inclusive[key] += 1
+                    frame = frame.f_back
+
+    def report(self, limit=25):
+        report_data = "Wall time by function, sampled every %.0f ms across all threads:\n" % (self.interval * 1000.0)
+        report_data += " %10s %10s  %s\n" % ('total (s)', 'self (s)', 'function')
+        for key in sorted(self.inclusive, key=self.inclusive.get, reverse=True)[:limit]:
+            filename, lineno, name = key
+            report_data += " %10.2f %10.2f  %s (%s:%d)\n" % (self.inclusive[key] * self.interval,
+                                                           self.exclusive.get(key, 0) * self.interval,
+                                                           name, os.path.basename(filename), lineno)
+        return report_data
+
+
+class Profiler(object):
+    """
+    --profile support: times the Solr, Postgres, SSH relay, munging and JSON spans of the run, and optionally
+    writes a cProfile dump of the main thread and/or samples the stacks of all threads.
+    """
+    def __init__(self, filename=None, sample_interval=None):
+        self.filename = filename
+        self.profile = None
+        self.sampler = StackSampler(sample_interval) if sample_interval else None
+        self.started = None
+        self.elapsed = 0.0
+
+    def start(self):
+        registry.tracing = True
+        self.started = clock()
+        if self.filename:
+            # cProfile only sees the thread it is enabled in; the sampler covers the others
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        if self.sampler:
+            self.sampler.start()
+
+    def stop(self):
+        if self.profile:
+            self.profile.disable()
+            self.profile.dump_stats(self.filename)
+        if self.sampler:
+            self.sampler.stop()
+        self.elapsed = clock() - self.started
+        registry.tracing = False
+
+    def breakdown(self):
+        latency = registry.snapshot()['latency']
+        report_data = "Time by activity over %.1f seconds of wall time:\n" % self.elapsed
+        for label, names in BREAKDOWN:
+            seconds = sum(latency[name]['total_ms'] for name in names if name in latency) / 1000.0
+            calls = sum(latency[name]['count'] for name in names if name in latency)
+            report_data += " %17s: %8.2f s %6.1f%% %9d calls\n" % (label, seconds,
+                                                                   100.0 * seconds / max(self.elapsed, 1e-6), calls)
+        report_data += ("Activities in different threads or worker processes overlap, so the percentages can add up "
+                        "to more than 100%; SSH relay time is also part of the Solr and Postgres time it carries.\n")
+        return report_data
+
+    def report(self):
+        report_data = self.breakdown()
+        if self.sampler:
+            report_data += self.sampler.report()
+        if self.profile:
+            report_data += "cProfile data written to %s; view it with: python -m pstats %s\n" % (self.filename,
+                                                                                              self.filename)
+        return report_data
@@ -0,0 +1,76 @@
+from __future__ import absolute_import, division, print_function
+import datetime
+import json
+import logging
+from cbopensource.tools.eventduplicator.events import EventColumns
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f%z"
+
+
+def encode_default(o):
+    # anything else that the encoder does not understand is serialized as null
+    if type(o) is datetime.date or type(o) is datetime.datetime:
+        return o.strftime(DATE_FORMAT)
+    if type(o) is EventColumns:
+        # compacted *_complete fields go back to Solr's list of pipe-delimited strings only when written
+        return o.encode()
+
+
+class StdlibSerializer(object):
+    name = 'json'
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder(default=encode_default, separators=(',', ':'))
+
+    def dumps(self, obj):
+        """
+        :return: the UTF-8 encoded JSON representation of obj
+        :rtype: bytes
+        """
+        return self.encoder.encode(obj).encode('utf8')
+
+
+class OrjsonSerializer(StdlibSerializer):
+    name = 'orjson'
+
+    def __init__(self):
+        super(OrjsonSerializer, self).__init__()
+        # keep our own date format instead of orjson's RFC 3339 output, so packages look the same either way
+        self.options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj, default=encode_default, option=self.options)
+        except orjson.JSONEncodeError:
+            # e.g. integers wider than 64 bits; the stdlib encoder handles those
+            return super(OrjsonSerializer, self).dumps(obj)
+
+
+serializers = {
+    'json': StdlibSerializer
+}
+if orjson:
+    serializers['orjson'] = OrjsonSerializer
+
+
+def get_serializer(name=None):
+    """
+    Return a serializer by name, or the fastest one available if no name is given.
+    """
+    if not name:
+        name = 'orjson' if 'orjson' in serializers else 'json'
+    if name not in serializers:
+        raise Exception("JSON serializer %s is not available" % name)
+    return serializers[name]()
+
+
+serializer = get_serializer()
+dumps = serializer.dumps
@@ -1,20 +1,42 @@
 from __future__ import absolute_import, division, print_function
 import re
-import psycopg2
-import psycopg2.extras
-import requests
 import json
 from cbopensource.tools.eventduplicator.utils import get_process_id, update_sensor_id_refs, update_feed_id_refs
+from cbopensource.tools.eventduplicator.metrics import registry, clock
+from cbopensource.tools.eventduplicator.throttle import TokenBucket, AIMDController, backoff_delay
+from cbopensource.tools.eventduplicator.jsonstream import iter_solr_docs
+from cbopensource.tools.eventduplicator import serializer
 from copy import deepcopy
 from collections import defaultdict
 import logging
 import datetime
+import math
+import time
+import threading
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+# psycopg2 and requests are imported where they are first needed, so that runs which only read and write packages
+# on disk (and --help) do not pay for loading them
 
 __author__ = 'jgarman'
 log = logging.getLogger(__name__)
 
 
+def parse_solr_date(value):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Cannot parse Solr date %s" % value)
+
+
 class SolrBase(object):
+    stream_chunk_size = 64 * 1024
+
     def __init__(self, connection):
         self.connection = connection
         self.have_cb_conf = False
@@ -80,10 +102,38 @@ class SolrBase(object):
         return conn
 
     def solr_get(self, path, *args, **kwargs):
-        return self.connection.http_get(path, *args, **kwargs)
+        with registry.timer('solr_get'):
+            return self.connection.http_get(path, *args, **kwargs)
+
+    def solr_get_docs(self, path, params):
+        """
+        Query Solr and yield the documents in the response as they are parsed from the streamed body, rather than
+        reading and decoding the whole page first. Yields nothing if the query fails.
+        """
+        resp = self.solr_get(path, params=params, stream=True)
+        try:
+            if resp.status_code != 200:
+                log.warning("Error querying %s (HTTP %d)" % (path, resp.status_code))
+                return
+            for doc in iter_solr_docs(registry.span_iter('solr_read', resp.iter_content(self.stream_chunk_size))):
+                yield doc
+        finally:
+            resp.close()
 
     def solr_post(self, path, *args, **kwargs):
-        return self.connection.http_post(path, *args, **kwargs)
+        with registry.timer('solr_post'):
+            return self.connection.http_post(path, *args, **kwargs)
+
+    def round_trip_time(self, samples=3):
+        """
+        :return: median time in seconds of an empty query against the process core
+        """
+        timings = []
+        for i in range(samples):
+            start = clock()
+            self.solr_get("/solr/0/select", params={'q': '*:*', 'rows': 0, 'wt': 'json'})
+            timings.append(clock() - start)
+        return sorted(timings)[len(timings) // 2]
 
     def find_db_row_matching(self, table_name, obj):
         obj.pop('id', None)
@@ -93,7 +143,8 @@ class SolrBase(object):
 
         # FIXME: is there a better way to do this?
         query = 'SELECT id from %s WHERE %s' % (table_name, predicate)
-        cursor.execute(query, obj)
+        with registry.timer('db_query'):
+            cursor.execute(query, obj)
 
         row_id = cursor.fetchone()
         if row_id:
@@ -102,6 +153,7 @@ class SolrBase(object):
             return None
 
     def insert_db_row(self, table_name, obj):
+        import psycopg2
         obj.pop('id', None)
 
         cursor = self.dbconn().cursor()
@@ -109,12 +161,15 @@ class SolrBase(object):
         values = ', '.join(['%%(%s)s' % x for x in obj])
         query = 'INSERT INTO %s (%s) VALUES (%s) RETURNING id' % (table_name, fields, values)
         try:
-            cursor.execute(query, obj)
-            self.dbconn().commit()
+            with registry.timer('db_query'):
+                cursor.execute(query, obj)
+                self.dbconn().commit()
             row_id = cursor.fetchone()[0]
             return row_id
         except psycopg2.Error as e:
-            log.error("Error inserting row into table %s, id %s: %s" % (table_name, obj.get("id", None), e.message))
+            # the transaction is aborted; roll back so that later queries on this connection still work
+            self.dbconn().rollback()
+            log.error("Error inserting row into table %s: %s" % (table_name, str(e).strip()))
             return None
 
 
@@ -122,14 +177,20 @@ class LocalConnection(object):
     def __init__(self):
         # TODO: if for some reason someone has changed SolrPort on their cb server... this is incorrect
         self.solr_url_base = 'http://127.0.0.1:8080'
+        import requests
         self.session = requests.Session()
 
     @staticmethod
     def open_file(filename, mode='r'):
         return open(filename, mode)
 
+    @staticmethod
+    def db_endpoint(host, port):
+        return host, port
+
     @staticmethod
     def open_db(user, password, database, host, port):
+        import psycopg2
         return psycopg2.connect(user=user, password=password, database=database, host=host, port=port)
 
     def http_get(self, path, **kwargs):
@@ -147,14 +208,52 @@ class LocalConnection(object):
 
 class SolrInputSource(SolrBase):
     def __init__(self, connection, **kwargs):
-        self.query = kwargs.pop('query')
+        self.base_query = kwargs.pop('query')
+        self.query = self.base_query
+        self.since = None
+        self.sample_filter = None
+        self.partitions = kwargs.pop('partitions', 1)
+        # newest value of watermark_field among the process documents returned by the query so far
+        self.watermark_field = 'last_update'
+        self.watermark = None
         self.pagination_length = 20
+        self.buckets_per_partition = 10
+        self.batch_size = 100
         super(SolrInputSource, self).__init__(connection)
 
-    def doc_count_hint(self):
+    def set_since(self, since):
+        """
+        Restrict the query to process documents whose watermark_field is at or after `since` (a Solr date). The
+        bound is inclusive, so documents updated within the same millisecond as the last run are not lost; those
+        at the boundary are simply sent again.
+        """
+        self.since = since
+        self.build_query()
+
+    def set_sample(self, sampler):
+        """
+        Restrict the query to the process documents kept by `sampler`, a transporter.Sampler, so that Solr filters
+        them and the others are never downloaded, counted or faceted.
+        """
+        self.sample_filter = sampler.solr_filter()
+        self.build_query()
+
+    def build_query(self):
+        self.query = self.base_query
+        if self.since:
+            self.query = '(%s) AND %s:[%s TO *]' % (self.query, self.watermark_field, self.since)
+        if self.sample_filter:
+            self.query = '(%s) AND %s' % (self.query, self.sample_filter)
+
+    def update_watermark(self, doc):
+        value = doc.get(self.watermark_field)
+        if value and (not self.watermark or parse_solr_date(value) > parse_solr_date(self.watermark)):
+            self.watermark = value
+
+    def doc_count_hint(self, query_filter=None):
         query = "/solr/0/select"
         params = {
-            'q': self.query,
+            'q': query_filter or self.query,
             'sort': 'start asc',
             'wt': 'json',
             'rows': 0
@@ -163,25 +262,172 @@ class SolrInputSource(SolrBase):
         rj = resp.json()
         return rj.get('response', {}).get('numFound', 0)
 
+    def get_field_stats(self, path, query, fields):
+        """
+        Sum, mean, min and max of numeric fields over the documents matching a query, from the Solr stats component.
+        :return: dict of field name to stats dict; fields without any values are left out
+        """
+        params = {
+            'q': query,
+            'rows': 0,
+            'stats': 'true',
+            'stats.field': fields,
+            'wt': 'json'
+        }
+        resp = self.solr_get(path, params=params)
+        if not resp.ok:
+            raise Exception("Error computing statistics over %s: %s" % (path, resp.content))
+
+        stats_fields = resp.json().get('stats', {}).get('stats_fields', {})
+        return dict((field, stats) for field, stats in stats_fields.items() if stats)
+
+    def get_sample_process_docs(self, num_found, sample_size):
+        """
+        Read up to sample_size process documents spread evenly over the query results, one request each.
+        :return: list of (doc, seconds taken by the request) tuples
+        """
+        sample = []
+        for i in range(min(num_found, sample_size)):
+            params = {
+                'q': self.query,
+                'sort': 'start asc',
+                'start': num_found * i // min(num_found, sample_size),
+                'rows': 1,
+                'wt': 'json'
+            }
+            start = clock()
+            docs = self.solr_get("/solr/0/select", params=params).json().get('response', {}).get('docs', [])
+            elapsed = clock() - start
+            if docs:
+                sample.append((docs[0], elapsed))
+        return sample
+
+    def get_process_ids(self, query_filter):
+        """
+        Like get_process_docs(query_filter), but only the process and parent ids of each document are returned.
+        """
+        params = {
+            'q': query_filter,
+            'fl': 'id,unique_id,parent_id,parent_unique_id',
+            'sort': 'start asc',
+            'wt': 'json'
+        }
+        for doc in self.paginated_get("/solr/0/select", params):
+            yield doc
+
     def paginated_get(self, query, params, start=0):
         params['rows'] = self.pagination_length
         params['start'] = start
         while True:
-            resp = self.solr_get(query, params=params)
-            rj = resp.json()
-            docs = rj.get('response', {}).get('docs', [])
-            if not len(docs):
-                break
-            for doc in docs:
+            count = 0
+            for doc in self.solr_get_docs(query, params):
+                count += 1
                 yield doc
+            if not count:
+                break
 
-            params['start'] += len(docs)
+            params['start'] += count
             params['rows'] = self.pagination_length
 
+    def get_start_bound(self, direction):
+        params = {
+            'q': self.query,
+            'sort': 'start %s' % direction,
+            'fl': 'start',
+            'rows': 1,
+            'wt': 'json'
+        }
+        docs = self.solr_get("/solr/0/select", params=params).json().get('response', {}).get('docs', [])
+        if not docs or 'start' not in docs[0]:
+            return None
+        return docs[0]['start']
+
+    def get_time_windows(self, num_windows):
+        """
+        Split the query into at most num_windows ranges over the start field, each holding a similar number of
+        documents, using a range facet with num_windows * buckets_per_partition buckets.
+        :return: list of Solr range expressions, e.g. ['[* TO 2015-11-10T19:54:45Z}', '[2015-11-10T19:54:45Z TO *]']
+        """
+        first, last = self.get_start_bound('asc'), self.get_start_bound('desc')
+        if num_windows < 2 or not first or first == last:
+            return ['[* TO *]']
+
+        span = (parse_solr_date(last) - parse_solr_date(first)).total_seconds()
+        gap = max(int(math.ceil(span / (num_windows * self.buckets_per_partition))), 1)
+        params = {
+            'q': self.query,
+            'rows': 0,
+            'facet': 'true',
+            'facet.range': 'start',
+            'facet.range.start': first,
+            'facet.range.end': '%s+%dSECONDS' % (last, gap),
+            'facet.range.gap': '+%dSECONDS' % gap,
+            'wt': 'json'
+        }
+        resp = self.solr_get("/solr/0/select", params=params)
+        if not resp.ok:
+            raise Exception("Error computing time windows for query %s: %s" % (self.query, resp.content))
+        counts = resp.json().get('facet_counts', {}).get('facet_ranges', {}).get('start', {}).get('counts', [])
+
+        total = sum(counts[1::2])
+        boundaries = []
+        running = 0
+        for bucket_start, count in zip(counts[::2], counts[1::2]):
+            if running >= total * (len(boundaries) + 1) / num_windows and len(boundaries) < num_windows - 1:
+                boundaries.append(bucket_start)
+            running += count
+
+        edges = ['*'] + boundaries + ['*']
+        windows = ['[%s TO %s}' % (lo, hi) for lo, hi in zip(edges[:-1], edges[1:])]
+        windows[-1] = windows[-1][:-1] + ']'
+        return windows
+
+    def get_partitioned_process_docs(self):
+        """
+        Read the query as several start time windows concurrently, one thread per window. Documents are yielded as
+        they arrive, so they are no longer sorted by start time across windows.
+        """
+        windows = self.get_time_windows(self.partitions)
+        log.info("Reading %s in %d time windows" % (self.query, len(windows)))
+
+        results = Queue.Queue(maxsize=self.pagination_length * len(windows))
+
+        def read_window(window):
+            try:
+                for doc in self.get_process_docs('(%s) AND start:%s' % (self.query, window)):
+                    results.put(('doc', doc))
+            except Exception as e:
+                results.put(('error', e))
+            finally:
+                results.put(('done', window))
+
+        for window in windows:
+            reader = threading.Thread(target=read_window, args=(window,))
+            reader.daemon = True
+            reader.start()
+
+        remaining = len(windows)
+        while remaining:
+            kind, value = results.get()
+            registry.set_gauge('partition_queue', results.qsize())
+            if kind == 'doc':
+                yield value
+            elif kind == 'error':
+                raise value
+            else:
+                remaining -= 1
+
     def get_process_docs(self, query_filter=None):
         query = "/solr/0/select"
         if not query_filter:
-            query_filter = self.query
+            if self.partitions > 1:
+                docs = self.get_partitioned_process_docs()
+            else:
+                docs = self.get_process_docs(self.query)
+            for doc in docs:
+                self.update_watermark(doc)
+                yield doc
+            return
 
         params = {
             'q': query_filter,
@@ -199,22 +445,44 @@ class SolrInputSource(SolrBase):
             'q': 'id:"%s" AND feed_name:%s' % (feed_id, feed_name),
             'wt': 'json'
         }
-        result = self.solr_get(query, params=params)
-        if not result.ok:
-            return None
-        rj = result.json()
-        docs = rj.get('response', {}).get('docs', [{}])
-        if len(docs) == 0:
-            return None
+        for doc in self.solr_get_docs(query, params):
+            return doc
+        return None
 
-        return docs[0]
+    def get_feed_docs(self, feed_keys):
+        """
+        Fetch feed documents with one query per feed name for up to `batch_size` documents.
+        :return: generator of (feed_key, doc) tuples; doc is None if the feed document could not be found
+        """
+        query = "/solr/cbfeeds/select"
+        doc_ids_by_feed = defaultdict(list)
+        for feed_key in sorted(set(feed_keys)):
+            feed_name, doc_id = feed_key.split(':')
+            doc_ids_by_feed[feed_name].append(doc_id)
+
+        for feed_name, doc_ids in sorted(doc_ids_by_feed.items()):
+            for i in range(0, len(doc_ids), self.batch_size):
+                batch = doc_ids[i:i + self.batch_size]
+                params = {
+                    'q': 'id:(%s) AND feed_name:%s' % (' OR '.join('"%s"' % doc_id for doc_id in batch), feed_name),
+                    'rows': len(batch),
+                    'wt': 'json'
+                }
+                found = {}
+                for doc in self.solr_get_docs(query, params):
+                    found[doc.get('id')] = doc
+
+                for doc_id in batch:
+                    yield "%s:%s" % (feed_name, doc_id), found.get(doc_id)
 
     def get_feed_metadata(self, feed_id):
+        from psycopg2.extras import RealDictCursor
         try:
             conn = self.dbconn()
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute('SELECT id,name,display_name,feed_url,summary,icon,provider_url,tech_data,category,icon_small' +
-                        'FROM alliance_feeds WHERE id=%s', (feed_id,))
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            with registry.timer('db_query'):
+                cur.execute('SELECT id,name,display_name,feed_url,summary,icon,provider_url,tech_data,category,' +
+                            'icon_small FROM alliance_feeds WHERE id=%s', (feed_id,))
             feed_info = cur.fetchone()
             if not feed_info:
                 return None
@@ -226,34 +494,130 @@ class SolrInputSource(SolrBase):
 
         return feed_info
 
+    def get_feeds_metadata(self, feed_ids):
+        """
+        Fetch the alliance_feeds rows of several feeds with one query.
+        :return: dict of feed id to feed metadata, for the feeds that were found
+        """
+        from psycopg2.extras import RealDictCursor
+        feed_ids = sorted(set(feed_ids))
+        if not feed_ids:
+            return {}
+
+        try:
+            conn = self.dbconn()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            with registry.timer('db_query'):
+                cur.execute('SELECT id,name,display_name,feed_url,summary,icon,provider_url,tech_data,category,' +
+                            'icon_small FROM alliance_feeds WHERE id = ANY(%s)', (feed_ids,))
+            feed_info = dict((row['id'], row) for row in cur.fetchall())
+
+            conn.commit()
+        except Exception as e:
+            log.error("Error getting feed metadata for ids %s: %s" % (', '.join(str(i) for i in feed_ids), str(e)))
+            return {}
+
+        return feed_info
+
     def get_binary_doc(self, md5sum):
         query = "/solr/cbmodules/select"
         params = {
             'q': 'md5:%s' % md5sum.upper(),
             'wt': 'json'
         }
-        result = self.solr_get(query, params=params)
-        if result.status_code != 200:
-            return None
-        rj = result.json()
-        docs = rj.get('response', {}).get('docs', [{}])
-        if len(docs) == 0:
-            return None
-        return docs[0]
+        for doc in self.solr_get_docs(query, params):
+            return doc
+        return None
+
+    def get_binary_docs(self, md5sums):
+        """
+        Fetch binary documents in batches of `batch_size` MD5s per query.
+        :return: generator of (md5sum, doc) tuples; doc is None if the binary could not be found
+        """
+        query = "/solr/cbmodules/select"
+        md5sums = sorted(set(md5sum.upper() for md5sum in md5sums))
+        for i in range(0, len(md5sums), self.batch_size):
+            batch = md5sums[i:i + self.batch_size]
+            params = {
+                'q': 'md5:(%s)' % ' OR '.join(batch),
+                'rows': len(batch),
+                'wt': 'json'
+            }
+            found = {}
+            for doc in self.solr_get_docs(query, params):
+                found[doc.get('md5', '').upper()] = doc
+
+            for md5sum in batch:
+                yield md5sum, found.get(md5sum)
+
+    def get_facet_values(self, path, query, fields):
+        params = {
+            'q': query,
+            'rows': 0,
+            'facet': 'true',
+            'facet.field': fields,
+            'facet.limit': -1,
+            'facet.mincount': 1,
+            'wt': 'json'
+        }
+        resp = self.solr_get(path, params=params)
+        if not resp.ok:
+            raise Exception("Error computing facets over %s: %s" % (path, resp.content))
+
+        facet_fields = resp.json().get('facet_counts', {}).get('facet_fields', {})
+        # Solr returns each facet as a flat [value, count, value, count, ...] list
+        return dict((field, set(facet_fields.get(field, [])[::2])) for field in fields)
+
+    def get_dependencies(self):
+        """
+        Compute the binaries, sensors and feed hits referenced by every process matching the query, using facets
+        over the result set rather than reading the process documents.
+
+        Solr has no field of its own for the MD5s of loaded modules: they are indexed into md5 together with those
+        of child processes and written files, which Transporter.update_md5sums does not follow. So 'md5s' only
+        holds process binaries, and modules are still found as each process is read; 'module_md5s' is the rest of
+        the md5 field, an upper bound on the module binaries for estimates.
+        :return: dict with 'md5s', 'module_md5s', 'sensor_ids' and 'feed_keys' sets
+        """
+        feed_names = self.get_facet_values('/solr/cbfeeds/select', '*:*', ['feed_name'])['feed_name']
+        feed_fields = ['alliance_data_%s' % feed_name for feed_name in feed_names]
+
+        facets = self.get_facet_values('/solr/0/select', self.query,
+                                       ['process_md5', 'md5', 'sensor_id'] + feed_fields)
+
+        md5s = set(md5sum.upper() for md5sum in facets['process_md5'])
+        md5s.discard('0' * 32)
+        module_md5s = set(md5sum.upper() for md5sum in facets['md5']) - md5s
+        module_md5s.discard('0' * 32)
+
+        feed_keys = set()
+        for field in feed_fields:
+            feed_keys |= set('%s:%s' % (field[14:], doc_name) for doc_name in facets[field])
+
+        return {
+            'md5s': md5s,
+            'module_md5s': module_md5s,
+            'sensor_ids': set(int(sensor_id) for sensor_id in facets['sensor_id']),
+            'feed_keys': feed_keys
+        }
 
     def get_version(self):
         return self.connection.open_file('/usr/share/cb/VERSION').read()
 
     def get_sensor_doc(self, sensor_id):
+        from psycopg2.extras import RealDictCursor
         try:
             conn = self.dbconn()
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cur.execute('SELECT * FROM sensor_registrations WHERE id=%s',(sensor_id,))
-            sensor_info = cur.fetchone()
-            cur.execute('SELECT * FROM sensor_builds WHERE id=%s', (sensor_info['build_id'],))
-            build_info = cur.fetchone()
-            cur.execute('SELECT * FROM sensor_os_environments WHERE id=%s', (sensor_info['os_environment_id'],))
-            environment_info = cur.fetchone()
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            with registry.timer('db_query'):
+                cur.execute('SELECT * FROM sensor_registrations WHERE id=%s', (sensor_id,))
+                sensor_info = cur.fetchone()
+            with registry.timer('db_query'):
+                cur.execute('SELECT * FROM sensor_builds WHERE id=%s', (sensor_info['build_id'],))
+                build_info = cur.fetchone()
+            with registry.timer('db_query'):
+                cur.execute('SELECT * FROM sensor_os_environments WHERE id=%s', (sensor_info['os_environment_id'],))
+                environment_info = cur.fetchone()
             conn.commit()
         except Exception as e:
             log.error("Error getting sensor data for sensor id %s: %s" % (sensor_id, str(e)))
@@ -277,8 +641,13 @@ class SolrInputSource(SolrBase):
 
 
 class SolrOutputSink(SolrBase):
-    def __init__(self, connection):
+    existing_policies = ('overwrite', 'skip', 'newer')
+
+    def __init__(self, connection, existing='overwrite', max_rate=None, max_concurrency=1, spool=None,
+                 destination=None):
         super(SolrOutputSink, self).__init__(connection)
+        if existing not in self.existing_policies:
+            raise Exception("Unknown policy for existing documents: %s" % existing)
         self.feed_id_map = {}
         self.existing_md5s = set()
         self.sensor_id_map = {}
@@ -286,7 +655,33 @@ class SolrOutputSink(SolrBase):
         self.sensor_build_map = {}
 
         self.written_docs = defaultdict(int)
+        self.skipped_docs = defaultdict(int)
+        self.failed_docs = defaultdict(int)
+        self.failed_lock = threading.Lock()
         self.new_metadata = defaultdict(list)
+
+        # what to do with process documents that are already in the destination: 'overwrite' them, 'skip' them, or
+        # overwrite them only if the source document has a 'newer' last_update. Anything but 'overwrite' looks the
+        # documents up in batches of existence_batch_size.
+        self.existing_policy = existing
+        self.existence_batch_size = 100
+        self.pending_process_docs = []
+
+        # document updates are limited to max_rate per second, and with max_concurrency > 1 are posted from a pool
+        # of threads through an AIMD window that shrinks when the target slows down or answers 429/503. Those
+        # responses, and connection errors, are retried up to max_retries times with jittered backoff.
+        self.rate_limiter = TokenBucket(max_rate)
+        self.max_concurrency = max_concurrency
+        self.post_window = AIMDController(max_concurrency, target_latency=2.0)
+        self.max_retries = 5
+        self.retry_statuses = (429, 503)
+        self.post_queue = None
+        self.post_threads = []
+
+        # documents that still cannot be written are saved to the spool (a DeadLetterSpool), tagged with the
+        # destination they were meant for, so that they can be replayed later
+        self.spool = spool
+        self.destination = destination or str(connection)
         self.doc_endpoints = {
             'binary': '/solr/cbmodules/update/json',
             'proc': '/solr/0/update',
@@ -315,7 +710,13 @@ class SolrOutputSink(SolrBase):
             'q': 'md5:%s' % md5sum.upper(),
             'wt': 'json'
         }
-        result = self.solr_get(query, params=params)
+        import requests
+        try:
+            result = self.solr_get(query, params=params)
+        except requests.RequestException as e:
+            # treat the binary as missing; sending it again is harmless
+            log.error("Error looking up binary %s in destination Solr: %s" % (md5sum, e))
+            return None
         if result.status_code != 200:
             return None
         rj = result.json()
@@ -325,16 +726,96 @@ class SolrOutputSink(SolrBase):
         return docs[0]
 
     def output_doc(self, doc_type, doc_content):
-        args = {"add": {"commitWithin": 5000, "doc": doc_content}}
+        # equivalent to {"add": {"commitWithin": 5000, "doc": doc_content}}, without re-encoding the document
+        with registry.span('json_encode'):
+            body = b''.join((b'{"add":{"commitWithin":5000,"doc":', serializer.dumps(doc_content), b'}}'))
+        self.written_docs[doc_type] += 1
+
+        if self.max_concurrency > 1:
+            if not self.post_queue:
+                self.start_post_workers()
+            self.post_queue.put((doc_type, body))
+            registry.set_gauge('post_queue', self.post_queue.qsize())
+        else:
+            self.post_doc(doc_type, body)
+
+    def post_doc(self, doc_type, body):
+        import requests
         headers = {'content-type': 'application/json; charset=utf8'}
-        r = self.solr_post(self.doc_endpoints[doc_type],
-                           data=json.dumps(args), headers=headers, timeout=60)
+        r, error = None, None
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            self.post_window.acquire()
+            start = clock()
+            # anything else raised by the post still frees its slot in the window, and counts as overloaded
+            overloaded = True
+            try:
+                r = self.solr_post(self.doc_endpoints[doc_type], data=body, headers=headers, timeout=60)
+                error = None
+            except requests.RequestException as e:
+                r, error = None, e
+            else:
+                overloaded = r.status_code in self.retry_statuses
+            finally:
+                self.post_window.release(clock() - start, overloaded)
+                registry.set_gauge('post_window', int(self.post_window.limit))
+
+            if r is not None and r.ok:
+                registry.record_doc(doc_type, len(body))
+                return True
+            if not overloaded or attempt == self.max_retries:
+                break
 
-        self.written_docs[doc_type] += 1
+            registry.increment('solr_post_retries')
+            time.sleep(backoff_delay(attempt))
+
+        log.error("Error sending document to destination Solr: %s" % (error if r is None else r.content))
+        with self.failed_lock:
+            self.failed_docs[doc_type] += 1
+        self.dead_letter(doc_type, json.loads(body.decode('utf8'))['add']['doc'],
+                         error if r is None else "HTTP %d: %s" % (r.status_code, r.text))
+        return False
 
-        if not r.ok:
-            log.error("Error sending document to destination Solr: %s" % r.content)
-        return r
+    def dead_letter(self, doc_type, doc_content, error):
+        if self.spool:
+            self.spool.write(self.destination, doc_type, doc_content, error)
+
+    def replay_doc(self, doc_type, doc_content):
+        """
+        Resend a document saved by dead_letter(). Solr documents were saved as posted, after the id rewrites;
+        feed metadata and sensors were saved as read from the source and go through the usual lookups again.
+        """
+        if doc_type == 'feed_metadata':
+            self.output_feed_metadata(doc_content)
+        elif doc_type == 'sensor':
+            self.output_sensor_info(doc_content)
+        else:
+            self.output_doc(doc_type, doc_content)
+
+    def post_worker(self):
+        while True:
+            item = self.post_queue.get()
+            if item is None:
+                return
+            self.post_doc(*item)
+
+    def start_post_workers(self):
+        self.post_queue = Queue.Queue(maxsize=self.max_concurrency * 2)
+        self.post_threads = [threading.Thread(target=self.post_worker) for _ in range(self.max_concurrency)]
+        for thread in self.post_threads:
+            thread.daemon = True
+            thread.start()
+
+    def flush_posts(self):
+        if not self.post_queue:
+            return
+
+        for _ in self.post_threads:
+            self.post_queue.put(None)
+        for thread in self.post_threads:
+            thread.join()
+        self.post_queue = None
+        self.post_threads = []
 
     def output_feed_doc(self, doc_content):
         if doc_content['feed_id'] not in self.feed_id_map:
@@ -367,6 +848,68 @@ class SolrOutputSink(SolrBase):
             doc_content = deepcopy(doc_content)
             update_sensor_id_refs(doc_content, sensor_id)
 
+        if self.existing_policy == 'overwrite':
+            self.post_process_doc(doc_content)
+            return
+
+        # the existence check has to use the unique_id as rewritten for the target sensor id
+        self.pending_process_docs.append(doc_content)
+        if len(self.pending_process_docs) >= self.existence_batch_size:
+            self.flush_process_docs()
+
+    def existence_query(self, docs):
+        return {
+            'q': 'unique_id:(%s)' % ' OR '.join(str(doc['unique_id']) for doc in docs),
+            'fl': 'unique_id,last_update',
+            'rows': len(docs),
+            'wt': 'json'
+        }
+
+    def select_process_docs(self, docs, existing_docs):
+        """
+        Apply the existing document policy.
+        :param existing_docs: documents returned by the existence query
+        :return: the documents that should be posted
+        """
+        existing = dict((str(doc.get('unique_id')), doc.get('last_update')) for doc in existing_docs)
+
+        selected = []
+        for doc in docs:
+            process_id = str(doc['unique_id'])
+            if process_id not in existing:
+                selected.append(doc)
+            elif self.existing_policy == 'newer' and doc.get('last_update') and \
+                    (not existing[process_id] or
+                     parse_solr_date(doc['last_update']) > parse_solr_date(existing[process_id])):
+                selected.append(doc)
+            else:
+                log.debug("Skipping process %s, which already exists in the destination" % process_id)
+                self.skipped_docs['proc'] += 1
+
+        return selected
+
+    def flush_process_docs(self):
+        docs, self.pending_process_docs = self.pending_process_docs, []
+        if not docs:
+            return
+
+        import requests
+        try:
+            resp = self.solr_get("/solr/0/select", params=self.existence_query(docs))
+        except requests.RequestException as e:
+            log.error("Error checking for existing process documents, sending them anyway: %s" % e)
+            existing_docs = []
+        else:
+            if not resp.ok:
+                log.error("Error checking for existing process documents, sending them anyway: %s" % resp.content)
+                existing_docs = []
+            else:
+                existing_docs = resp.json().get('response', {}).get('docs', [])
+
+        for doc in self.select_process_docs(docs, existing_docs):
+            self.post_process_doc(doc)
+
+    def post_process_doc(self, doc_content):
         # fix up the last_update field
         last_update = doc_content.get("last_update", None) or self.now
         doc_content["last_update"] = {"set": last_update}
@@ -382,13 +925,18 @@ class SolrOutputSink(SolrBase):
             self.feed_id_map[original_id] = feed_id
             return
 
+        original_doc = deepcopy(doc_content)
         doc_content.pop('id', None)
         doc_content['manually_added'] = True
         doc_content['enabled'] = False
         doc_content['display_name'] += ' (added via cb-event-duplicator)'
 
         feed_id = self.insert_db_row('alliance_feeds', doc_content)
+        if not feed_id:
+            self.dead_letter('feed_metadata', original_doc, "Could not insert feed %s" % doc_content['name'])
+            return
         self.new_metadata['feed'].append(doc_content['name'])
+        registry.record_doc('feed_metadata')
 
         self.feed_id_map[original_id] = feed_id
 
@@ -403,6 +951,8 @@ class SolrOutputSink(SolrBase):
             self.sensor_id_map[original_id] = sensor_id
             return
 
+        original_doc = deepcopy(doc_content)
+
         # we need to first ensure that the sensor build and os_environment are available in the target server
         os_id = self.find_db_row_matching('sensor_os_environments', doc_content['os_info'])
         if not os_id:
@@ -416,11 +966,19 @@ class SolrOutputSink(SolrBase):
         doc_content['sensor_info']['build_id'] = build_id
         doc_content['sensor_info']['os_environment_id'] = os_id
         sensor_id = self.insert_db_row('sensor_registrations', doc_content['sensor_info'])
+        if not sensor_id:
+            self.dead_letter('sensor', original_doc,
+                             "Could not insert sensor %s" % doc_content['sensor_info']['computer_name'])
+            return
 
         self.new_metadata['sensor'].append(doc_content['sensor_info']['computer_name'])
+        registry.record_doc('sensor')
         self.sensor_id_map[original_id] = sensor_id
 
     def cleanup(self):
+        self.flush_process_docs()
+        self.flush_posts()
+
         headers = {'content-type': 'application/json; charset=utf8'}
         args = {}
 
@@ -435,6 +993,16 @@ class SolrOutputSink(SolrBase):
         report_data = "Documents inserted into %s by type:\n" % (self.connection,)
         for key in self.written_docs.keys():
             report_data += " %8s: %d\n" % (key, self.written_docs[key])
+        if self.skipped_docs:
+            report_data += "Documents already in %s and skipped by type:\n" % (self.connection,)
+            for key in self.skipped_docs.keys():
+                report_data += " %8s: %d\n" % (key, self.skipped_docs[key])
+        if self.failed_docs:
+            report_data += "Documents that could not be sent to %s by type:\n" % (self.connection,)
+            for key in self.failed_docs.keys():
+                report_data += " %8s: %d\n" % (key, self.failed_docs[key])
+        if self.spool:
+            report_data += self.spool.report()
         for key in self.new_metadata.keys():
             report_data += "New %ss created in %s:\n" % (key, self.connection)
             for value in self.new_metadata[key]:
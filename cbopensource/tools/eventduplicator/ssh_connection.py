@@ -6,11 +6,11 @@ except ImportError:
     import socketserver as SocketServer
 import select
 import threading
-import requests
 import logging
 import getpass
-import psycopg2
 import socket
+import itertools
+from cbopensource.tools.eventduplicator.metrics import registry
 
 __author__ = 'jgarman'
 
@@ -33,11 +33,12 @@ class ForwardServer (SocketServer.ThreadingTCPServer, threading.Thread):
         return self.serve_forever()
 
 
-def get_request_handler(remote_host, remote_port, transport):
+def get_request_handler(remote_host, remote_port, transport, counter_name):
     class SubHandler(Handler):
         chain_host = remote_host
         chain_port = int(remote_port)
         ssh_transport = transport
+        byte_counter = counter_name
 
     return SubHandler
 
@@ -60,16 +61,19 @@ class Handler(SocketServer.BaseRequestHandler):
                                                               chan.getpeername(), (self.chain_host, self.chain_port)))
         while True:
             r, w, x = select.select([self.request, chan], [], [])
-            if self.request in r:
-                data = self.request.recv(1024)
-                if len(data) == 0:
-                    break
-                chan.send(data)
-            if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
+            with registry.span('ssh_relay'):
+                if self.request in r:
+                    data = self.request.recv(1024)
+                    if len(data) == 0:
+                        break
+                    chan.send(data)
+                    registry.add_bytes(self.byte_counter + ':sent', len(data))
+                if chan in r:
+                    data = chan.recv(1024)
+                    if len(data) == 0:
+                        break
+                    self.request.send(data)
+                    registry.add_bytes(self.byte_counter + ':received', len(data))
 
         peername = self.request.getpeername()
         chan.close()
@@ -78,20 +82,44 @@ class Handler(SocketServer.BaseRequestHandler):
 
 
 class SSHConnection(object):
-    def __init__(self, username, hostname, port, password_callback=get_password):
-        self.ssh_connection = paramiko.SSHClient()
-        self.ssh_connection.load_system_host_keys()
-        self.ssh_connection.set_missing_host_key_policy(paramiko.WarningPolicy())
+    """
+    Tunnels Solr and Postgres traffic to a Cb server over SSH. With stripes > 1, that many SSH connections are opened
+    to the server, each with its own Solr tunnel, and Solr requests are spread over them round robin: a single SSH
+    connection is one TCP stream with one encryption thread, which limits throughput on high-latency links however
+    many requests are in flight. Postgres and SFTP always use the first connection.
+    """
+    def __init__(self, username, hostname, port, password_callback=get_password, password='', stripes=1):
         self.name = "%s@%s:%d" % (username, hostname, port)
+        import requests
         self.session = requests.Session()
 
-        connected = False
-        password = ''
-        while not connected:
+        self.ssh_connection, password = self.connect(username, hostname, port, password_callback, password)
+        # kept so that worker processes can open their own connections without prompting again
+        self.password = password
+        self.stripe_connections = [self.ssh_connection]
+        for i in range(1, stripes):
+            self.stripe_connections.append(self.connect(username, hostname, port, password_callback, password)[0])
+
+        self.forwarded_connections = []
+
+        self.solr_url_bases = []
+        for i, ssh_connection in enumerate(self.stripe_connections):
+            solr_forwarded_port = self.forward_tunnel('127.0.0.1', 8080, ssh_connection=ssh_connection,
+                                                      counter_name=self.counter_name('solr#%d' % i))
+            self.solr_url_bases.append('http://127.0.0.1:%d' % solr_forwarded_port)
+        self.solr_url_base = self.solr_url_bases[0]
+        self.next_stripe = itertools.count()
+
+    def connect(self, username, hostname, port, password_callback, password):
+        ssh_connection = paramiko.SSHClient()
+        ssh_connection.load_system_host_keys()
+        ssh_connection.set_missing_host_key_policy(paramiko.WarningPolicy())
+
+        while True:
             try:
-                self.ssh_connection.connect(hostname=hostname, username=username, port=port, look_for_keys=False,
-                                            password=password, timeout=2.0, banner_timeout=2.0, allow_agent=True)
-                connected = True
+                ssh_connection.connect(hostname=hostname, username=username, port=port, look_for_keys=False,
+                                       password=password, timeout=2.0, banner_timeout=2.0, allow_agent=True)
+                return ssh_connection, password
             except paramiko.AuthenticationException:
                 password = password_callback(self.name)
             except paramiko.SSHException as e:
@@ -101,30 +129,33 @@ class SSHConnection(object):
                 log.error("Error connecting to %s: %s" % (self.name, str(e)))
                 raise
 
-        self.forwarded_connections = []
+    def counter_name(self, tunnel):
+        return 'ssh:%s %s' % (self.name, tunnel)
 
-        solr_forwarded_port = self.forward_tunnel('127.0.0.1', 8080)
-        self.solr_url_base = 'http://127.0.0.1:%d' % solr_forwarded_port
+    def stripe_url_base(self):
+        # requests keeps a separate keep-alive pool per local port, so each stripe reuses its own HTTP connections
+        return self.solr_url_bases[next(self.next_stripe) % len(self.solr_url_bases)]
 
     def http_get(self, path, **kwargs):
-        return self.session.get('%s%s' % (self.solr_url_base, path), **kwargs)
+        return self.session.get('%s%s' % (self.stripe_url_base(), path), **kwargs)
 
     def http_post(self, path, *args, **kwargs):
-        return self.session.post('%s%s' % (self.solr_url_base, path), *args, **kwargs)
+        return self.session.post('%s%s' % (self.stripe_url_base(), path), *args, **kwargs)
 
-    def forward_tunnel(self, remote_host, remote_port):
+    def forward_tunnel(self, remote_host, remote_port, ssh_connection=None, counter_name=None):
         # this is a little convoluted, but lets me configure things for the Handler
         # object.  (socketserver doesn't give Handlers any way to access the outer
         # server normally.)
 
-        transport = self.ssh_connection.get_transport()
+        transport = (ssh_connection or self.ssh_connection).get_transport()
+        counter_name = counter_name or self.counter_name('%s:%d' % (remote_host, remote_port))
 
         local_port = 12001
         conn = None
         while not conn and local_port < 65536:
             try:
                 conn = ForwardServer(('127.0.0.1', local_port),
-                                     get_request_handler(remote_host, remote_port, transport))
+                                     get_request_handler(remote_host, remote_port, transport, counter_name))
             except Exception:
                 local_port += 1
 
@@ -139,12 +170,19 @@ class SSHConnection(object):
     def close(self):
         for conn in self.forwarded_connections:
             conn.shutdown()
+        for ssh_connection in self.stripe_connections[1:]:
+            ssh_connection.close()
 
     def open_file(self, filename, mode='r'):
         return self.ssh_connection.open_sftp().file(filename, mode=mode)
 
+    def db_endpoint(self, host, port):
+        local_port = self.forward_tunnel(remote_host=host, remote_port=port, counter_name=self.counter_name('postgres'))
+        return host, local_port
+
     def open_db(self, user, password, database, host, port):
-        local_port = self.forward_tunnel(remote_host=host, remote_port=port)
+        import psycopg2
+        host, local_port = self.db_endpoint(host, port)
         return psycopg2.connect(user=user, password=password, database=database, host=host, port=local_port)
 
     def __str__(self):
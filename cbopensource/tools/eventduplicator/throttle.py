@@ -0,0 +1,91 @@
+from __future__ import absolute_import, division, print_function
+import time
+import random
+import threading
+from cbopensource.tools.eventduplicator.metrics import clock
+
+__author__ = 'jgarman'
+
+
+class TokenBucket(object):
+    """
+    Limits callers of acquire() to `rate` per second on average, allowing bursts of up to `burst`. A rate of None
+    means no limit.
+    """
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate or 1, 1)
+        self.tokens = self.burst
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            wait = self.reserve(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def reserve(self, tokens=1):
+        """
+        Take `tokens` if they are available.
+
+        :return: 0 if they were taken, otherwise the number of seconds to wait before trying again
+        """
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+
+class AIMDController(object):
+    """
+    Adaptive concurrency window: grows by one slot per window of requests that complete within target_latency,
+    and is halved (at most once per window) when a request is slower than that or the server signals overload.
+    """
+    def __init__(self, maximum, minimum=1, initial=None, target_latency=1.0, decrease=0.5):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(initial or minimum)
+        self.target_latency = target_latency
+        self.decrease = decrease
+
+        self.inflight = 0
+        self.completed_since_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                self.condition.wait()
+            self.inflight += 1
+
+    def release(self, latency, overloaded=False):
+        with self.condition:
+            self.inflight -= 1
+            self.adjust(latency, overloaded)
+            self.condition.notify_all()
+
+    def adjust(self, latency, overloaded):
+        self.completed_since_decrease += 1
+        if overloaded or latency > self.target_latency:
+            # only back off once for all the requests that were in flight when the server got slow
+            if self.completed_since_decrease >= int(self.limit):
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.completed_since_decrease = 0
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """
+    :return: seconds to wait before retry number `attempt` (starting at 0): exponential backoff with full jitter
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
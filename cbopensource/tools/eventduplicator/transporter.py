@@ -1,8 +1,12 @@
 from __future__ import absolute_import, division, print_function
 import logging
 import datetime
-from cbopensource.tools.eventduplicator.utils import get_process_id, get_parent_process_id
-import sys
+from copy import deepcopy
+from cbopensource.tools.eventduplicator.utils import get_process_id, get_parent_process_id, update_sensor_id_refs, \
+    replace_sensor_in_guid, sample_bucket
+from cbopensource.tools.eventduplicator.events import EVENT_FIELDS, EventColumns, compact_events, event_column
+from cbopensource.tools.eventduplicator.metrics import registry, ProgressLine
+from cbopensource.tools.eventduplicator.throttle import TokenBucket
 
 __author__ = 'jgarman'
 
@@ -10,7 +14,7 @@ log = logging.getLogger(__name__)
 
 
 class Transporter(object):
-    def __init__(self, input_source, output_sink, tree=False):
+    def __init__(self, input_source, output_sink, tree=False, prefetch=False, amplifier=None, target_rate=None):
         self.input_md5set = set()
         self.input_proc_guids = set()
 
@@ -23,50 +27,65 @@ class Transporter(object):
         self.seen_feed_ids = set()
 
         self.traverse_tree = tree
+        self.prefetch = prefetch
+        self.progress = ProgressLine()
+
+        # writes each process and sensor as several copies under synthetic sensors, see Amplifier
+        self.amplifier = amplifier
+        # paces process documents, including amplified copies, to target_rate per second
+        self.rate_limiter = TokenBucket(target_rate)
 
     def add_anonymizer(self, munger):
         self.mungers.append(munger)
 
     def output_process_doc(self, doc):
-        for munger in self.mungers:
-            doc = munger.munge_document('proc', doc)
+        with registry.span('munge'):
+            for munger in self.mungers:
+                doc = munger.munge_document('proc', doc)
+
+        self.progress.update("Uploading %s (%.1f procs/sec)..." % (get_process_id(doc), registry.rate('proc')))
 
-        sys.stdout.write('%-70s\r' % ("Uploading process %s..." % get_process_id(doc)))
-        sys.stdout.flush()
+        for doc in self.amplifier.amplify_process(doc) if self.amplifier else [doc]:
+            self.rate_limiter.acquire()
+            self.output.output_process_doc(doc)
 
-        self.output.output_process_doc(doc)
+    def munge_feed_doc(self, doc):
+        with registry.span('munge'):
+            for munger in self.mungers:
+                doc = munger.munge_document('feed', doc)
+        return doc
 
-    def output_feed_doc(self, doc):
-        for munger in self.mungers:
-            doc = munger.munge_document('feed', doc)
+    def output_feed_metadata(self, feed_ids):
+        # only feeds we have not seen before; their metadata is loaded with a single query
+        new_feed_ids = set(feed_ids) - self.seen_feed_ids
+        if not new_feed_ids:
+            return
 
-        # check if we have seen this feed_id before
-        feed_id = doc['feed_id']
-        if feed_id not in self.seen_feed_ids:
-            feed_metadata = self.input.get_feed_metadata(feed_id)
-            if feed_metadata:
+        feed_metadata = self.input.get_feeds_metadata(new_feed_ids)
+        for feed_id in sorted(new_feed_ids):
+            if feed_metadata.get(feed_id):
                 # note that without feed metadata, bad things may happen on the Cb UI side...
-                self.output.output_feed_metadata(feed_metadata)
+                self.output.output_feed_metadata(feed_metadata[feed_id])
                 self.seen_feed_ids.add(feed_id)
 
-        self.output.output_feed_doc(doc)
-
     def output_binary_doc(self, doc):
-        for munger in self.mungers:
-            # note that the mungers are mutating the data in place, anyway.
-            doc = munger.munge_document('binary', doc)
+        with registry.span('munge'):
+            for munger in self.mungers:
+                # note that the mungers are mutating the data in place, anyway.
+                doc = munger.munge_document('binary', doc)
 
-        sys.stdout.write('%-70s\r' % ("Uploading binary %s..." % doc['md5']))
-        sys.stdout.flush()
+        self.progress.update("Uploading binary %s..." % doc['md5'])
 
         self.output.output_binary_doc(doc)
 
     def output_sensor_info(self, doc):
-        for munger in self.mungers:
-            # note that the mungers are mutating the data in place, anyway.
-            doc['sensor_info'] = munger.munge_document('sensor', doc['sensor_info'])
+        with registry.span('munge'):
+            for munger in self.mungers:
+                # note that the mungers are mutating the data in place, anyway.
+                doc['sensor_info'] = munger.munge_document('sensor', doc['sensor_info'])
 
-        self.output.output_sensor_info(doc)
+        for doc in self.amplifier.amplify_sensor(doc) if self.amplifier else [doc]:
+            self.output.output_sensor_info(doc)
 
     def update_sensors(self, proc):
         sensor_id = proc.get('sensor_id', 0)
@@ -84,10 +103,10 @@ class Transporter(object):
         md5s = set()
         process_md5 = proc.get('process_md5', None)
         if process_md5 and process_md5 != '0'*32:
-            md5s.add(proc.get('process_md5'))
-        for modload_complete in proc.get('modload_complete', []):
-            fields = modload_complete.split('|')
-            md5s.add(fields[1])
+            md5s.add(process_md5.upper())
+        for md5sum in set(event_column(proc.get('modload_complete', []), 1)):
+            if md5sum:
+                md5s.add(md5sum.upper())
 
         retval = md5s - self.input_md5set
         self.input_md5set |= md5s
@@ -142,11 +161,11 @@ class Transporter(object):
             process_id = get_process_id(proc)
             if process_id not in self.input_proc_guids:
                 self.input_proc_guids.add(get_process_id(proc))
-                yield proc
+                yield compact_events(proc)
 
             if self.traverse_tree:
                 for tree_proc in self.traverse_up_down(proc):
-                    yield tree_proc
+                    yield compact_events(tree_proc)
 
     def update_feeds(self, doc):
         feed_keys = [k for k in doc.keys() if k.startswith('alliance_data_')]
@@ -229,6 +248,64 @@ class Transporter(object):
                                   'uptime': 340776}}
         return sensor
 
+    def output_binaries(self, binary_docs, referrer):
+        # binary_docs is an iterable of (md5sum, doc) pairs, with doc None if it could not be retrieved.
+        # returns the new feed hits referenced by these binaries
+        new_feed_ids = set()
+        for md5sum, doc in binary_docs:
+            if doc:
+                new_feed_ids |= self.update_feeds(doc)
+                self.output_binary_doc(doc)
+            else:
+                log.warning("Could not retrieve the binary MD5 %s referenced in %s" % (md5sum, referrer))
+
+        return new_feed_ids
+
+    def output_sensors(self, sensor_ids, referrer):
+        # TODO: right now we don't munge sensor or feed documents
+        for sensor in sensor_ids:
+            doc = self.input.get_sensor_doc(sensor)
+            if not doc:
+                log.warning("Could not retrieve sensor info for sensor id %s referenced in %s" % (sensor, referrer))
+                doc = self.generate_fake_sensor(sensor)
+
+            self.output_sensor_info(doc)
+
+    def output_feeds(self, feed_keys, referrer):
+        feed_docs = []
+        for feed, doc in self.input.get_feed_docs(feed_keys):
+            if doc:
+                feed_docs.append(self.munge_feed_doc(doc))
+            else:
+                log.warning("Could not retrieve feed document for id %s referenced in %s" % (feed, referrer))
+
+        # feed metadata has to be written before the feed documents that refer to it
+        self.output_feed_metadata(doc['feed_id'] for doc in feed_docs)
+        for doc in feed_docs:
+            self.output.output_feed_doc(doc)
+
+    def prefetch_dependencies(self):
+        dependencies = self.input.get_dependencies()
+        if dependencies is None:
+            log.info("%s cannot compute dependencies upfront; they will be found per process"
+                     % self.input.connection_name())
+            return
+
+        new_md5sums = set(dependencies['md5s']) - self.input_md5set
+        self.input_md5set |= new_md5sums
+        new_sensor_ids = set(dependencies['sensor_ids']) - self.seen_sensor_ids
+        self.seen_sensor_ids |= new_sensor_ids
+        new_feed_ids = set(dependencies['feed_keys']) - self.seen_feeds
+        self.seen_feeds |= new_feed_ids
+
+        log.info("Prefetching %d binaries, %d sensors and %d feed documents" % (len(new_md5sums), len(new_sensor_ids),
+                                                                               len(new_feed_ids)))
+
+        referrer = "the results of the query"
+        new_feed_ids |= self.output_binaries(self.input.get_binary_docs(new_md5sums), referrer)
+        self.output_sensors(new_sensor_ids, referrer)
+        self.output_feeds(new_feed_ids, referrer)
+
     def transport(self, debug=False):
         # TODO: multithread this so we have some parallelization
 
@@ -238,39 +315,25 @@ class Transporter(object):
         if not self.output.set_data_version(input_version):
             raise Exception("Input and Output versions are incompatible")
 
+        if self.prefetch:
+            self.prefetch_dependencies()
+
         # get process list
         for i, proc in enumerate(self.get_process_docs()):
             new_md5sums = self.update_md5sums(proc)
             new_sensor_ids = self.update_sensors(proc)
             new_feed_ids = self.update_feeds(proc)
 
+            registry.set_gauge('pending_binaries', len(new_md5sums))
+            registry.set_gauge('pending_sensors', len(new_sensor_ids))
+            registry.set_gauge('pending_feeds', len(new_feed_ids))
+
             # output docs, sending binaries & sensors first
-            for md5sum in new_md5sums:
-                doc = self.input.get_binary_doc(md5sum)
-                if doc:
-                    new_feed_ids |= self.update_feeds(doc)
-                    self.output_binary_doc(doc)
-                else:
-                    log.warning("Could not retrieve the binary MD5 %s referenced in the process with ID: %s"
-                                % (md5sum, proc['unique_id']))
-
-            # TODO: right now we don't munge sensor or feed documents
-            for sensor in new_sensor_ids:
-                doc = self.input.get_sensor_doc(sensor)
-                if not doc:
-                    log.warning("Could not retrieve sensor info for sensor id %s referenced in the process with ID: %s"
-                                % (md5sum, proc['unique_id']))
-                    doc = self.generate_fake_sensor(sensor)
-
-                self.output_sensor_info(doc)
-
-            for feed in new_feed_ids:
-                doc = self.input.get_feed_doc(feed)
-                if doc:
-                    self.output_feed_doc(doc)
-                else:
-                    log.warning("Could not retrieve feed document for id %s referenced in the process with ID: %s"
-                                % (md5sum, proc['unique_id']))
+            referrer = "the process with ID: %s" % proc['unique_id']
+            new_feed_ids |= self.output_binaries(((md5sum, self.input.get_binary_doc(md5sum))
+                                                  for md5sum in new_md5sums), referrer)
+            self.output_sensors(new_sensor_ids, referrer)
+            self.output_feeds(new_feed_ids, referrer)
 
             self.output_process_doc(proc)
 
@@ -278,8 +341,7 @@ class Transporter(object):
         self.input.cleanup()
         self.output.cleanup()
 
-        sys.stdout.write('%-70s\r' % "")
-        sys.stdout.flush()
+        self.progress.clear()
 
         log.info("Transport complete from %s to %s" % (self.input.connection_name(), self.output.connection_name()))
 
@@ -302,6 +364,111 @@ class CleanseSolrData(object):
         return doc_content
 
 
+class Sampler(object):
+    """
+    Keeps a deterministic fraction `rate` of the matching processes, to build smaller datasets. Processes are put in
+    one of 256 buckets by sample_bucket() and those in the first round(rate * 256) buckets are kept, so every run
+    picks the same processes, with all of their segments. Input sources apply it with set_sample(); with --tree, the
+    trees of the processes that are kept are then copied whole as usual.
+    """
+    buckets = 256
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.kept_buckets = min(max(int(round(rate * self.buckets)), 1), self.buckets)
+
+    def keep(self, process_id):
+        return sample_bucket(process_id) < self.kept_buckets
+
+    def solr_filter(self):
+        """
+        :return: a Solr query clause matching the unique_id of the processes that are kept, or None to keep them all
+        """
+        if self.kept_buckets == self.buckets:
+            return None
+        # wildcards on the last two digits of the GUID, before the segment number
+        return 'unique_id:(%s)' % ' OR '.join('????????-????-????-????-??????????%02x-*' % bucket
+                                              for bucket in range(self.kept_buckets))
+
+
+class Amplifier(object):
+    """
+    Replays each process `copies` times, each copy under its own synthetic sensor, to build load-test datasets from a
+    single read. Copy N of sensor S is sensor (N + 1) * sensor_id_stride + S, with "-ampN" appended to its computer
+    and host names; the sensor id in the process, parent, child and cross-process GUIDs is replaced to match, and the
+    times of copy N are shifted by N * time_offset seconds.
+    """
+    sensor_id_stride = 1000000
+    date_fields = ['start', 'last_update', 'server_added_timestamp', 'last_server_update']
+    event_fields = EVENT_FIELDS
+
+    def __init__(self, copies, time_offset=0):
+        self.copies = copies
+        self.time_offset = time_offset
+
+    def sensor_id(self, sensor_id, copy):
+        return (copy + 1) * self.sensor_id_stride + sensor_id
+
+    def sensor_ids(self, sensor_id):
+        return [self.sensor_id(sensor_id, copy) for copy in range(self.copies)]
+
+    @staticmethod
+    def hostname(hostname, copy):
+        return '%s-amp%d' % (hostname, copy)
+
+    @staticmethod
+    def shift_time(value, seconds):
+        # keeps the format of the original, e.g. 2015-11-10T19:54:45.000Z or 2015-11-10 19:54:45.000
+        base, dot, fraction = value.partition('.')
+        if not dot and base.endswith('Z'):
+            base, fraction = base[:-1], 'Z'
+        fmt = '%Y-%m-%dT%H:%M:%S' if 'T' in base else '%Y-%m-%d %H:%M:%S'
+        try:
+            shifted = datetime.datetime.strptime(base, fmt) + datetime.timedelta(seconds=seconds)
+        except ValueError:
+            return value
+        return shifted.strftime(fmt) + dot + fraction
+
+    def amplify_events(self, events, time_index, guid_index, sensor_id, seconds):
+        if not isinstance(events, EventColumns):
+            events = EventColumns(events, time_index)
+        if seconds:
+            events.map_column(time_index, lambda value: self.shift_time(value, seconds))
+        if guid_index is not None:
+            events.map_column(guid_index,
+                              lambda value: replace_sensor_in_guid(value, sensor_id) if len(value) > 9 else value)
+        return events
+
+    def amplify_sensor(self, doc):
+        for copy in range(self.copies):
+            sensor = deepcopy(doc)
+            sensor_info = sensor['sensor_info']
+            sensor_info['id'] = self.sensor_id(sensor_info['id'], copy)
+            for field in ['computer_name', 'computer_dns_name']:
+                if sensor_info.get(field):
+                    sensor_info[field] = self.hostname(sensor_info[field], copy)
+            yield sensor
+
+    def amplify_process(self, doc):
+        for copy in range(self.copies):
+            proc = deepcopy(doc)
+            sensor_id = self.sensor_id(proc.get('sensor_id', 0), copy)
+            update_sensor_id_refs(proc, sensor_id)
+            if proc.get('hostname'):
+                proc['hostname'] = self.hostname(proc['hostname'], copy)
+
+            seconds = copy * self.time_offset
+            if seconds:
+                for field in self.date_fields:
+                    if proc.get(field):
+                        proc[field] = self.shift_time(proc[field], seconds)
+
+            for field, (time_index, guid_index) in self.event_fields.items():
+                if proc.get(field) and (seconds or guid_index is not None):
+                    proc[field] = self.amplify_events(proc[field], time_index, guid_index, sensor_id, seconds)
+            yield proc
+
+
 class DataAnonymizer(object):
     def __init__(self):
         pass
@@ -336,25 +503,23 @@ class DataAnonymizer(object):
                 for piece in pieces:
                     translation_usernames[piece] = DataAnonymizer.translate(piece)
 
+        def anonymize_string(target):
+            target = target.replace(hostname, hostname_new)
+            for key in translation_usernames:
+                target = target.replace(key, translation_usernames.get(key))
+            return target
+
         for field in doc:
             values = doc[field]
             try:
                 if not values:
                     continue
-                was_list = True
-                targets = values
-                if not hasattr(values, '__iter__'):
-                    was_list = False
-                    targets = [values]
-                values = []
-                for target in targets:
-                    target = target.replace(hostname, hostname_new)
-                    for key in translation_usernames:
-                        target = target.replace(key, translation_usernames.get(key))
-                    values.append(target)
-                if not was_list:
-                    values = values[0]
-                doc[field] = values
+                if isinstance(values, EventColumns):
+                    values.map_text(anonymize_string)
+                elif isinstance(values, list):
+                    doc[field] = [anonymize_string(target) for target in values]
+                else:
+                    doc[field] = anonymize_string(values)
             except AttributeError:
                 pass
 
@@ -1,6 +1,5 @@
 from __future__ import absolute_import, division, print_function
-import datetime
-import json
+from cbopensource.tools.eventduplicator import serializer
 
 __author__ = 'jgarman'
 
@@ -23,6 +22,17 @@ def get_process_id(proc):
         return new_style_id
 
 
+def sample_bucket(guid):
+    """
+    :return: a bucket in [0, 256) from the last two hex digits of the process GUID, the same for every segment of the
+    process. Those digits are the low bits of the process start time, so the buckets are evenly filled.
+    """
+    guid = split_process_id(guid)[0]
+    if type(guid) == int:
+        return guid % 256
+    return int(guid[34:36], 16)
+
+
 def get_parent_process_id(proc):
     old_style_id = proc.get('parent_unique_id', None)
     if old_style_id and old_style_id != '':
@@ -35,11 +45,7 @@ def get_parent_process_id(proc):
 
 
 def json_encode(d):
-    def default(o):
-        if type(o) is datetime.date or type(o) is datetime.datetime:
-            return o.strftime("%Y-%m-%d %H:%M:%S.%f%z")
-
-    return json.dumps(d, default=default)
+    return serializer.dumps(d).decode('utf8')
 
 
 def replace_sensor_in_guid(guid, new_id):
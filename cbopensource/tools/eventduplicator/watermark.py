@@ -0,0 +1,46 @@
+from __future__ import absolute_import, division, print_function
+import os
+import json
+import logging
+import tempfile
+
+__author__ = 'jgarman'
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WATERMARK_FILE = os.path.join(os.path.expanduser('~'), '.cb-event-duplicator', 'watermarks.json')
+
+
+class WatermarkStore(object):
+    """
+    Remembers, per source/destination/query, the newest last_update value transferred so far, in a JSON file.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename or DEFAULT_WATERMARK_FILE
+        self.watermarks = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as fp:
+                self.watermarks = json.load(fp)
+
+    @staticmethod
+    def key(source, destination, query):
+        return '%s -> %s [%s]' % (source, destination, query)
+
+    def get(self, key):
+        return self.watermarks.get(key)
+
+    def set(self, key, value):
+        self.watermarks[key] = value
+        self.save()
+
+    def save(self):
+        dirname = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # write to a temporary file first, so an interrupted run never leaves a truncated watermark file behind
+        fd, tempname = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(self.watermarks, fp, indent=2, sort_keys=True)
+        os.rename(tempname, self.filename)
+        log.debug("Saved watermarks to %s" % self.filename)
@@ -15,6 +15,9 @@ setup(
         'paramiko<2.0',
         'psycopg2==2.6.1'
     ],
+    extras_require={
+        'async': ['aiohttp', 'asyncpg']
+    },
     entry_points={
         'console_scripts': ['cb-event-duplicator=cbopensource.tools.eventduplicator.data_migration:main']
     },
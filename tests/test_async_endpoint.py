@@ -0,0 +1,121 @@
+from __future__ import absolute_import, division, print_function
+import re
+import sys
+import shutil
+import asyncio
+import datetime
+import tempfile
+import unittest
+from cbopensource.tools.eventduplicator.file_endpoint import FileInputSource, FileOutputSink
+from cbopensource.tools.eventduplicator.transporter import Transporter
+from cbopensource.tools.eventduplicator.deadletter import DeadLetterSpool
+try:
+    from cbopensource.tools.eventduplicator.async_endpoint import AsyncSolrOutputSink, check_dependencies
+    check_dependencies()
+    import asyncpg
+except Exception:
+    # SyntaxError on Python 2, or aiohttp and asyncpg are missing
+    asyncpg = None
+
+__author__ = 'jgarman'
+
+COLUMN_TYPES = {
+    'sensor_registrations': {'last_checkin_time': 'timestamp with time zone',
+                             'last_update': 'timestamp with time zone',
+                             'license_expiration': 'timestamp without time zone',
+                             'next_checkin_time': 'timestamp with time zone',
+                             'registration_time': 'timestamp with time zone'},
+    'sensor_builds': {'installer_avail': 'boolean'},
+    'sensor_os_environments': {},
+}
+
+
+class FakeConnection(object):
+    def close(self):
+        pass
+
+    def __str__(self):
+        return "fake"
+
+
+class FakePool(object):
+    """
+    Stands in for an asyncpg pool: like asyncpg, it refuses to bind anything but datetime objects to timestamp
+    columns, and with fail_inserts set it fails every insert that way.
+    """
+    def __init__(self, fail_inserts=False):
+        self.fail_inserts = fail_inserts
+        self.rows = []
+
+    async def fetch(self, query, table_name):
+        return [{'column_name': name, 'data_type': data_type}
+                for name, data_type in COLUMN_TYPES[table_name].items()]
+
+    async def fetchrow(self, query, *args):
+        if query.startswith('SELECT'):
+            return None
+
+        table_name, columns = re.match(r'INSERT INTO (\w+) \(([^)]*)\)', query).groups()
+        values = dict(zip(columns.split(', '), args))
+        for column, data_type in COLUMN_TYPES[table_name].items():
+            if data_type.startswith('timestamp') and isinstance(values.get(column), str) or self.fail_inserts:
+                raise asyncpg.exceptions._base.DataError("invalid input for query argument: expected a datetime")
+
+        self.rows.append((table_name, values))
+        return {'id': len(self.rows)}
+
+    async def close(self):
+        pass
+
+
+@unittest.skipIf(asyncpg is None, "requires Python 3.6+, aiohttp and asyncpg")
+class TestAsyncSensorInsert(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        package = FileOutputSink(self.tempdir + '/package')
+        package.output_sensor_info(Transporter.generate_fake_sensor(5))
+        # as read back from a package, timestamps are strings
+        self.sensor_doc = FileInputSource(self.tempdir + '/package').get_sensor_doc(5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def output_sensor(self, pool):
+        sink = AsyncSolrOutputSink(FakeConnection(), spool=DeadLetterSpool(self.tempdir + '/failed.jsonl'))
+
+        async def run():
+            await sink.open()
+            sink.pool = pool
+            try:
+                await sink.output_sensor_info(self.sensor_doc)
+            finally:
+                await sink.close_async()
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+        return sink
+
+    def test_package_timestamps_are_bound_as_datetimes(self):
+        self.assertIsInstance(self.sensor_doc['sensor_info']['last_checkin_time'], str)
+
+        pool = FakePool()
+        sink = self.output_sensor(pool)
+
+        self.assertEqual(sink.sensor_id_map, {5: 3})
+        registration = dict(pool.rows)['sensor_registrations']
+        self.assertEqual(registration['last_checkin_time'],
+                         datetime.datetime(2015, 6, 30, 6, 9, 15, 570570, tzinfo=datetime.timezone.utc))
+        self.assertEqual(registration['license_expiration'], datetime.datetime(1990, 1, 1))
+
+    def test_binding_errors_dead_letter_the_sensor(self):
+        sink = self.output_sensor(FakePool(fail_inserts=True))
+
+        self.assertEqual(sink.sensor_id_map, {})
+        self.assertEqual(sink.spool.count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()